@@ -36,6 +36,7 @@ from nova.openstack.common import log as logging
 
 from nova.db.sqlalchemy import api as mysql_api
 from nova.db.discovery import api as discovery_api
+from nova.db.discovery import tracing
 
 
 db_opts = [
@@ -92,25 +93,9 @@ class ApiProxy:
         def __call__(self, *args, **kwargs):
 
             # result_callable_a = self.callable_a(*args, **kwargs)
-            # try:
-            result_callable_b = self.callable_b(*args, **kwargs)
-            # except:
-            #     result_callable_b = "ERROR"
-            #     pass
-
-            # pretty_print_callable_a = "%s.%s => [%s]" % (self.label_a, self.call_name, str(result_callable_a))
-            pretty_print_callable_b = "%s.%s(args=%s, kwargs=%s) => [%s]" % (self.label_b, self.call_name, str(args), str(kwargs), str(result_callable_b))
-            
-            # print(pretty_print_callable_a)
-            print(pretty_print_callable_b)
-
-            fo = open("/opt/logs/db_api.log", "a")
-
-            # fo.write(pretty_print_callable_a+"\n")
-            fo.write(pretty_print_callable_b+"\n")
-            fo.write("\n")
-
-            fo.close()
+            result_callable_b = tracing.trace_call(self.call_name,
+                                                   self.callable_b,
+                                                   *args, **kwargs)
 
             if self.return_first:
                 return result_callable_a
@@ -273,6 +258,20 @@ def compute_node_get_all(context, no_date_fields=False):
     return IMPL.compute_node_get_all(context, no_date_fields)
 
 
+def compute_node_get_all_changed_since(context, since):
+    """Get the computeNodes created, updated or deleted since a given time.
+
+    :param context: The security context
+    :param since: Datetime compared with the 'created_at', 'updated_at' and
+                  'deleted_at' fields of the compute nodes
+
+    :returns: List of dictionaries each containing compute node properties,
+              including corresponding service. Deleted compute nodes are
+              included, so that callers can forget them.
+    """
+    return IMPL.compute_node_get_all_changed_since(context, since)
+
+
 def compute_node_search_by_hypervisor(context, hypervisor_match):
     """Get compute nodes by hypervisor hostname.
 
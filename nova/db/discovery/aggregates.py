@@ -0,0 +1,400 @@
+"""Aggregates module.
+
+This module contains the aggregates (count, sum, min, max) computed by the
+queries of the discovery database backend, and the counters that maintain
+some of them incrementally.
+
+Aggregates are computed over the stored values of objects, which are not
+desimplified into models: a stored value is only wrapped into a RawObject,
+whose fields are read as attributes by the criterions of the query.
+
+The count of the objects of some tables, and the sum of some of their fields,
+are also maintained in Riak counters for groups of objects (e.g. the
+instances of a project, or of a user of a project): each write of an object
+updates the counters of its groups with the difference between its previous
+and its new value. A query that only selects these aggregates, with a
+criterion on the columns of a group, reads them from the counters. Counters
+of a table are built with a scan of the table the first time they are
+needed, under a guard (see the guards module) so that concurrent workers
+do not add their corrections twice.
+
+"""
+
+import datetime
+import threading
+
+import pytz
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import BinaryExpression
+from sqlalchemy.sql.expression import BindParameter
+from sqlalchemy.sql.expression import ColumnClause
+from sqlalchemy.sql.functions import FunctionElement
+
+from nova.db.discovery.client import get_client
+from nova.db.discovery import guards
+from nova.db.discovery import key_index
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+AGGREGATES_BUCKET = "aggregate_counters"
+AGGREGATES_STATUS_BUCKET = "aggregate_counters_status"
+
+"""Aggregates maintained in counters: tablename -> (groups of columns, summed
+fields). Objects are counted in each group, and the values of the summed
+fields are added."""
+COUNTED_TABLES = {
+    "instances": ([("project_id",), ("project_id", "user_id")],
+                  ["vcpus", "memory_mb"])
+}
+
+AGGREGATE_FUNCTIONS = ["count", "sum", "min", "max"]
+
+
+def is_aggregate(arg):
+    """Check if the given argument of a query is an aggregate function
+    (func.count(column), func.sum(column), ...)."""
+
+    return isinstance(arg, FunctionElement) and \
+        getattr(arg, "name", None) in AGGREGATE_FUNCTIONS
+
+
+def get_aggregate_column(arg):
+    """Returns the column aggregated by the given function, as a string
+    "tablename.column" (or None if the function has no column)."""
+
+    for clause in arg.clauses:
+        table = getattr(clause, "table", None)
+        if isinstance(clause, ColumnClause) and table is not None:
+            return "%s.%s" % (table.name, clause.name)
+        return None
+    return None
+
+
+class RawObject(object):
+    """Read-only view of the stored value of an object, whose fields are read
+    as attributes: datetimes are converted, other values are returned as they
+    are stored."""
+
+    __slots__ = ["_raw_value", "__tablename__"]
+
+    def __init__(self, value):
+        """Constructor"""
+
+        self._raw_value = value
+        self.__tablename__ = value.get("nova_classname")
+
+    def __getattr__(self, name):
+        value = self._raw_value.get(name)
+        if isinstance(value, dict) and \
+                value.get("simplify_strategy") == "datetime" and \
+                "epoch" in value:
+            result = datetime.datetime.utcfromtimestamp(value["epoch"])
+            if value.get("timezone") == "UTC":
+                result = pytz.utc.localize(result)
+            return result
+        return value
+
+
+def aggregate(name, values):
+    """Compute the given aggregate over a list of values: None values are
+    ignored, as with SQL aggregates."""
+
+    if name == "count":
+        return len(values)
+    values = [x for x in values if x is not None]
+    try:
+        if name == "sum":
+            return sum(values)
+        if name == "min":
+            return min(values) if len(values) > 0 else None
+        if name == "max":
+            return max(values) if len(values) > 0 else None
+    except TypeError:
+        return None
+    raise ValueError("unknown aggregate %s" % (name))
+
+
+def get_counter_key(tablename, group, values, field):
+    """Returns the key of the counter of a field (or of the count, if field
+    is None) of a group of objects."""
+
+    parts = ["%s=%s" % (column, values.get(column)) for column in group]
+    return "%s|%s|%s" % (tablename, "|".join(parts), field or "count")
+
+
+def get_contributions(tablename, value):
+    """Returns the increments that an object adds to the counters of its
+    table, as a dict counter_key -> increment."""
+
+    result = {}
+    if value is None or not tablename in COUNTED_TABLES:
+        return result
+    (groups, fields) = COUNTED_TABLES[tablename]
+    for group in groups:
+        result[get_counter_key(tablename, group, value, None)] = 1
+        for field in fields:
+            field_value = value.get(field)
+            if isinstance(field_value, (int, long)):
+                key = get_counter_key(tablename, group, value, field)
+                result[key] = field_value
+    return result
+
+
+CONFIGURED_BUCKETS = set()
+
+def get_counters_bucket():
+    """Returns the bucket that contains the counters: Riak counters require
+    siblings to be allowed on their bucket."""
+
+    counters_bucket = get_client().bucket(AGGREGATES_BUCKET)
+    if not AGGREGATES_BUCKET in CONFIGURED_BUCKETS:
+        counters_bucket.allow_mult = True
+        CONFIGURED_BUCKETS.add(AGGREGATES_BUCKET)
+    return counters_bucket
+
+
+def update_counters(tablename, old_value, new_value):
+    """Update the counters of a table after an object has been written: its
+    previous value (None if the object did not exist) is replaced by its new
+    value (None if the object has been deleted)."""
+
+    update_table_counters(tablename, [(old_value, new_value)])
+
+
+def update_table_counters(tablename, changes):
+    """Update the counters of a table after several of its objects have
+    been written: the increments of the objects are added up, so that each
+    counter is updated once.
+    :param changes: a list of tuples (previous value, new value)
+    """
+
+    if not tablename in COUNTED_TABLES:
+        return
+    increments = {}
+    for (old_value, new_value) in changes:
+        for (key, value) in get_contributions(tablename, new_value).items():
+            increments[key] = increments.get(key, 0) + value
+        for (key, value) in get_contributions(tablename, old_value).items():
+            increments[key] = increments.get(key, 0) - value
+
+    try:
+        counters_bucket = get_counters_bucket()
+        for (key, increment) in increments.items():
+            if increment != 0:
+                counters_bucket.update_counter(key, increment)
+    except Exception:
+        LOG.exception("could not update the counters of %s" % (tablename))
+        forget_counters(tablename)
+
+
+"""Tables whose counters are known to be built."""
+COUNTED_READY = set()
+COUNTED_LOCK = threading.Lock()
+
+
+"""Number of seconds a rebuild of the counters of a table may hold their
+guard: the scan of a large table may last longer than a quota reservation."""
+REBUILD_LEASE_DURATION = 600
+
+"""Number of scans of a table before giving up a rebuild of its counters,
+when they are updated during each scan."""
+REBUILD_ATTEMPTS = 3
+
+
+def counters_guard_name(tablename):
+    """Returns the name of the guard of the counters of a table, which
+    serializes their rebuilds and the changes of their status."""
+
+    return "counters:%s" % (tablename)
+
+
+def forget_counters(tablename):
+    """Mark the counters of a table as invalid: they will be rebuilt before
+    being used again."""
+
+    COUNTED_READY.discard(tablename)
+    with guards.guarded(counters_guard_name(tablename),
+                        lease_duration=REBUILD_LEASE_DURATION):
+        status = get_client().bucket(AGGREGATES_STATUS_BUCKET).\
+            get(tablename)
+        if isinstance(status.data, dict):
+            status.data = dict(status.data, ready=False)
+        else:
+            status.data = {"ready": False}
+        status.store()
+
+
+def read_counter_values(keys):
+    """Returns the current values of the given counters, as a dict."""
+
+    counters_bucket = get_counters_bucket()
+    return dict((key, counters_bucket.get_counter(key) or 0)
+                for key in keys)
+
+
+def compute_counters(tablename, objects):
+    """Returns the values of the counters of a table computed from its
+    objects, as a dict counter_key -> value.
+    :param objects: the stored values of every object of the table
+    """
+
+    totals = {}
+    for value in objects:
+        for (key, increment) in get_contributions(tablename, value).items():
+            totals[key] = totals.get(key, 0) + increment
+    return totals
+
+
+def rebuild_counters(tablename, totals, before):
+    """Set the counters of a table to the given values. The guard of the
+    counters must be held. Returns False, without changing the counters, if
+    some of them were updated since their values were read before the scan
+    of the table: the scan may then miss writes that the counters include.
+    :param totals: the values computed by compute_counters
+    :param before: the values of the counters of the table read before the
+    scan of the table, which must include every counter of totals
+    """
+
+    """Counters can only be incremented: each counter is moved by the
+    difference between its computed value and its current value. A write
+    that lands after the current values are read is kept, as it increments
+    the counters on its own: only a write whose object is scanned, but whose
+    counters are updated after they are read, is counted twice."""
+    current = read_counter_values(before.keys())
+    if current != before:
+        return False
+    counters_bucket = get_counters_bucket()
+    for (key, value) in current.items():
+        if totals.get(key, 0) != value:
+            counters_bucket.update_counter(key, totals.get(key, 0) - value)
+
+    status = get_client().bucket(AGGREGATES_STATUS_BUCKET).new(tablename,
+        data={"ready": True, "keys": sorted(current.keys())})
+    status.store()
+    return True
+
+
+def ensure_counters(tablename):
+    """Make sure that the counters of the given table are built. Returns
+    False if they could not be built.
+
+    The counters are rebuilt under their guard, so that the API workers
+    that need them at the same time rebuild them once. The counters found
+    by a scan that were not read before it (e.g. the first time the
+    counters are built) are read before the next scan.
+    """
+
+    if tablename in COUNTED_READY:
+        return True
+    with COUNTED_LOCK:
+        if tablename in COUNTED_READY:
+            return True
+        try:
+            status_bucket = get_client().bucket(AGGREGATES_STATUS_BUCKET)
+            status = status_bucket.get(tablename)
+            if isinstance(status.data, dict) and status.data.get("ready"):
+                COUNTED_READY.add(tablename)
+                return True
+
+            with guards.guarded(counters_guard_name(tablename),
+                                lease_duration=REBUILD_LEASE_DURATION):
+                """Another worker may have rebuilt the counters while the
+                guard was waited for."""
+                status = status_bucket.get(tablename)
+                if isinstance(status.data, dict):
+                    if status.data.get("ready"):
+                        COUNTED_READY.add(tablename)
+                        return True
+                    known_keys = set(status.data.get("keys", []))
+                else:
+                    known_keys = set()
+
+                from nova.db.discovery.utils import get_objects
+                for attempt in range(REBUILD_ATTEMPTS):
+                    before = read_counter_values(known_keys)
+                    objects = []
+                    for keys in key_index.iter_key_shards(tablename):
+                        objects += get_objects(tablename, desimplify=False,
+                                               keys=keys)
+                    totals = compute_counters(tablename, objects)
+                    if set(totals.keys()) <= known_keys and \
+                            rebuild_counters(tablename, totals, before):
+                        COUNTED_READY.add(tablename)
+                        return True
+                    known_keys |= set(totals.keys())
+                LOG.warning("counters of %s were updated during each scan "
+                            "of the table", tablename)
+                return False
+        except Exception:
+            LOG.exception("could not build counters of %s", tablename)
+            return False
+
+
+def extract_equalities(criterions, tablename):
+    """Returns the values of the columns of a table that the given
+    criterions test for equality, as a dict column -> value, or None if the
+    criterions are not only equalities on columns of this table."""
+
+    result = {}
+    for criterion in criterions:
+        if hasattr(criterion, "is_boolean_expression"):
+            if criterion.operator != "AND" and \
+                    not (criterion.operator == "NORMAL" and
+                         len(criterion.exps) == 1):
+                return None
+            equalities = extract_equalities(criterion.exps, tablename)
+        elif isinstance(criterion, BinaryExpression):
+            left = criterion.left
+            right = criterion.right
+            if criterion.operator is not operators.eq or \
+                    not isinstance(right, BindParameter) or \
+                    getattr(getattr(left, "table", None), "name",
+                            None) != tablename:
+                return None
+            equalities = {left.name: right.effective_value}
+        else:
+            return None
+        if equalities is None:
+            return None
+        for (column, value) in equalities.items():
+            if column in result and result[column] != value:
+                return None
+            result[column] = value
+    return result
+
+
+def read_counters(tablename, functions, criterions):
+    """Read the given aggregates from the counters of a table. Returns the
+    list of their values, or None if they are not maintained in counters.
+    :param functions: a list of tuples (aggregate name, "tablename.column")
+    """
+
+    if not tablename in COUNTED_TABLES:
+        return None
+    equalities = extract_equalities(criterions, tablename)
+    if equalities is None:
+        return None
+    (groups, fields) = COUNTED_TABLES[tablename]
+    group = [x for x in groups if set(x) == set(equalities.keys())]
+    if len(group) == 0:
+        return None
+
+    counter_fields = []
+    for (name, column) in functions:
+        field = (column or "").split(".")[-1]
+        if name == "count":
+            counter_fields += [None]
+        elif name == "sum" and field in fields:
+            counter_fields += [field]
+        else:
+            return None
+
+    if not ensure_counters(tablename):
+        return None
+    counters_bucket = get_counters_bucket()
+    result = []
+    for field in counter_fields:
+        key = get_counter_key(tablename, group[0], equalities, field)
+        result += [counters_bucket.get_counter(key) or 0]
+    return result
@@ -0,0 +1,99 @@
+"""Allocator module.
+
+This module contains the allocator of identifiers of the discovery database
+backend. Each table has a counter stored in Riak, which is incremented
+atomically by the database: a process leases a block of identifiers by
+incrementing the counter of a table by the size of a block, and then hands out
+the identifiers of its block without any further request. Two processes thus
+never give the same identifier to two objects.
+
+"""
+
+import threading
+
+from nova.db.discovery import key_index
+from nova.db.discovery.client import get_client
+
+ID_COUNTERS_BUCKET = "id_counters"
+
+"""Number of identifiers leased at once by a process."""
+ID_BLOCK_SIZE = 1000
+
+
+class IdAllocator(object):
+    """Class that hands out unique identifiers for the objects of each
+    table, by leasing blocks of identifiers from the counters stored in
+    Riak."""
+
+    def __init__(self, block_size=ID_BLOCK_SIZE):
+        """Constructor"""
+
+        self.block_size = block_size
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.counters_configured = False
+
+    def get_counters_bucket(self):
+        """Returns the bucket that contains the counters: Riak counters
+        require siblings to be allowed on their bucket."""
+
+        counters_bucket = get_client().bucket(ID_COUNTERS_BUCKET)
+        if not self.counters_configured:
+            counters_bucket.allow_mult = True
+            self.counters_configured = True
+        return counters_bucket
+
+    def find_highest_existing_key(self, tablename):
+        """Returns the highest key used by the objects of the given table
+        before its counter was used, or 0 if the table has no object."""
+
+        return key_index.get_highest_key(tablename)
+
+    def lease_block(self, tablename):
+        """Lease a new block of identifiers for the given table.
+        :return: a list [next_id, last_id] describing the leased block
+        """
+
+        counters_bucket = self.get_counters_bucket()
+        last_id = counters_bucket.update_counter(tablename, self.block_size,
+                                                 returnvalue=True)
+
+        if not tablename in self.leases:
+            """The first lease of a table checks that the counter is above
+            identifiers given before the counter existed: otherwise the
+            counter is moved above them, by a whole number of blocks (at
+            least one), and the block is taken from the top of this
+            increment, which no other process can lease. As the counter
+            was already above the first block, the top of the increment is
+            above the existing identifiers."""
+            highest_key = self.find_highest_existing_key(tablename)
+            if last_id - self.block_size < highest_key:
+                blocks = max(1, -(-highest_key // self.block_size))
+                last_id = counters_bucket.update_counter(
+                    tablename,
+                    blocks * self.block_size,
+                    returnvalue=True
+                )
+
+        return [last_id - self.block_size + 1, last_id]
+
+    def allocate(self, tablename):
+        """Returns a new identifier for an object of the given table."""
+
+        with self.lock:
+            lease = self.leases.get(tablename)
+            if lease is None or lease[0] > lease[1]:
+                lease = self.lease_block(tablename)
+                self.leases[tablename] = lease
+            result = lease[0]
+            lease[0] += 1
+            return result
+
+
+ID_ALLOCATOR = IdAllocator()
+
+
+def allocate_id(tablename):
+    """Returns a new identifier for an object of the given table."""
+
+    return ID_ALLOCATOR.allocate(tablename)
@@ -89,6 +89,16 @@ import pytz
 from desimplifier import ObjectDesimplifier
 from utils import find_table_name
 from query import RiakModelQuery
+from query import paginate_query
+from nova.db.discovery.lazy_reference import LazyReference
+from nova.db.discovery.lazy_reference import prefetch
+from nova.db.discovery.lazy_reference import scan_table
+from nova.db.discovery import guards
+from nova.db.discovery import indexes
+from nova.db.discovery import key_index
+from nova.db.discovery.aggregates import RawObject
+from nova.db.discovery.query import normalize_sort_value
+from nova.db.discovery.utils import fetch_stored_values
 
 db_opts = [
     cfg.StrOpt('osapi_compute_unique_server_name_scope',
@@ -625,14 +635,56 @@ def compute_node_get_all(context, no_date_fields):
     #     node['service'] = services.get(proxy['service_id'])
 
     #     compute_nodes.append(node)
+    query = RiakModelQuery(models.ComputeNode)
+    return _compute_nodes_to_dicts(query.all())
+
+
+@require_admin_context
+def compute_node_get_all_changed_since(context, since):
+    """Soft deleted compute nodes are removed from the key index, so they
+    are not found by the query: they are found by the index of their
+    deletion time, and returned as dicts that only contain their identifier
+    and dates, which is all that is needed to forget them. Only the compute
+    nodes deleted since the given time are read (unless the table cannot be
+    indexed: every deleted compute node is then read)."""
+    query = RiakModelQuery(models.ComputeNode).\
+            filter(or_(models.ComputeNode.updated_at >= since,
+                       models.ComputeNode.created_at >= since,
+                       models.ComputeNode.deleted_at >= since))
+    result = _compute_nodes_to_dicts(query.all())
+
+    since_value = normalize_sort_value(since)
+    if indexes.ensure_table_indexed(models.ComputeNode):
+        deleted_keys = indexes.find_deleted_keys(models.ComputeNode, since)
+    else:
+        deleted_keys = key_index.iter_removed_keys("compute_nodes")
+    stored_values = fetch_stored_values("compute_nodes", list(deleted_keys))
+    for key in sorted(stored_values):
+        compute_node = RawObject(stored_values[key])
+        if not compute_node.deleted or compute_node.deleted_at is None or \
+                normalize_sort_value(compute_node.deleted_at) < since_value:
+            continue
+        result += [{
+            "id": compute_node.id,
+            "deleted": compute_node.deleted,
+            "created_at": compute_node.created_at,
+            "updated_at": compute_node.updated_at,
+            "deleted_at": compute_node.deleted_at,
+            "service": None
+        }]
+    return result
+
+
+def _compute_nodes_to_dicts(compute_nodes):
+    """Convert compute nodes to dicts, which contain their service."""
     from nova.db.discovery.simplifier import ObjectSimplifier
     from nova.db.discovery.desimplifier import ObjectDesimplifier
 
-    query = RiakModelQuery(models.ComputeNode)
-    compute_nodes = query.all()
+    """Objects of this call share a request, so that the lazy references they
+    create are loaded together."""
+    request_uuid = uuid.uuid1()
 
     def novabase_to_dict(ref):
-        request_uuid = uuid.uuid1()
         object_simplifier = ObjectSimplifier(request_uuid=request_uuid)
         object_desimplifier = ObjectDesimplifier(request_uuid=request_uuid)
 
@@ -643,11 +695,27 @@ def compute_node_get_all(context, no_date_fields):
         
         return desimplified_object
 
+    """The services find their compute node by its service_id, which is
+    resolved by scanning the compute nodes table: it is scanned once for the
+    whole call, instead of once per service. The compute nodes returned by
+    a query are lazy references of the request of the query, which resolve
+    the same relationships when they are loaded."""
+    request_uuids = set([request_uuid])
+    for each in compute_nodes:
+        if isinstance(each, LazyReference):
+            request_uuids.add(each.request_uuid)
+    scan_table("compute_nodes", request_uuids)
+
+    """Load the services with one batched request."""
+    prefetch([LazyReference("services", each.service_id, request_uuid, None)
+              for each in compute_nodes])
+
     result = []
     for each in compute_nodes:
         compute_node = novabase_to_dict(each)
-        compute_node["service"] = novabase_to_dict(compute_node["service"])
-        compute_node["service"].pop("compute_node")
+        if compute_node.get("service") is not None:
+            compute_node["service"] = novabase_to_dict(compute_node["service"])
+            compute_node["service"].pop("compute_node")
         result += [compute_node]
 
     return result
@@ -2037,17 +2105,16 @@ def instance_get_all_by_filters(context, filters, sort_key, sort_dir,
                               filters)
 
     # paginate query
-    # if marker is not None:
-    #     try:
-    #         marker = _instance_get_by_uuid(context, marker, session=session)
-    #     except exception.InstanceNotFound:
-    #         raise exception.MarkerNotFound(marker)
-    # TODO: following cannot yet work with the RIAK DB implementation!
-    # query_prefix = sqlalchemyutils.paginate_query(query_prefix,
-    #                        models.Instance, limit,
-    #                        [sort_key, 'created_at', 'id'],
-    #                        marker=marker,
-    #                        sort_dir=sort_dir)
+    if marker is not None:
+        try:
+            marker = _instance_get_by_uuid(context, marker, session=session)
+        except exception.InstanceNotFound:
+            raise exception.MarkerNotFound(marker)
+    query_prefix = paginate_query(query_prefix,
+                           models.Instance, limit,
+                           [sort_key, 'created_at', 'id'],
+                           marker=marker,
+                           sort_dir=sort_dir)
     # print("filters: %s" % (filters))
     # query_prefix = RiakModelQuery(models.Instance).filter_dict(filters_)
     # query_prefix = RiakModelQuery(models.Instance)
@@ -3468,12 +3535,15 @@ def quota_reserve(context, resources, project_quotas, user_quotas, deltas,
                   user_id=None):
     elevated = context.elevated()
     session = get_session()
-    with session.begin():
 
-        if project_id is None:
-            project_id = context.project_id
-        if user_id is None:
-            user_id = context.user_id
+    if project_id is None:
+        project_id = context.project_id
+    if user_id is None:
+        user_id = context.user_id
+
+    # Riak offers no transaction: the usages of the project are read and
+    # updated while holding the guard of the project.
+    with guards.guarded(guards.project_guard_name(project_id)):
 
         # Get the current usages
         project_usages, user_usages = _get_project_user_quota_usages(
@@ -3599,7 +3669,7 @@ def _quota_reservations_query(session, context, reservations):
 @_retry_on_deadlock
 def reservation_commit(context, reservations, project_id=None, user_id=None):
     session = get_session()
-    with session.begin():
+    with guards.guarded(guards.project_guard_name(project_id)):
         _project_usages, user_usages = _get_project_user_quota_usages(
                 context, session, project_id, user_id)
         reservation_query = _quota_reservations_query(session, context,
@@ -3611,12 +3681,16 @@ def reservation_commit(context, reservations, project_id=None, user_id=None):
             usage.in_use += reservation.delta
         reservation_query.soft_delete(synchronize_session=False)
 
+        # Objects are not flushed by the session: updated usages are saved.
+        for usage_ref in user_usages.values():
+            session.add(usage_ref)
+
 
 @require_context
 @_retry_on_deadlock
 def reservation_rollback(context, reservations, project_id=None, user_id=None):
     session = get_session()
-    with session.begin():
+    with guards.guarded(guards.project_guard_name(project_id)):
         _project_usages, user_usages = _get_project_user_quota_usages(
                 context, session, project_id, user_id)
         reservation_query = _quota_reservations_query(session, context,
@@ -3627,6 +3701,10 @@ def reservation_rollback(context, reservations, project_id=None, user_id=None):
                 usage.reserved -= reservation.delta
         reservation_query.soft_delete(synchronize_session=False)
 
+        # Objects are not flushed by the session: updated usages are saved.
+        for usage_ref in user_usages.values():
+            session.add(usage_ref)
+
 
 @require_admin_context
 def quota_destroy_all_by_project_and_user(context, project_id, user_id):
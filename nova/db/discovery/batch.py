@@ -0,0 +1,212 @@
+"""Batch module.
+
+This module contains the write batches of the discovery database backend.
+Saving an object writes every object of its simplified graph (e.g. an
+instance with its info cache, its metadata and its security groups): a batch
+collects these writes, and executes them with as few sequential round trips
+as possible:
+
+- the versions of the objects that are not known are fetched with a single
+  multiget request per table;
+- objects are stored concurrently, by a bounded pool of green threads;
+- the key index, the counters and the stamps of each table are updated once
+  per batch, after the objects of the table have been stored.
+
+A write that fails does not stop the others: the batch is flushed, and the
+first failure is then raised again.
+
+"""
+
+import sys
+
+import eventlet
+from oslo.config import cfg
+import six
+
+from nova.db.discovery import aggregates
+from nova.db.discovery import client
+from nova.db.discovery.client import get_client
+from nova.db.discovery import codec
+from nova.db.discovery.indexes import add_indexes
+from nova.db.discovery.indexes import clear_indexes
+from nova.db.discovery import key_index
+from nova.db.discovery import table_cache
+from nova.db.discovery import versions
+from nova.openstack.common import log as logging
+
+batch_opts = [
+    cfg.IntOpt('write_concurrency',
+               default=8,
+               help='Number of objects of a write batch that are stored '
+                    'concurrently'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(batch_opts, group='discovery')
+
+LOG = logging.getLogger(__name__)
+
+
+def load_versions(tablename, keys):
+    """Returns the last versions of the given objects of a table, as a dict
+    key -> (vclock, stored value). Versions that are not known are fetched
+    with a multiget request (the value of an object that does not exist is
+    None)."""
+
+    result = {}
+    missing_keys = []
+    for key in keys:
+        version = versions.VERSION_CACHE.lookup(tablename, key)
+        if version is None:
+            missing_keys += [key]
+        else:
+            result[key] = version
+
+    if len(missing_keys) > 0:
+        object_bucket = versions.get_object_bucket(get_client(), tablename)
+        for fetched in object_bucket.multiget(["%d" % (key)
+                                               for key in missing_keys]):
+            if isinstance(fetched, tuple):
+                """The fetch failed: the object is read again when it is
+                written."""
+                continue
+            versions.remember_object(tablename, fetched)
+            result[int(fetched.key)] = (fetched.vclock, fetched.data)
+
+    for key in missing_keys:
+        if not key in result:
+            stored = versions.get_object_bucket(get_client(), tablename).\
+                get("%d" % (key))
+            versions.remember_object(tablename, stored)
+            result[key] = (stored.vclock, stored.data)
+    return result
+
+
+class PendingWrite(object):
+    """A write of an object, waiting for its batch to be flushed."""
+
+    __slots__ = ["tablename", "key", "vclock", "previous_value", "value",
+                 "model_class", "deleted", "stored", "error"]
+
+    def __init__(self, tablename, key, vclock, previous_value, value,
+                 model_class, deleted=False):
+        """Constructor"""
+
+        self.tablename = tablename
+        self.key = key
+        self.vclock = vclock
+        self.previous_value = previous_value
+        self.value = value
+        self.model_class = model_class
+        self.deleted = deleted
+        self.stored = False
+        """The exc_info of the failure of the write, if it failed"""
+        self.error = None
+
+
+class WriteBatch(object):
+    """Class that collects the writes of objects, and executes them when it
+    is flushed."""
+
+    def __init__(self, concurrency=None):
+        """Constructor"""
+
+        self.concurrency = concurrency
+        self.writes = []
+
+    def add(self, tablename, key, vclock, previous_value, value,
+            model_class, deleted=False):
+        """Add the write of an object to the batch.
+        :param vclock: the vector clock of the version that is replaced
+        :param previous_value: the value of this version (None if the object
+        is created)
+        :param deleted: True if the object is soft deleted: it is removed
+        from the secondary indexes, the key index and the counters
+        """
+
+        self.writes += [PendingWrite(tablename, key, vclock, previous_value,
+                                     value, model_class, deleted)]
+
+    def store(self, write, operation_counter=None):
+        """Store the object of a pending write: a failure is logged and
+        recorded in the write.
+        :param operation_counter: the counter of the Riak operations of the
+        thread that flushes the batch, when the write is executed by another
+        greenthread
+        """
+
+        if operation_counter is not None:
+            client.use_operation_counter(operation_counter)
+        try:
+            object_bucket = versions.get_object_bucket(get_client(),
+                                                       write.tablename)
+            fetched = object_bucket.new(
+                "%d" % (write.key),
+                data=write.value,
+                content_type=codec.get_content_type()
+            )
+            """Writing with the vector clock of the known version tells
+            Riak which version is replaced: a concurrent write creates
+            siblings instead of being silently overwritten."""
+            fetched.vclock = write.vclock
+            if write.deleted:
+                clear_indexes(fetched, write.value)
+            else:
+                add_indexes(fetched, write.model_class, write.value)
+            versions.store_object(fetched)
+            versions.remember_object(write.tablename, fetched)
+            write.stored = True
+        except Exception:
+            write.error = sys.exc_info()
+            LOG.exception("failed to store %s %s", write.tablename,
+                          write.key)
+            versions.VERSION_CACHE.forget(write.tablename, write.key)
+        return write
+
+    def flush(self):
+        """Execute the writes of the batch. Returns the list of the writes
+        whose object has been stored. If writes failed, the first failure is
+        raised again once every write has been executed, and the writes that
+        succeeded have been indexed."""
+
+        writes = self.writes
+        self.writes = []
+        if len(writes) == 0:
+            return []
+
+        concurrency = self.concurrency or CONF.discovery.write_concurrency
+        if len(writes) == 1 or concurrency <= 1:
+            stored = [self.store(write) for write in writes]
+        else:
+            """The operations of the writes are counted for the caller."""
+            operation_counter = client.get_operation_counter()
+            pool = eventlet.GreenPool(min(concurrency, len(writes)))
+            stored = list(pool.imap(
+                lambda write: self.store(write, operation_counter), writes))
+        failed = [write for write in stored if write.error is not None]
+        stored = [write for write in stored if write.stored]
+
+        """The key index, the counters and the stamp of a table are updated
+        after its objects have been stored."""
+        tablenames = []
+        for write in stored:
+            if not write.tablename in tablenames:
+                tablenames += [write.tablename]
+        for tablename in tablenames:
+            table_writes = [x for x in stored if x.tablename == tablename]
+            aggregates.update_table_counters(
+                tablename,
+                [(x.previous_value, None if x.deleted else x.value)
+                 for x in table_writes]
+            )
+            key_index.update_keys(
+                tablename,
+                added=[x.key for x in table_writes
+                       if x.previous_value is None and not x.deleted],
+                removed=[x.key for x in table_writes if x.deleted]
+            )
+            table_cache.bump_stamp(tablename)
+
+        if len(failed) > 0:
+            six.reraise(*failed[0].error)
+        return stored
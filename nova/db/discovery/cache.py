@@ -0,0 +1,173 @@
+"""Cache module.
+
+This module contains the manager of the request-scoped caches used by the
+discovery database backend (simplifier, desimplifier and lazy references
+caches). Each database request uses its own caches, identified by a request
+uuid: a manager keeps the caches of the most recently used requests, and
+evicts the caches of requests that have not been used for a while, so that
+the memory used by a long-running service stays bounded.
+
+"""
+
+import collections
+import contextlib
+import threading
+import time
+import uuid
+
+"""Maximum number of requests whose caches are kept by a manager."""
+MAX_REQUEST_CACHES = 1000
+
+"""Number of seconds after which the caches of an unused request are
+evicted."""
+REQUEST_CACHE_TTL = 300
+
+CACHE_MANAGERS = []
+
+
+class RequestCacheManager(object):
+    """Class that keeps request-scoped caches in a LRU: the caches of the
+    least recently used requests are evicted when the manager is full, or
+    when they have not been used during ttl seconds."""
+
+    def __init__(self, name, max_size=MAX_REQUEST_CACHES,
+                 ttl=REQUEST_CACHE_TTL, factory=dict):
+        """Constructor"""
+
+        self.name = name
+        self.factory = factory
+        self.max_size = max_size
+        self.ttl = ttl
+
+        """request_uuid -> [cache, expiration_time, stamp]"""
+        self.entries = {}
+        """(request_uuid, stamp) pairs, the least recently used first: pairs
+        whose stamp is not the current stamp of their entry are stale."""
+        self.order = collections.deque()
+        self.stamp = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        CACHE_MANAGERS.append(self)
+
+    def touch(self, request_uuid, entry, now):
+        """Mark the given entry as the most recently used one."""
+
+        self.stamp += 1
+        entry[1] = now + self.ttl
+        entry[2] = self.stamp
+        self.order.append((request_uuid, self.stamp))
+
+        if len(self.order) > 2 * len(self.entries) + 16:
+            """Drop stale pairs."""
+            self.order = collections.deque(sorted(
+                [(key, value[2]) for (key, value) in self.entries.items()],
+                key=lambda pair: pair[1]
+            ))
+
+    def evict(self, now):
+        """Evict the caches of expired requests, and the caches of the least
+        recently used requests while the manager is full."""
+
+        while len(self.order) > 0:
+            (request_uuid, stamp) = self.order[0]
+            entry = self.entries.get(request_uuid)
+            if entry is None or entry[2] != stamp:
+                self.order.popleft()
+                continue
+            if len(self.entries) > self.max_size or entry[1] <= now:
+                self.order.popleft()
+                del self.entries[request_uuid]
+                self.evictions += 1
+                continue
+            break
+
+    def get(self, request_uuid):
+        """Returns the cache of the given request, creating it (with the
+        factory of the manager) if needed."""
+
+        with self.lock:
+            now = time.time()
+            entry = self.entries.get(request_uuid)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry = [self.factory(), now, 0]
+                self.entries[request_uuid] = entry
+            self.touch(request_uuid, entry, now)
+            self.evict(now)
+            return entry[0]
+
+    def reset(self, request_uuid):
+        """Replace the cache of the given request by an empty cache, and
+        returns it."""
+
+        with self.lock:
+            now = time.time()
+            entry = [self.factory(), now, 0]
+            self.entries[request_uuid] = entry
+            self.touch(request_uuid, entry, now)
+            self.evict(now)
+            return entry[0]
+
+    def release(self, request_uuid):
+        """Forget the cache of the given request."""
+
+        with self.lock:
+            self.entries.pop(request_uuid, None)
+
+    def clear(self):
+        """Forget every cache."""
+
+        with self.lock:
+            self.entries = {}
+            self.order = collections.deque()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, request_uuid):
+        return request_uuid in self.entries
+
+    def stats(self):
+        """Returns the statistics of the manager."""
+
+        return {
+            "name": self.name,
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+def get_cache_stats():
+    """Returns the statistics of every cache manager."""
+
+    return [manager.stats() for manager in CACHE_MANAGERS]
+
+
+def release_request(request_uuid, managers=None):
+    """Forget the caches of the given request in the given managers (every
+    manager by default)."""
+
+    for manager in (managers if managers is not None else CACHE_MANAGERS):
+        manager.release(request_uuid)
+
+
+@contextlib.contextmanager
+def request_scope(request_uuid=None, managers=None):
+    """Context manager that yields a request uuid, and forgets the caches of
+    this request when the block is left."""
+
+    if request_uuid is None:
+        request_uuid = uuid.uuid1()
+    try:
+        yield request_uuid
+    finally:
+        release_request(request_uuid, managers)
@@ -0,0 +1,257 @@
+"""Client module.
+
+This module contains the factory of the Riak client shared by the modules of
+the discovery database backend. The nodes of the Riak cluster, the size of the
+pool of workers used by multiget requests, the timeout of operations and their
+default quorums (R, PR, W, DW, PW) are read from the [discovery] section of
+the configuration. For tests and benchmarks, the client can also be backed by
+a storage that stands in for the cluster (see the storage module).
+
+A single client is created per process: its pool of connections opens a
+connection for each concurrent request (greenthreads of a service do not wait
+for each other on a single socket), and a forked process creates its own
+client instead of sharing the sockets of its parent. Connections are guarded
+by the locks of the threading module, which are green locks once eventlet has
+patched the process.
+
+"""
+
+import os
+import threading
+
+from oslo.config import cfg
+import riak
+
+riak_opts = [
+    cfg.ListOpt('nodes',
+                default=['127.0.0.1:8087'],
+                help='Nodes of the Riak cluster, as a list of host:port '
+                     '(protocol buffers port)'),
+    cfg.StrOpt('protocol',
+               default='pbc',
+               help='Protocol used to communicate with Riak: "pbc" or '
+                    '"http"'),
+    cfg.IntOpt('pool_size',
+               default=None,
+               help='Number of workers that fetch the keys of a multiget '
+                    'request in parallel (default: a factor of the number '
+                    'of CPUs)'),
+    cfg.IntOpt('timeout',
+               default=None,
+               help='Timeout of Riak operations, in milliseconds'),
+    cfg.StrOpt('r',
+               default=None,
+               help='Default R quorum of reads'),
+    cfg.StrOpt('pr',
+               default=None,
+               help='Default PR quorum of reads'),
+    cfg.StrOpt('w',
+               default=None,
+               help='Default W quorum of writes'),
+    cfg.StrOpt('dw',
+               default=None,
+               help='Default DW quorum of writes'),
+    cfg.StrOpt('pw',
+               default=None,
+               help='Default PW quorum of writes'),
+    cfg.StrOpt('storage',
+               default='riak',
+               help='Storage of the objects: "riak" (a Riak cluster), '
+                    '"memory" (the memory of the process) or "sqlite" (a '
+                    'sqlite database, see storage_path); storages other '
+                    'than Riak are meant for tests and benchmarks'),
+    cfg.StrOpt('storage_path',
+               default=None,
+               help='Path of the sqlite database used by the "sqlite" '
+                    'storage'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(riak_opts, group='discovery')
+
+DEFAULT_PB_PORT = 8087
+
+
+def parse_quorum(value):
+    """Quorums are either integers or symbolic values ("one", "quorum",
+    "all", "default")."""
+
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def parse_node(node):
+    """Convert a "host:port" string into the configuration of a Riak
+    node."""
+
+    if ":" in node:
+        (host, port) = node.rsplit(":", 1)
+        return {"host": host, "pb_port": int(port)}
+    return {"host": node, "pb_port": DEFAULT_PB_PORT}
+
+
+def set_default_options(params, defaults):
+    """Set the options of an operation that were not given by the caller
+    to their configured default values."""
+
+    for (key, value) in defaults.items():
+        if params.get(key) is None and value is not None:
+            params[key] = value
+    return params
+
+
+"""Counter of the Riak operations issued by each thread (or greenthread,
+once eventlet has patched the process): greenthreads that issue operations
+on behalf of another thread share its counter (see use_operation_counter)."""
+OPERATIONS = threading.local()
+
+
+def get_operation_counter():
+    """Returns the counter of the operations of the current thread: a list
+    that holds the number of operations."""
+
+    counter = getattr(OPERATIONS, "counter", None)
+    if counter is None:
+        counter = OPERATIONS.counter = [0]
+    return counter
+
+
+def use_operation_counter(counter):
+    """Count the operations of the current thread with the given counter,
+    which is the counter of the thread it works for."""
+
+    OPERATIONS.counter = counter
+
+
+def count_operations(count=1):
+    """Count Riak operations issued by the current thread."""
+
+    get_operation_counter()[0] += count
+
+
+def get_operation_count():
+    """Returns the number of Riak operations issued by the current
+    thread."""
+
+    return get_operation_counter()[0]
+
+
+class DiscoveryRiakClient(riak.RiakClient):
+    """Riak client that applies the configured timeout and quorums to the
+    operations whose caller does not specify them, and counts the operations
+    of each thread."""
+
+    def __init__(self, read_options=None, write_options=None,
+                 timeout=None, **kwargs):
+        """Constructor"""
+
+        super(DiscoveryRiakClient, self).__init__(**kwargs)
+        self.read_options = dict(read_options or {}, timeout=timeout)
+        self.write_options = dict(write_options or {}, timeout=timeout)
+        self.timeout = timeout
+
+    def get(self, robj, **params):
+        count_operations()
+        set_default_options(params, self.read_options)
+        return super(DiscoveryRiakClient, self).get(robj, **params)
+
+    def put(self, robj, **params):
+        count_operations()
+        set_default_options(params, self.write_options)
+        return super(DiscoveryRiakClient, self).put(robj, **params)
+
+    def delete(self, robj, **params):
+        count_operations()
+        set_default_options(params, self.write_options)
+        return super(DiscoveryRiakClient, self).delete(robj, **params)
+
+    def get_index(self, bucket, index, startkey, endkey=None, **params):
+        count_operations()
+        set_default_options(params, {"timeout": self.timeout})
+        return super(DiscoveryRiakClient, self).get_index(
+            bucket, index, startkey, endkey, **params
+        )
+
+    def multiget(self, pairs, **params):
+        """The fetches of a multiget are issued by the workers of its pool:
+        they are counted for the calling thread."""
+
+        count_operations(len(pairs))
+        return super(DiscoveryRiakClient, self).multiget(pairs, **params)
+
+    def get_counter(self, bucket, key, **params):
+        count_operations()
+        return super(DiscoveryRiakClient, self).get_counter(bucket, key,
+                                                            **params)
+
+    def update_counter(self, bucket, key, value, **params):
+        count_operations()
+        return super(DiscoveryRiakClient, self).update_counter(bucket, key,
+                                                               value,
+                                                               **params)
+
+
+def create_client():
+    """Create a Riak client configured with the [discovery] options, whose
+    codecs and resolvers are registered."""
+
+    from nova.db.discovery import codec
+    from nova.db.discovery import versions
+
+    options = CONF.discovery
+    client_class = DiscoveryRiakClient
+    client_options = {}
+    if options.storage != "riak":
+        from nova.db.discovery import storage
+        client_class = storage.StorageRiakClient
+        client_options["storage"] = storage.get_storage(options.storage,
+                                                        options.storage_path)
+    client = client_class(
+        protocol=options.protocol,
+        nodes=[parse_node(node) for node in options.nodes],
+        multiget_pool_size=options.pool_size,
+        timeout=options.timeout,
+        read_options={"r": parse_quorum(options.r),
+                      "pr": parse_quorum(options.pr)},
+        write_options={"w": parse_quorum(options.w),
+                       "dw": parse_quorum(options.dw),
+                       "pw": parse_quorum(options.pw)},
+        **client_options
+    )
+    codec.register_codecs(client)
+    versions.register_resolver(client)
+    return client
+
+
+"""pid -> client"""
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+def get_client():
+    """Returns the Riak client of the current process."""
+
+    pid = os.getpid()
+    client = CLIENTS.get(pid)
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(pid)
+            if client is None:
+                client = create_client()
+                """Clients inherited from a parent process are dropped."""
+                CLIENTS.clear()
+                CLIENTS[pid] = client
+    return client
+
+
+def reset_client():
+    """Forget the client of the current process: the next call to
+    get_client creates a new client (e.g. after the configuration has
+    changed)."""
+
+    with CLIENTS_LOCK:
+        CLIENTS.clear()
@@ -0,0 +1,253 @@
+"""Codec module.
+
+This module contains the codecs used to encode the simplified objects stored
+by the discovery database backend. The "json" codec stores simplified objects
+as they are (verbose JSON documents). The "compact" codec stores them as
+positional lists: the fields of a model are described once by a schema (whose
+identifier is stored with each object), nested simplified values (datetimes,
+references to other objects, ...) are converted into short tagged lists, and
+metadata that can be computed from the schema is not stored. The compact
+encoding uses msgpack when it is available, and compact JSON otherwise.
+
+The content type of each Riak object tells which codec encoded it: values
+written with any codec (including values written before codecs existed) can
+thus always be read.
+
+"""
+
+import json
+import threading
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from nova.db.discovery.client import get_client
+
+JSON_CONTENT_TYPE = "application/json"
+COMPACT_MSGPACK_CONTENT_TYPE = "application/x-discovery-compact+msgpack"
+COMPACT_JSON_CONTENT_TYPE = "application/x-discovery-compact+json"
+
+"""Version of the compact format, stored in front of each compact value."""
+COMPACT_FORMAT_VERSION = 1
+
+SCHEMAS_BUCKET = "schemas"
+
+"""Codec used to write objects: "json" or "compact"."""
+DEFAULT_CODEC = "compact"
+
+"""Keys of simplified objects that are not stored by the compact codec: the
+classname metadata is computed from the schema, and the memory address and
+request uuid of the object are meaningless once stored."""
+COMPUTED_KEYS = ["metadata_novabase_classname", "nova_classname", "pid",
+                 "rid"]
+
+DATETIME_TAG = "~d"
+NOVABASE_TAG = "~n"
+IPNETWORK_TAG = "~i"
+LIST_TAG = "~l"
+
+
+class SchemaRegistry(object):
+    """Class that associates schema identifiers to the ordered list of
+    fields of a model. Schemas are stored in Riak, so that a value encoded
+    with an older version of a model can still be decoded."""
+
+    def __init__(self):
+        """Constructor"""
+
+        self.schemas = {}
+        self.model_schema_ids = {}
+        self.lock = threading.Lock()
+
+    def get_schema_id(self, tablename, fields):
+        """Returns the identifier of the schema made of the given fields of
+        a table, storing the schema if it is not known yet."""
+
+        key = (tablename, tuple(fields))
+        if key in self.model_schema_ids:
+            return self.model_schema_ids[key]
+
+        checksum = zlib.crc32(",".join(fields)) & 0xffffffff
+        schema_id = "%s-%08x" % (tablename, checksum)
+        with self.lock:
+            if not schema_id in self.schemas:
+                schemas_bucket = get_client().bucket(SCHEMAS_BUCKET)
+                stored_schema = schemas_bucket.get(schema_id)
+                if stored_schema.data is None:
+                    stored_schema.data = {"tablename": tablename,
+                                          "fields": list(fields)}
+                    stored_schema.store()
+                self.schemas[schema_id] = (tablename, list(fields))
+            self.model_schema_ids[key] = schema_id
+        return schema_id
+
+    def get_schema(self, schema_id):
+        """Returns a tuple (tablename, fields) describing the given schema."""
+
+        if not schema_id in self.schemas:
+            stored_schema = get_client().bucket(SCHEMAS_BUCKET).get(schema_id)
+            if stored_schema.data is None:
+                raise KeyError("unknown schema %s" % (schema_id))
+            self.schemas[schema_id] = (stored_schema.data["tablename"],
+                                       stored_schema.data["fields"])
+        return self.schemas[schema_id]
+
+
+SCHEMA_REGISTRY = SchemaRegistry()
+
+
+def get_model_fields(tablename):
+    """Returns the sorted names of the fields of the model of a table."""
+
+    from nova.db.discovery import models
+
+    classname = models.get_model_classname_from_tablename(tablename)
+    model = models.get_model_class_from_name(classname)
+    return sorted(model._sa_class_manager.keys())
+
+
+def encode_value(value):
+    """Convert a simplified value into its compact form."""
+
+    if isinstance(value, dict):
+        strategy = value.get("simplify_strategy")
+        if strategy == "datetime" and "epoch" in value:
+            return [DATETIME_TAG, value["epoch"], value["timezone"]]
+        if strategy == "novabase":
+            return [NOVABASE_TAG, value["tablename"],
+                    value["novabase_classname"], value["id"]]
+        if strategy == "ipnetwork":
+            return [IPNETWORK_TAG, value["value"]]
+        return dict((key, encode_value(value[key])) for key in value)
+    if isinstance(value, (list, tuple)):
+        result = [encode_value(item) for item in value]
+        if len(result) > 0 and isinstance(result[0], basestring) and \
+                result[0].startswith("~"):
+            """Protect lists that could be mistaken for tagged values."""
+            result = [LIST_TAG] + result
+        return result
+    return value
+
+
+def decode_value(value):
+    """Convert a compact value into its simplified form."""
+
+    if isinstance(value, dict):
+        return dict((key, decode_value(value[key])) for key in value)
+    if isinstance(value, (list, tuple)):
+        if len(value) > 0 and isinstance(value[0], basestring):
+            tag = value[0]
+            if tag == DATETIME_TAG:
+                return {"simplify_strategy": "datetime", "epoch": value[1],
+                        "timezone": value[2]}
+            if tag == NOVABASE_TAG:
+                return {"simplify_strategy": "novabase",
+                        "tablename": value[1],
+                        "novabase_classname": value[2], "id": value[3]}
+            if tag == IPNETWORK_TAG:
+                return {"simplify_strategy": "ipnetwork", "value": value[1]}
+            if tag == LIST_TAG:
+                return [decode_value(item) for item in value[1:]]
+        return [decode_value(item) for item in value]
+    return value
+
+
+def to_compact(data):
+    """Convert a simplified object into its compact form: [version,
+    schema_id, positional values, extra values]."""
+
+    tablename = None
+    if isinstance(data, dict):
+        tablename = data.get("nova_classname")
+    if tablename is None:
+        """Not a stored object: only nested values are compacted."""
+        return [COMPACT_FORMAT_VERSION, None, [], encode_value(data)]
+
+    fields = get_model_fields(tablename)
+    schema_id = SCHEMA_REGISTRY.get_schema_id(tablename, fields)
+
+    values = [encode_value(data.get(field)) for field in fields]
+    extra_values = {}
+    for key in data:
+        if not key in COMPUTED_KEYS and not key in fields:
+            extra_values[key] = encode_value(data[key])
+
+    return [COMPACT_FORMAT_VERSION, schema_id, values, extra_values]
+
+
+def from_compact(compact):
+    """Convert a compact object back into its simplified form."""
+
+    version = compact[0]
+    if version != COMPACT_FORMAT_VERSION:
+        raise ValueError("unsupported compact format version %s" % (version))
+
+    schema_id = compact[1]
+    if schema_id is None:
+        return decode_value(compact[3])
+
+    from nova.db.discovery import models
+
+    (tablename, fields) = SCHEMA_REGISTRY.get_schema(schema_id)
+    result = dict(zip(fields, [decode_value(x) for x in compact[2]]))
+    for key in compact[3]:
+        result[key] = decode_value(compact[3][key])
+
+    result["nova_classname"] = tablename
+    result["metadata_novabase_classname"] = \
+        models.get_model_classname_from_tablename(tablename)
+    return result
+
+
+def encode_compact_msgpack(data):
+    return msgpack.packb(to_compact(data), use_bin_type=True)
+
+
+def decode_compact_msgpack(value):
+    try:
+        compact = msgpack.unpackb(value, raw=False)
+    except TypeError:
+        """Older versions of msgpack do not know the "raw" parameter."""
+        compact = msgpack.unpackb(value, encoding="utf-8")
+    return from_compact(compact)
+
+
+def encode_compact_json(data):
+    return json.dumps(to_compact(data), separators=(",", ":"))
+
+
+def decode_compact_json(value):
+    return from_compact(json.loads(value))
+
+
+def get_content_type(codec_name=None):
+    """Returns the content type used to write objects with the given codec
+    (the default codec if None)."""
+
+    if codec_name is None:
+        codec_name = DEFAULT_CODEC
+    if codec_name == "json":
+        return JSON_CONTENT_TYPE
+    if codec_name == "compact":
+        if msgpack is not None:
+            return COMPACT_MSGPACK_CONTENT_TYPE
+        return COMPACT_JSON_CONTENT_TYPE
+    raise ValueError("unknown codec %s" % (codec_name))
+
+
+def register_codecs(client):
+    """Register the encoders and decoders of the compact codec on the given
+    Riak client."""
+
+    client.set_encoder(COMPACT_JSON_CONTENT_TYPE, encode_compact_json)
+    client.set_decoder(COMPACT_JSON_CONTENT_TYPE, decode_compact_json)
+    if msgpack is not None:
+        client.set_encoder(COMPACT_MSGPACK_CONTENT_TYPE,
+                           encode_compact_msgpack)
+        client.set_decoder(COMPACT_MSGPACK_CONTENT_TYPE,
+                           decode_compact_msgpack)
+    return client
+
@@ -11,8 +11,9 @@ import uuid
 import pytz
 import nova.db.discovery.models
 import nova.db.discovery.lazy_reference
+from nova.db.discovery.cache import RequestCacheManager
 
-CACHES = {}
+CACHES = RequestCacheManager("desimplifier")
 
 def convert_to_camelcase(word):
     """Convert the given word into camelcase naming convention."""
@@ -23,15 +24,13 @@ class ObjectDesimplifier(object):
     into an object containing values understandable by services composing
     Nova."""
 
-    def __init__(self, request_uuid=uuid.uuid1()):
+    def __init__(self, request_uuid=None):
         """Constructor"""
 
         self.request_uuid = (request_uuid if request_uuid is not None
             else uuid.uuid1()
         )
-        if not CACHES.has_key(self.request_uuid):
-            CACHES[self.request_uuid] = {}
-        self.cache = CACHES[self.request_uuid]
+        self.cache = CACHES.get(self.request_uuid)
 
     def is_dict_and_has_key(self, obj, key):
         """Check if the given object is a dict which contains the given key."""
@@ -81,7 +80,11 @@ class ObjectDesimplifier(object):
     def datetime_desimplify(self, value):
         """Desimplify a datetime object."""
 
-        result = datetime.datetime.strptime(value["value"], '%b %d %Y %H:%M:%S')
+        if "epoch" in value:
+            result = datetime.datetime.utcfromtimestamp(value["epoch"])
+        else:
+            result = datetime.datetime.strptime(value["value"],
+                                                '%b %d %Y %H:%M:%S')
         if value["timezone"] == "UTC":
             result = pytz.utc.localize(result)
         return result
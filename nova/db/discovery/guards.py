@@ -0,0 +1,175 @@
+"""Guards module.
+
+This module contains the guards that serialize the read-modify-write
+operations of the discovery database backend on a group of objects (e.g. the
+quota usages of a project), which cannot rely on the transactions and row
+locks of a SQL database.
+
+A guard is a Riak object that records the current owner of the group and the
+expiration of its lease. It is acquired with a compare-and-set: the guard is
+read, and if it is free (or its lease has expired) it is written with the
+vector clock that was read. If another process wrote the guard concurrently,
+Riak keeps both writes as siblings: the write that created the siblings has
+lost, and its owner withdraws it before retrying. Attempts are retried a
+bounded number of times, after a random delay that grows with each attempt.
+
+Guards only serialize the processes that use the same group: there is no
+global lock.
+
+"""
+
+import contextlib
+import random
+import time
+import uuid
+
+from oslo.db import exception as db_exc
+
+from nova.db.discovery.client import get_client
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+GUARDS_BUCKET = "guards"
+
+"""Number of seconds after which a guard that has not been released is
+considered free (e.g. its owner has crashed)."""
+LEASE_DURATION = 60
+
+"""Number of attempts to acquire a guard before giving up."""
+MAX_ATTEMPTS = 30
+
+"""Bounds of the delay between two attempts, in seconds: the delay is a
+random value up to BASE_DELAY * 2^attempt, capped to MAX_DELAY."""
+BASE_DELAY = 0.005
+MAX_DELAY = 0.5
+
+
+def keep_siblings(riak_object):
+    """Resolver of the guards bucket: siblings are kept, as they tell that a
+    guard was written concurrently."""
+
+    pass
+
+
+CONFIGURED_BUCKETS = set()
+
+def get_guards_bucket():
+    """Returns the bucket that contains the guards: siblings must be allowed
+    on this bucket, and not resolved when guards are read."""
+
+    guards_bucket = get_client().bucket(GUARDS_BUCKET)
+    if not GUARDS_BUCKET in CONFIGURED_BUCKETS:
+        guards_bucket.allow_mult = True
+        CONFIGURED_BUCKETS.add(GUARDS_BUCKET)
+    guards_bucket.resolver = keep_siblings
+    return guards_bucket
+
+
+def is_held(value, now):
+    """Check if the given value of a guard is an unexpired lease."""
+
+    return isinstance(value, dict) and value.get("owner") is not None and \
+        value.get("expires", 0) > now
+
+
+def get_backoff_delay(attempt):
+    """Returns the random delay to wait before the given attempt."""
+
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * (2 ** attempt)))
+
+
+class Guard(object):
+    """Class that acquires and releases the guard of a group of objects."""
+
+    def __init__(self, name, lease_duration=LEASE_DURATION,
+                 max_attempts=MAX_ATTEMPTS):
+        """Constructor"""
+
+        self.name = name
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        self.token = uuid.uuid4().hex
+        self.attempts = 0
+
+    def try_acquire(self):
+        """Try to acquire the guard once. Returns True if the guard has been
+        acquired."""
+
+        guards_bucket = get_guards_bucket()
+        guard = guards_bucket.get(self.name)
+        now = time.time()
+        if any(is_held(x.data, now) for x in guard.siblings):
+            return False
+
+        """The guard is free: its value is replaced, with a vector clock
+        that descends from every sibling that was read."""
+        guard.siblings = guard.siblings[:1]
+        guard.data = {"owner": self.token,
+                      "expires": now + self.lease_duration}
+        guard.store()
+        if len(guard.siblings) < 2:
+            return True
+
+        """The guard was written concurrently: the write that created
+        siblings lost, and is withdrawn."""
+        others = [x for x in guard.siblings
+                  if not (isinstance(x.data, dict) and
+                          x.data.get("owner") == self.token)]
+        guard.siblings = guard.siblings[:1]
+        if len(others) > 0:
+            guard.data = others[0].data
+        else:
+            guard.data = {"owner": None, "expires": 0}
+        guard.store()
+        return False
+
+    def acquire(self):
+        """Acquire the guard, waiting for it if it is held. Raises DBDeadlock
+        if the guard could not be acquired after max_attempts attempts."""
+
+        for attempt in range(self.max_attempts):
+            self.attempts = attempt + 1
+            if self.try_acquire():
+                return
+            time.sleep(get_backoff_delay(attempt))
+        raise db_exc.DBDeadlock("could not acquire guard %s" % (self.name))
+
+    def release(self):
+        """Release the guard, if it is still owned."""
+
+        guards_bucket = get_guards_bucket()
+        guard = guards_bucket.get(self.name)
+        siblings = [x for x in guard.siblings
+                    if not (isinstance(x.data, dict) and
+                            x.data.get("owner") == self.token)]
+        if len(siblings) == len(guard.siblings):
+            """The lease has expired, and the guard has been taken."""
+            LOG.warning("guard %s was lost before being released" %
+                        (self.name))
+            return
+        guard.siblings = guard.siblings[:1]
+        if len(siblings) > 0:
+            guard.data = siblings[0].data
+        else:
+            guard.data = {"owner": None, "expires": 0}
+        guard.store()
+
+
+@contextlib.contextmanager
+def guarded(name, **kwargs):
+    """Context manager that holds the guard of the given name while its
+    block is executed."""
+
+    guard = Guard(name, **kwargs)
+    guard.acquire()
+    try:
+        yield guard
+    finally:
+        guard.release()
+
+
+def project_guard_name(project_id):
+    """Returns the name of the guard of the quotas of a project."""
+
+    return "quotas:%s" % (project_id)
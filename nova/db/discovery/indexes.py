@@ -0,0 +1,362 @@
+"""Indexes module.
+
+This module contains functions that are used to maintain and query secondary
+indexes of the discovery database backend. A few columns (uuid, host, ...) are
+very often used in equality filters: their values are stored as Riak secondary
+index entries each time an object is written, so that a query filtering on one
+of them can fetch the matching keys instead of scanning the whole table.
+
+A few sort orders (by creation date, by id) are also stored as ordered
+indexes: the term of an object in such an index combines the values of the
+sorted columns, so that a range query on the index returns the keys of the
+table in this order, one page at a time. Each ordered index is stored twice,
+with opposite terms, as index ranges can only be read in ascending order.
+
+Soft deleted objects leave every index, but the one of their deletion time:
+objects deleted since a given time are found without reading every deleted
+object of their table.
+
+"""
+
+import calendar
+import datetime
+
+from sqlalchemy import Boolean
+from sqlalchemy import Integer
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import BindParameter
+
+from nova.db.discovery import key_index
+from nova.db.discovery.client import get_client
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+INDEXED_COLUMNS = ["uuid", "host", "project_id", "instance_uuid", "binary",
+                   "topic", "deleted"]
+
+"""Sort orders stored as ordered indexes: each of them is a sequence of
+columns."""
+ORDERED_INDEXES = [("created_at", "id"), ("id",)]
+
+"""Factor used to combine the values of several columns into a single term:
+every column but the first one must have values below this factor."""
+ORDER_TERM_FACTOR = 10 ** 10
+
+"""Upper bound of the terms of ordered indexes."""
+ORDER_TERM_MAX = 10 ** 30
+
+"""Index of the deletion time of soft deleted objects."""
+DELETED_AT_INDEX = "deleted_at_int"
+
+INDEX_STATUS_BUCKET = "index_status"
+
+"""Tables whose objects are known to carry their index entries."""
+INDEXED_TABLES = set()
+
+
+def get_indexed_columns(model):
+    """Returns the names of the columns of the given model that are
+    indexed."""
+
+    table = getattr(model, "__table__", None)
+    if table is None:
+        return []
+    return [name for name in INDEXED_COLUMNS if name in table.columns]
+
+
+def get_index_field(model, column_name):
+    """Returns the name of the Riak index field associated to the given
+    column: integer columns use an "_int" index, other columns a "_bin"
+    index."""
+
+    column_type = model.__table__.columns[column_name].type
+    if isinstance(column_type, (Integer, Boolean)):
+        return "%s_int" % (column_name)
+    return "%s_bin" % (column_name)
+
+
+def get_ordered_indexes(model):
+    """Returns the ordered indexes whose columns belong to the given
+    model."""
+
+    table = getattr(model, "__table__", None)
+    if table is None:
+        return []
+    return [columns for columns in ORDERED_INDEXES
+            if all(name in table.columns for name in columns)]
+
+
+def get_order_index_field(columns, descending):
+    """Returns the name of the Riak index field that stores the given sort
+    order."""
+
+    suffix = "_desc" if descending else ""
+    return "order_%s%s_int" % ("_".join(columns), suffix)
+
+
+def convert_order_value(value):
+    """Convert the value of a sorted column (a python value or a simplified
+    value) into an integer."""
+
+    if value is None:
+        return 0
+    if isinstance(value, dict):
+        if "epoch" in value:
+            return int(value["epoch"])
+        value = datetime.datetime.strptime(value["value"],
+                                           '%b %d %Y %H:%M:%S')
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    return int(value)
+
+
+def compute_order_term(columns, values, descending=False):
+    """Returns the term of an object in the ordered index of the given
+    columns, according to the values of these columns."""
+
+    term = 0
+    for value in values:
+        term = term * ORDER_TERM_FACTOR + convert_order_value(value)
+    return -term if descending else term
+
+
+def compute_start_term(columns, values, descending=False):
+    """Returns the lowest term, in the ordered index of the given columns, of
+    the objects whose first column has the same value as the given values:
+    terms only keep datetimes up to the second, so the objects that follow
+    the given values may have a lower term than these values.
+    """
+
+    width = ORDER_TERM_FACTOR ** (len(columns) - 1)
+    term = convert_order_value(values[0]) * width
+    return -(term + width - 1) if descending else term
+
+
+def find_ordered_index(model, order_by):
+    """Find an ordered index that returns the objects of the given model in
+    the given order.
+    :param order_by: a list of tuples (column_name, descending)
+    :return: a tuple (columns, descending), or None if no ordered index
+    matches the given order
+    """
+
+    if len(order_by) == 0:
+        return None
+    directions = set([descending for (_, descending) in order_by])
+    if len(directions) > 1:
+        return None
+    column_names = tuple([column_name for (column_name, _) in order_by])
+    for columns in get_ordered_indexes(model):
+        if columns[:len(column_names)] == column_names:
+            return (columns, directions.pop())
+    return None
+
+
+def iter_ordered_keys(model, columns, descending, start_term=None,
+                      page_size=100):
+    """Iterate over the keys of the objects of the given model, in the order
+    of the given ordered index. Keys are read page by page: each step fetches
+    a page of the index and yields the list of its keys.
+    :param start_term: the lowest term of the returned keys
+    """
+
+    object_bucket = get_client().bucket(model.__tablename__)
+    index_field = get_order_index_field(columns, descending)
+    if start_term is None:
+        start_term = -ORDER_TERM_MAX
+
+    continuation = None
+    while True:
+        page = object_bucket.get_index(index_field, start_term,
+                                       ORDER_TERM_MAX,
+                                       max_results=page_size,
+                                       continuation=continuation)
+        keys = [int(key) for key in page]
+        if len(keys) > 0:
+            yield keys
+        continuation = page.continuation
+        if continuation is None:
+            break
+
+
+def convert_index_value(index_field, value):
+    """Convert a python value into a value that can be stored in (or
+    searched in) the given index field. Returns None if the value cannot be
+    indexed."""
+
+    if value is None:
+        return None
+    if index_field.endswith("_int"):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return "%s" % (value)
+
+
+def add_indexes(riak_object, model, data):
+    """Set the index entries of the given Riak object, according to the values
+    contained in data (a simplified object)."""
+
+    riak_object.remove_index()
+    for column_name in get_indexed_columns(model):
+        index_field = get_index_field(model, column_name)
+        index_value = convert_index_value(index_field, data.get(column_name))
+        if index_value is not None:
+            riak_object.add_index(index_field, index_value)
+    for columns in get_ordered_indexes(model):
+        term = compute_order_term(columns, [data.get(x) for x in columns])
+        riak_object.add_index(get_order_index_field(columns, False), term)
+        riak_object.add_index(get_order_index_field(columns, True), -term)
+    return riak_object
+
+
+def clear_indexes(riak_object, data=None):
+    """Remove every index entry of the given Riak object: it will not be
+    returned anymore by index lookups. A soft deleted object keeps the entry
+    of its deletion time (see find_deleted_keys).
+    :param data: the simplified object (the data of the Riak object by
+    default)
+    """
+
+    if data is None:
+        data = riak_object.data
+    riak_object.remove_index()
+    if isinstance(data, dict) and data.get("deleted") and \
+            data.get("deleted_at") is not None:
+        riak_object.add_index(DELETED_AT_INDEX,
+                              convert_order_value(data["deleted_at"]))
+    return riak_object
+
+
+def get_index_status(model):
+    """Returns a description of the indexes maintained for the given model:
+    it is stored once a table has been indexed, so that tables indexed
+    before an index was added are indexed again."""
+
+    return {
+        "columns": get_indexed_columns(model),
+        "ordered": [list(columns) for columns in get_ordered_indexes(model)],
+        "deleted": DELETED_AT_INDEX
+    }
+
+
+def is_table_indexed(model):
+    """Check if every object of the table of the given model carries its
+    index entries."""
+
+    tablename = model.__tablename__
+    if tablename in INDEXED_TABLES:
+        return True
+
+    status = get_client().bucket(INDEX_STATUS_BUCKET).get(tablename)
+    if status.data == get_index_status(model):
+        INDEXED_TABLES.add(tablename)
+        return True
+    return False
+
+
+def reindex_table(model):
+    """Rewrite every object of the table of the given model with its index
+    entries. Objects stored before indexes were maintained are thus made
+    visible to index lookups."""
+
+    tablename = model.__tablename__
+    object_bucket = get_client().bucket(tablename)
+
+    for key in key_index.iter_keys(tablename):
+        riak_object = object_bucket.get(str(key))
+        if riak_object.data is None:
+            continue
+        add_indexes(riak_object, model, riak_object.data)
+        riak_object.store()
+    for key in key_index.iter_removed_keys(tablename):
+        riak_object = object_bucket.get(str(key))
+        if riak_object.data is None:
+            continue
+        clear_indexes(riak_object)
+        riak_object.store()
+
+    status_bucket = get_client().bucket(INDEX_STATUS_BUCKET)
+    status = status_bucket.new(tablename, data=get_index_status(model))
+    status.store()
+    INDEXED_TABLES.add(tablename)
+
+
+def ensure_table_indexed(model):
+    """Make sure that the table of the given model can be queried with
+    its indexes. Returns False if the table could not be indexed."""
+
+    if is_table_indexed(model):
+        return True
+    try:
+        reindex_table(model)
+    except Exception:
+        LOG.exception("could not index table %s" % (model.__tablename__))
+        return False
+    return True
+
+
+def find_keys(model, column_name, values):
+    """Returns the set of keys of the objects of the given model whose
+    column has one of the given values."""
+
+    object_bucket = get_client().bucket(model.__tablename__)
+    index_field = get_index_field(model, column_name)
+
+    result = set()
+    for value in values:
+        index_value = convert_index_value(index_field, value)
+        if index_value is None:
+            continue
+        for key in object_bucket.get_index(index_field, index_value):
+            result.add(int(key))
+    return result
+
+
+def find_deleted_keys(model, since):
+    """Returns the set of keys of the objects of the given model that were
+    soft deleted since the given datetime. Deletion times are indexed up to
+    the second: objects deleted during the second that precedes the given
+    datetime may be returned as well."""
+
+    object_bucket = get_client().bucket(model.__tablename__)
+    return set(int(key) for key in object_bucket.get_index(
+        DELETED_AT_INDEX, convert_order_value(since), ORDER_TERM_MAX))
+
+
+def extract_index_lookup(expression, model):
+    """Check if the given binary expression is an equality (or an IN) that
+    targets an indexed column of the given model. Returns a tuple
+    (column_name, values) if it is the case, otherwise it returns None."""
+
+    left = getattr(expression, "left", None)
+    right = getattr(expression, "right", None)
+
+    left_table = getattr(left, "table", None)
+    if left_table is None or left_table.name != model.__tablename__:
+        return None
+    if left.name not in get_indexed_columns(model):
+        return None
+
+    if expression.operator is operators.eq:
+        if not isinstance(right, BindParameter):
+            return None
+        values = [right.effective_value]
+    elif expression.operator is operators.in_op:
+        clauses = getattr(getattr(right, "element", None), "clauses", None)
+        if clauses is None:
+            return None
+        if not all(isinstance(clause, BindParameter) for clause in clauses):
+            return None
+        values = [clause.effective_value for clause in clauses]
+    else:
+        return None
+
+    if any(value is None for value in values):
+        return None
+
+    return (left.name, values)
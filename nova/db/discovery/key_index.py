@@ -0,0 +1,248 @@
+"""Key index module.
+
+This module contains functions that maintain the key index of the discovery
+database backend, which lists the keys of the (non deleted) objects of each
+table. The key index of a table is split into shards: the shard number n of a
+table contains the keys between n * SHARD_SIZE and (n + 1) * SHARD_SIZE - 1,
+so that adding or removing a key only rewrites a small shard. A directory
+object lists the shards of each table, so that a table scan can stream the
+keys shard by shard.
+
+Each shard (and each directory) is stored as a two-phase set: it contains the
+list of added values and the list of removed values. As identifiers are never
+reused, a removed key never comes back, and concurrent updates of a shard
+can be reconciled by merging their siblings. Tables indexed before the key
+index was sharded have their keys in a single list, which is moved into the
+shards the first time the table is scanned.
+
+"""
+
+from nova.db.discovery.client import get_client
+
+KEY_INDEX_BUCKET = "key_index"
+
+"""Number of keys covered by a shard of the key index."""
+SHARD_SIZE = 1000
+
+
+def merge_siblings(riak_object):
+    """Resolver of the key index bucket: siblings created by concurrent
+    updates are merged by computing the union of their added and removed
+    values."""
+
+    if len(riak_object.siblings) < 2:
+        return
+    values = [x.data for x in riak_object.siblings if x.data is not None]
+    merged = riak_object.siblings[0]
+    if any(isinstance(value, list) for value in values):
+        """Legacy key lists are merged with a simple union."""
+        merged.data = sorted(set().union(*[set(value) for value in values
+                                           if isinstance(value, list)]))
+    else:
+        added = set()
+        removed = set()
+        for value in values:
+            added |= set(value.get("added", []))
+            removed |= set(value.get("removed", []))
+        merged.data = {"added": sorted(added), "removed": sorted(removed)}
+    riak_object.siblings = [merged]
+
+
+KEY_INDEX_BUCKET_CONFIGURED = False
+
+def get_key_index_bucket():
+    """Returns the bucket that stores the key index: siblings are allowed on
+    this bucket, so that concurrent updates are not lost."""
+
+    global KEY_INDEX_BUCKET_CONFIGURED
+
+    key_index_bucket = get_client().bucket(KEY_INDEX_BUCKET)
+    if not KEY_INDEX_BUCKET_CONFIGURED:
+        key_index_bucket.allow_mult = True
+        KEY_INDEX_BUCKET_CONFIGURED = True
+    key_index_bucket.resolver = merge_siblings
+    return key_index_bucket
+
+
+def get_shard_number(key):
+    """Returns the number of the shard that contains the given key."""
+
+    return key // SHARD_SIZE
+
+
+def get_shard_name(tablename, shard_number):
+    """Returns the Riak key of the given shard of a table."""
+
+    return "%s:%d" % (tablename, shard_number)
+
+
+def get_directory_name(tablename):
+    """Returns the Riak key of the directory of shards of a table."""
+
+    return "%s:shards" % (tablename)
+
+
+def update_two_phase_set(riak_key, added=None, removed=None):
+    """Add and remove values from the two-phase set stored at the given key.
+    Returns True if the set did not exist before.
+    :param added: a list of added values
+    :param removed: a list of removed values
+    """
+
+    key_index_bucket = get_key_index_bucket()
+    fetched = key_index_bucket.get(riak_key)
+
+    is_new = fetched.data is None
+    data = fetched.data if not is_new else {"added": [], "removed": []}
+
+    added_values = set(data["added"]) | set(added or [])
+    removed_values = set(data["removed"]) | set(removed or [])
+
+    if len(added_values) == len(data["added"]) and \
+            len(removed_values) == len(data["removed"]) and not is_new:
+        """The set already contains the values: nothing to write."""
+        return is_new
+
+    fetched.data = {
+        "added": sorted(added_values),
+        "removed": sorted(removed_values)
+    }
+    fetched.store()
+    return is_new
+
+
+def group_by_shard(keys):
+    """Returns the given keys grouped by shard, as a dict shard number ->
+    list of keys."""
+
+    result = {}
+    for key in keys:
+        result.setdefault(get_shard_number(key), []).append(key)
+    return result
+
+
+def update_keys(tablename, added=None, removed=None):
+    """Add and remove keys from the key index of a table: each shard is
+    updated once, and the directory once if shards were created."""
+
+    added_shards = group_by_shard(added or [])
+    removed_shards = group_by_shard(removed or [])
+
+    new_shards = []
+    for shard_number in sorted(set(added_shards) | set(removed_shards)):
+        is_new_shard = update_two_phase_set(
+            get_shard_name(tablename, shard_number),
+            added=added_shards.get(shard_number),
+            removed=removed_shards.get(shard_number)
+        )
+        if is_new_shard:
+            new_shards += [shard_number]
+    if len(new_shards) > 0:
+        update_two_phase_set(get_directory_name(tablename), added=new_shards)
+
+
+def add_keys(tablename, keys):
+    """Add the given keys to the key index of a table."""
+
+    update_keys(tablename, added=keys)
+
+
+def add_key(tablename, key):
+    """Add the given key to the key index of a table."""
+
+    update_keys(tablename, added=[key])
+
+
+def remove_key(tablename, key):
+    """Remove the given key from the key index of a table."""
+
+    update_keys(tablename, removed=[key])
+
+
+"""Tables whose legacy key list was migrated (or found missing) by this
+process."""
+MIGRATED_TABLES = set()
+
+def migrate_legacy_keys(tablename):
+    """Move the keys of a table that were stored in a single list, before
+    the key index was sharded, into the shards of its key index, then delete
+    the list. The list is only read once per process and table, so that
+    scans do not read it again."""
+
+    if tablename in MIGRATED_TABLES:
+        return
+    legacy = get_key_index_bucket().get(tablename)
+    if isinstance(legacy.data, list):
+        if len(legacy.data) > 0:
+            add_keys(tablename, legacy.data)
+        legacy.delete()
+    MIGRATED_TABLES.add(tablename)
+
+
+def get_shard_numbers(tablename):
+    """Returns the sorted numbers of the shards of a table."""
+
+    directory = get_key_index_bucket().get(get_directory_name(tablename)).data
+    if directory is None:
+        return []
+    return sorted(set(directory["added"]) - set(directory["removed"]))
+
+
+def iter_key_shards(tablename):
+    """Iterate over the key index of a table, shard by shard: each step
+    fetches a single shard and yields the sorted list of its keys."""
+
+    migrate_legacy_keys(tablename)
+    key_index_bucket = get_key_index_bucket()
+    for shard_number in get_shard_numbers(tablename):
+        shard = key_index_bucket.get(
+            get_shard_name(tablename, shard_number)
+        ).data
+        if shard is not None:
+            keys = set(shard["added"]) - set(shard["removed"])
+            if len(keys) > 0:
+                yield sorted(keys)
+
+
+def iter_removed_keys(tablename):
+    """Iterate over the keys removed from the key index of a table (the keys
+    of its deleted objects): every shard is fetched."""
+
+    key_index_bucket = get_key_index_bucket()
+    for shard_number in get_shard_numbers(tablename):
+        shard = key_index_bucket.get(
+            get_shard_name(tablename, shard_number)
+        ).data
+        if shard is not None:
+            for key in sorted(shard["removed"]):
+                yield key
+
+
+def iter_keys(tablename):
+    """Iterate over the keys of the key index of a table."""
+
+    for keys in iter_key_shards(tablename):
+        for key in keys:
+            yield key
+
+
+def get_keys(tablename):
+    """Returns the list of the keys of the key index of a table."""
+
+    return list(iter_keys(tablename))
+
+
+def get_highest_key(tablename):
+    """Returns the highest key of the key index of a table, or 0 if the
+    table is empty."""
+
+    migrate_legacy_keys(tablename)
+    result = 0
+    shard_numbers = get_shard_numbers(tablename)
+    if len(shard_numbers) > 0:
+        shard = get_key_index_bucket().get(
+            get_shard_name(tablename, shard_numbers[-1])
+        ).data
+        if shard is not None and len(shard["added"]) > 0:
+            result = max(result, max(shard["added"]))
+    return result
@@ -4,15 +4,20 @@ This module contains functions, classes and mix-in that are used for the
 building lazy references to objects located in database. These lazy references
 will be evaluated only when some functions or properties will be called.
 
+Lazy references created during the same request share a loader: the first time
+one of them is evaluated, the objects referenced by every pending reference to
+the same table are fetched together, with a single batched request.
+
 """
 
-import riak
+import threading
 import uuid
 
+from nova.db.discovery.cache import RequestCacheManager
 from nova.db.discovery.models import get_model_class_from_name
 from nova.db.discovery.models import get_model_classname_from_tablename
-
-RIAK_CLIENT = riak.RiakClient(pb_port=8087, protocol='pbc')
+from nova.db.discovery.utils import fetch_values
+from nova.db.discovery.utils import get_objects
 
 def now_in_ms():
     return int(round(time.time() * 1000))
@@ -20,6 +25,126 @@ def now_in_ms():
 class EmptyObject:
     pass
 
+class LazyReferenceLoader(object):
+    """Class that loads the objects referenced by the lazy references of a
+    request. References register the object they target when they are
+    created, and the first reference to a table that is evaluated fetches
+    every pending object of this table at once (as the "selectin" loading
+    strategy of SQLAlchemy). The objects referenced by the fields of fetched
+    objects are registered as well, so that the relationships of a batch of
+    objects are also fetched with a single request."""
+
+    def __init__(self):
+        """Constructor"""
+
+        """tablename -> set of ids that have not been fetched yet"""
+        self.pending = {}
+        """(tablename, id) -> fetched value (None if it does not exist)"""
+        self.values = {}
+        """tablename -> stored values of the tables scanned by the request"""
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def register(self, tablename, id):
+        """Mark the object identified by the given id as an object that will
+        probably be loaded."""
+
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return
+
+        with self.lock:
+            if not (tablename, id) in self.values:
+                self.pending.setdefault(tablename, set()).add(id)
+
+    def register_references(self, value):
+        """Register the objects referenced by the fields of the given stored
+        value."""
+
+        if not isinstance(value, dict):
+            return
+        for field_value in value.values():
+            if isinstance(field_value, list):
+                candidates = field_value
+            else:
+                candidates = [field_value]
+            for candidate in candidates:
+                if isinstance(candidate, dict) and \
+                        candidate.get("simplify_strategy") == "novabase":
+                    self.register(candidate["tablename"], candidate["id"])
+
+    def fetch(self, tablename, id):
+        """Returns the stored value of the given object. If it has not been
+        fetched yet, it is fetched along with every pending object of the same
+        table."""
+
+        id = int(id)
+        key = (tablename, id)
+
+        values = {}
+        with self.lock:
+            if not key in self.values:
+                ids = self.pending.pop(tablename, set())
+                ids.add(id)
+                ids = [x for x in ids if not (tablename, x) in self.values]
+                values = fetch_values(tablename, sorted(ids))
+                for each in ids:
+                    self.values[(tablename, each)] = values.get(each)
+            result = self.values[key]
+
+        for value in values.values():
+            self.register_references(value)
+
+        return result
+
+    def scan(self, tablename, values=None):
+        """Fetch every object of the given table, once for the request: the
+        objects of this table are then found by the value of a field (see
+        find) without scanning the table again. Returns the stored values of
+        the objects.
+        :param values: the stored values of every object of the table, if
+        they were already fetched
+        """
+
+        with self.lock:
+            if tablename in self.tables:
+                return self.tables[tablename]
+
+        if values is None:
+            values = get_objects(tablename, False)
+        with self.lock:
+            self.tables[tablename] = values
+            for value in values:
+                if isinstance(value, dict) and value.get("id") is not None:
+                    self.values[(tablename, int(value["id"]))] = value
+        return values
+
+    def find(self, tablename, field, value):
+        """Returns the stored values of the objects of a scanned table whose
+        field has the given value, or None if the request did not scan this
+        table."""
+
+        values = self.tables.get(tablename)
+        if values is None:
+            return None
+        return [x for x in values if x.get(field) == value]
+
+LOADERS = RequestCacheManager("lazy_loader", factory=LazyReferenceLoader)
+
+
+def scan_table(tablename, request_uuids):
+    """Fetch every object of the given table once for the given requests, so
+    that the relationships resolved by the value of a field other than the
+    id (see utils.get_models_satisfying) do not scan the table once per
+    object."""
+
+    values = None
+    for request_uuid in request_uuids:
+        values = LOADERS.get(request_uuid).scan(tablename, values)
+    return values
+
+
 class LazyReference:
     """Class that references a remote object stored in database. This aims
     easing the development of algorithm on relational objects: instead of
@@ -38,9 +163,9 @@ class LazyReference:
         self.version = -1
 
         self.request_uuid = request_uuid if request_uuid is not None else uuid.uuid1()
-        if not caches.has_key(self.request_uuid):
-            caches[self.request_uuid] = {}
-        self.cache = caches[self.request_uuid]
+        self.cache = caches.get(self.request_uuid)
+        self.loader = LOADERS.get(self.request_uuid)
+        self.loader.register(self.base, self.id)
 
         if desimplifier is None:
             from desimplifier import ObjectDesimplifier
@@ -86,9 +211,7 @@ class LazyReference:
 
         # Check if obj is simplified or not
         if "simplify_strategy" in obj:
-            object_bucket = RIAK_CLIENT.bucket(obj["tablename"])
-            riak_value = object_bucket.get(str(obj["id"]))
-            obj = riak_value.data
+            obj = self.loader.fetch(obj["tablename"], obj["id"])
 
         # For each value of obj, set the corresponding attributes.
         for key in obj:
@@ -127,9 +250,7 @@ class LazyReference:
 
         key = self.get_key()
 
-        key_index_bucket = RIAK_CLIENT.bucket(self.base)
-        fetched = key_index_bucket.get(str(self.id))
-        obj = fetched.data
+        obj = self.loader.fetch(self.base, self.id)
 
         self.spawn_empty_model(obj)
         self.update_nova_model(obj)
@@ -163,7 +284,7 @@ class LazyReference:
         requested attribute/method is then setted with the given value."""
 
         if name in ["base", "id", "cache", "desimplifier", "request_uuid",
-        "uuid", "version"]:
+        "uuid", "version", "loader"]:
             self.__dict__[name] = value
         else:
             setattr(self.get_complex_ref(), name, value)
@@ -187,3 +308,16 @@ class LazyReference:
         """This method is required by some services of OpenStack."""
 
         return not not self.get_complex_ref()
+
+
+def prefetch(refs):
+    """Load the objects targeted by the given lazy references: the objects
+    of each table are fetched with a single batched request, instead of one
+    request per reference. Items that are not lazy references are ignored.
+    :return: the list of loaded objects
+    """
+
+    lazy_refs = [ref for ref in refs if isinstance(ref, LazyReference)]
+    for ref in lazy_refs:
+        ref.loader.register(ref.base, ref.id)
+    return [ref.get_complex_ref() for ref in lazy_refs]
@@ -33,19 +33,27 @@ from sqlalchemy import ForeignKey, DateTime, Boolean, Text, Float
 from nova.db.sqlalchemy import types
 
 # RIAK
-import riak
 from simplifier import ObjectSimplifier
+from simplifier import release_caches
 import traceback
 import sys
 import inspect
 
 from utils import ReloadableRelationMixin
+from nova.db.discovery import aggregates
+from nova.db.discovery import batch
+from nova.db.discovery.cache import request_scope
+from nova.db.discovery.client import get_client
+from nova.db.discovery import codec
+from nova.db.discovery.allocator import allocate_id
+from nova.db.discovery import key_index
+from nova.db.discovery.indexes import clear_indexes
+from nova.db.discovery import table_cache
+from nova.db.discovery import versions
 
 CONF = cfg.CONF
 BASE = declarative_base()
 
-dbClient = riak.RiakClient(pb_port=8087, protocol='pbc')
-
 def starts_with_uppercase(name):
     if name is None or len(name) < 1:
         return False
@@ -113,15 +121,26 @@ def get_tablename_from_name(name):
 def MediumText():
     return Text().with_variant(MEDIUMTEXT(), 'mysql')
 
-def same_version(a, b, model):
-    if a is None:
-        return False
+def get_changed_fields(a, b, model):
+    """Returns the fields of a model whose values differ between a stored
+    value (a) and a new value (b): every field of the new value is changed if
+    there is no stored value."""
+    result = []
     for attr in model._sa_class_manager:
         if "RelationshipProperty" in str(type(model._sa_class_manager[attr].property)):
             continue
+        if a is None:
+            if b.has_key(attr):
+                result += [attr]
+            continue
         if (a.has_key(attr) ^ b.has_key(attr)) or (a.has_key(attr) and a[attr] != b[attr]):
-            return False
-    return True
+            result += [attr]
+    return result
+
+def same_version(a, b, model):
+    if a is None:
+        return False
+    return len(get_changed_fields(a, b, model)) == 0
 
 def merge_dict(a, b):
     result = {}
@@ -141,25 +160,8 @@ class NovaBase(models.SoftDeleteMixin,
 
     def add_to_key_index(self, key, table_name):
 
-        """Check if the current table contains keys."""
-        myBucket = dbClient.bucket("key_index")
-        fetched = myBucket.get(table_name)
-
-        """If no keys: initialize an empty list of keys."""
-        if fetched.data == None:
-            empty_keys = myBucket.new(table_name, data=[])
-            empty_keys.store()
-
-        """It is certain that there is a list of keys: we simply work with it."""
-        fetched = myBucket.get(table_name)
-
-        keys = fetched.data if fetched.data != None else []
-        keys += [key]
-        fetched.data = list(set(keys))
-        fetched.store()
-
-        myBucket2 = dbClient.bucket("key_index")
-        fetched2 = myBucket2.get(table_name)
+        """Add the key to the shard of the key index that covers it."""
+        key_index.add_key(table_name, key)
 
     def next_key(self, table_name):
 
@@ -193,55 +195,53 @@ class NovaBase(models.SoftDeleteMixin,
                 if result.result == "Success" or result.result is None:
                     return -1
 
-        """Check if the current table contains keys."""
-        myBucket = dbClient.bucket("key_index")
-        fetched = myBucket.get(table_name)
-
-        """If no keys: initialize an empty list of keys."""
-        if fetched.data == None:
-            empty_keys = myBucket.new(table_name, data=[])
-            empty_keys.store()
-
-        fetched = myBucket.get(table_name)
-        keys = fetched.data if fetched.data != None else []
-        
-        current_key = 1
-        while current_key in keys:
-            current_key += 1
-
-        return current_key
+        """Lease a new identifier from the allocator of the table."""
+        return allocate_id(table_name)
 
     def already_in_database(self):
         return hasattr(self, "id") and (self.id is not None)
 
     def remove_from_key_index(self, key):
 
-        myBucket = dbClient.bucket("key_index")
-        fetched = myBucket.get(self.__tablename__)
-
-        keys = fetched.data if fetched.data != None else []
-        keys = [k for k in keys if k != key]
-        fetched.data = list(set(keys))
-        fetched.store()
+        """Remove the key from the shard of the key index that covers it."""
+        key_index.remove_key(self.__tablename__, key)
 
     def soft_delete(self, session):
 
-        myBucket = dbClient.bucket(self.__tablename__)
+        myBucket = versions.get_object_bucket(get_client(), self.__tablename__)
 
         """Delete existing object"""
         key_as_string = "%d" % (self.id)
         exisiting_object = myBucket.get(key_as_string)
+        previous_value = exisiting_object.data
 
-        object_simplifier = ObjectSimplifier(uuid.uuid1())
+        request_uuid = uuid.uuid1()
+        object_simplifier = ObjectSimplifier(request_uuid)
         simplified_object = object_simplifier.simplify(self)
-
-        """Update value of the object"""
-        exisiting_object.data = simplified_object
-        exisiting_object.store()
+        release_caches(request_uuid)
+
+        """Update value of the object: a deleted object is not referenced
+        anymore by the secondary indexes."""
+        exisiting_object.data = versions.stamp_changes(simplified_object,
+                                                       previous_value)
+        exisiting_object.content_type = codec.get_content_type()
+        clear_indexes(exisiting_object)
+        versions.store_object(exisiting_object)
+        versions.remember_object(self.__tablename__, exisiting_object)
+        aggregates.update_counters(self.__tablename__, previous_value, None)
 
         self.remove_from_key_index(self.id)
+        table_cache.bump_stamp(self.__tablename__)
+
+    def update(self, values, synchronize_session='evaluate', request_uuid=None, do_save=True):
 
-    def update(self, values, synchronize_session='evaluate', request_uuid=uuid.uuid1(), do_save=True):
+        """Lazy references created by an update that is not part of a request
+        are only valid during this update: they must not be found by the
+        following updates."""
+        if request_uuid is None:
+            with request_scope() as request_uuid:
+                return self.update(values, synchronize_session, request_uuid,
+                                   do_save)
 
         primitive = (int, str, bool)
 
@@ -272,16 +272,20 @@ class NovaBase(models.SoftDeleteMixin,
                 print(e)
                 pass
 
-        self.update_foreign_keys()
+        self.update_foreign_keys(request_uuid)
 
         if do_save:
             self.save(request_uuid=request_uuid)
         return self
 
 
-    def save(self, session=None, request_uuid=uuid.uuid1()):
-        
-        self.update_foreign_keys()
+    def save(self, session=None, request_uuid=None):
+
+        if request_uuid is None:
+            with request_scope() as request_uuid:
+                return self.save(session, request_uuid)
+
+        self.update_foreign_keys(request_uuid)
 
         target = self
         table_name = self.__tablename__
@@ -300,8 +304,6 @@ class NovaBase(models.SoftDeleteMixin,
         object_simplifier = ObjectSimplifier(request_uuid)
         simplified_object = object_simplifier.simplify(target)
 
-        table_next_key_offset = {}
-
         for key in [key for key in object_simplifier.complex_cache if "x" in key]:
 
             classname = "_".join(key.split("_")[0:-1])
@@ -315,12 +317,7 @@ class NovaBase(models.SoftDeleteMixin,
                 continue
 
             """Find a new_id for this object"""
-            table_next_key = self.next_key(table_name)
-            if not table_name in table_next_key_offset:
-                table_next_key_offset[table_name] = 0
-            new_id = table_next_key + table_next_key_offset[table_name]
-
-            table_next_key_offset[table_name] += 1
+            new_id = self.next_key(table_name)
 
             """Assign this id to the object"""
             simplified_object["id"] = new_id
@@ -329,56 +326,84 @@ class NovaBase(models.SoftDeleteMixin,
 
             pass
 
+        """Objects of the graph that are written: an object that appears
+        several times is written once, with the fields of each
+        occurrence."""
+        targets = []
+        target_positions = {}
         for key in object_simplifier.complex_cache:
 
             classname = "_".join(key.split("_")[0:-1])
             table_name = get_model_tablename_from_classname(classname)
-            
-            current_object = object_simplifier.complex_cache[key]
-
-            myBucket = dbClient.bucket(table_name)
-
-            """Delete existing object"""
-            # print("simplified_object [%s][%s] --> %s" % (table_name, current_object["id"], current_object))
 
+            current_object = object_simplifier.complex_cache[key]
             current_object["nova_classname"] = table_name
 
             if not "id" in current_object or current_object["id"] is None:
                 current_object["id"] = self.next_key(table_name)
-            else:
-                model_class = get_model_class_from_name(classname)
-                existing_object = myBucket.get(str(current_object["id"])).data
-                if not same_version(existing_object, current_object, model_class):
-                    current_object = merge_dict(existing_object, current_object)
-                else:
-                    continue
 
             if current_object["id"] == -1:
                 print(">>>>>>>>>>>>>> I skip %s: {%s}" %(table_name, current_object["id"]))
                 continue
 
-            object_simplifier_datetime = ObjectSimplifier(request_uuid)
+            position = target_positions.get((table_name, current_object["id"]))
+            if position is not None:
+                (_, _, previous_object) = targets[position]
+                targets[position] = (table_name, classname,
+                                     merge_dict(previous_object,
+                                                current_object))
+                continue
+            target_positions[(table_name, current_object["id"])] = len(targets)
+            targets += [(table_name, classname, current_object)]
+
+        """Compare the objects with their last known versions: versions that
+        are not known are fetched with a request per table."""
+        known_versions = {}
+        for table_name in set(x[0] for x in targets):
+            known_versions[table_name] = batch.load_versions(
+                table_name, [x[2]["id"] for x in targets if x[0] == table_name]
+            )
+
+        now = object_simplifier.simplify(timeutils.utcnow())
+        write_batch = batch.WriteBatch()
+        for (table_name, classname, current_object) in targets:
+
+            model_class = get_model_class_from_name(classname)
+            (vclock, existing_object) = \
+                known_versions[table_name][current_object["id"]]
+
+            changed_fields = get_changed_fields(existing_object,
+                                                current_object, model_class)
+            if existing_object is not None and len(changed_fields) == 0:
+                continue
 
-            if (current_object.has_key("created_at") and current_object["created_at"] is None) or not current_object.has_key("created_at"):
-                current_object["created_at"] = object_simplifier_datetime.simplify(timeutils.utcnow())
-            # else:
-            #     continue
-            current_object["updated_at"] = object_simplifier_datetime.simplify(timeutils.utcnow())
+            """Only the changed fields are applied on the known version."""
+            delta = dict((field, value)
+                         for (field, value) in current_object.items()
+                         if field in changed_fields or
+                         not field in model_class._sa_class_manager)
+            current_object = merge_dict(existing_object, delta)
+
+            if current_object.get("created_at") is None:
+                current_object["created_at"] = now
+                changed_fields += ["created_at"]
+            current_object["updated_at"] = now
+            changed_fields += ["updated_at"]
+            versions.stamp_changes(current_object, existing_object,
+                                   changed_fields)
 
             print(">>>>>>>>>>>>>> storing in %s: {%s}" %(table_name, current_object["id"]))
-            print(current_object)
 
-            
-            try:
-                local_object_simplifier = ObjectSimplifier(request_uuid)
-                corrected_object = local_object_simplifier.simplify(current_object)
-                fetched = myBucket.new(str(current_object["id"]), data=corrected_object)
-                fetched.store()
-                self.add_to_key_index(current_object["id"], table_name)
-            except Exception as e:
-                print("Failed to store following object: %s because of %s, becoming %s" % (current_object, e, corrected_object))
-                pass
-            print("<<<<<<<<<<<<<< done (storing in %s: {%s})" %(table_name, self.id))
+            write_batch.add(table_name, current_object["id"], vclock,
+                            existing_object, current_object, model_class)
+
+        """Objects are stored concurrently; the key index, the counters and
+        the stamp of each table are then updated once."""
+        write_batch.flush()
+
+        """The simplification caches of this request are not needed
+        anymore."""
+        release_caches(request_uuid)
 
         return self
 
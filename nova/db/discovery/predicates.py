@@ -0,0 +1,322 @@
+"""Predicates module.
+
+This module contains functions that compile the criterions of a query (SQL
+expressions built with SQLAlchemy, and boolean expressions of the discovery
+backend) into python predicates. A criterion is compiled once: the columns it
+targets are resolved into the labels and attributes of the rows, and the
+values of its bound parameters are extracted, so that evaluating it on a row
+is a simple function call.
+
+"""
+
+import datetime
+import re
+
+import pytz
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import BinaryExpression
+from sqlalchemy.sql.expression import BindParameter
+from sqlalchemy.sql.expression import BooleanClauseList
+from sqlalchemy.sql.expression import ClauseList
+from sqlalchemy.sql.expression import ColumnClause
+from sqlalchemy.sql.expression import False_
+from sqlalchemy.sql.expression import Grouping
+from sqlalchemy.sql.expression import Null
+from sqlalchemy.sql.expression import True_
+from sqlalchemy.sql.expression import UnaryExpression
+
+
+def normalize_value(value):
+    """Datetimes without timezone are considered as UTC datetimes, so that
+    they can be compared with datetimes that have a timezone."""
+
+    if isinstance(value, datetime.datetime) and value.tzinfo is None:
+        return pytz.utc.localize(value)
+    return value
+
+
+def always_true(row):
+    return True
+
+
+def always_false(row):
+    return False
+
+
+def compile_constant(value):
+    """Returns a getter that always returns the given value."""
+
+    value = normalize_value(value)
+
+    def getter(row):
+        return value
+    getter.is_constant = True
+    getter.value = value
+    return getter
+
+
+def compile_column(column):
+    """Returns a getter that extracts the value of the given column from a
+    row. A row is a KeyedTuple whose labels are the capitalized names of the
+    tables of its objects."""
+
+    label = column.table.name.capitalize()
+    tablename = column.table.name
+    attribute = column.name
+
+    def getter(row):
+        obj = getattr(row, label, None)
+        if obj is None:
+            if getattr(row, "__tablename__", None) != tablename:
+                return None
+            obj = row
+        return normalize_value(getattr(obj, attribute, None))
+    getter.is_constant = False
+    return getter
+
+
+def compile_operand(element):
+    """Returns a getter that computes the value of the given operand of a
+    binary expression on a row."""
+
+    if hasattr(element, "__clause_element__"):
+        element = element.__clause_element__()
+    if isinstance(element, BindParameter):
+        return compile_constant(element.effective_value)
+    if isinstance(element, Null):
+        return compile_constant(None)
+    if isinstance(element, True_):
+        return compile_constant(True)
+    if isinstance(element, False_):
+        return compile_constant(False)
+    if isinstance(element, ColumnClause) and \
+            getattr(element, "table", None) is not None:
+        return compile_column(element)
+    if isinstance(element, Grouping):
+        return compile_operand(element.element)
+    raise NotImplementedError("unsupported operand: %s" % (element))
+
+
+def compile_operands(element):
+    """Returns the getters of the operands of the right side of an IN
+    expression."""
+
+    if isinstance(element, Grouping):
+        element = element.element
+    if isinstance(element, ClauseList):
+        return [compile_operand(x) for x in element.clauses]
+    return [compile_operand(element)]
+
+
+def are_equal(a, b):
+    """Equality used by the criterions: values are also compared with their
+    string representation, as some values (identifiers, booleans) are not
+    stored with the type of their column."""
+
+    return "%s" % (a) == "%s" % (b) or a == b
+
+
+def like_to_regex(pattern):
+    """Convert the pattern of a LIKE expression into a regular
+    expression."""
+
+    result = ""
+    for character in pattern:
+        if character == "%":
+            result += ".*"
+        elif character == "_":
+            result += "."
+        else:
+            result += re.escape(character)
+    return "^%s$" % (result)
+
+
+def compile_pattern(operator, right):
+    """Returns a function that matches values with the pattern of a LIKE
+    (or REGEXP) expression, or None if the operator is not a pattern
+    operator."""
+
+    if not getattr(right, "is_constant", False):
+        return None
+    pattern = "%s" % (right.value)
+
+    if operator is operators.like_op or operator is operators.ilike_op or \
+            operator is operators.notlike_op or \
+            operator is operators.notilike_op:
+        regex = re.compile(like_to_regex(pattern), re.IGNORECASE)
+    elif operator is operators.contains_op:
+        regex = re.compile(re.escape(pattern), re.IGNORECASE)
+    elif operator is operators.startswith_op:
+        regex = re.compile("^%s" % (re.escape(pattern)), re.IGNORECASE)
+    elif operator is operators.endswith_op:
+        regex = re.compile("%s$" % (re.escape(pattern)), re.IGNORECASE)
+    elif getattr(operator, "opstring", "").upper() == "REGEXP":
+        regex = re.compile(pattern, re.IGNORECASE)
+    elif getattr(operator, "opstring", "").upper() in ["LIKE", "ILIKE"]:
+        regex = re.compile(like_to_regex(pattern), re.IGNORECASE)
+    else:
+        return None
+
+    def matches(value):
+        return regex.search("%s" % (value)) is not None
+    return matches
+
+
+COMPARATORS = {
+    operators.eq: are_equal,
+    operators.ne: lambda a, b: not are_equal(a, b),
+    operators.lt: lambda a, b: a < b,
+    operators.le: lambda a, b: a <= b,
+    operators.gt: lambda a, b: a > b,
+    operators.ge: lambda a, b: a >= b
+}
+
+
+def compile_binary_expression(expression):
+    """Compile a binary expression (column = value, column IN (...), column
+    IS NULL, ...) into a predicate."""
+
+    operator = expression.operator
+    left = compile_operand(expression.left)
+
+    if operator is operators.in_op or operator is operators.notin_op:
+        rights = compile_operands(expression.right)
+        negate = operator is operators.notin_op
+        if all(getattr(x, "is_constant", False) for x in rights):
+            values = [x.value for x in rights if x.value is not None]
+
+            def predicate(row):
+                value = left(row)
+                if value is None:
+                    return False
+                found = any(value == x or value is x for x in values)
+                return found != negate
+        else:
+            def predicate(row):
+                value = left(row)
+                if value is None:
+                    return False
+                found = False
+                for right in rights:
+                    right_value = right(row)
+                    if value == right_value or value is right_value:
+                        found = True
+                        break
+                return found != negate
+        return predicate
+
+    right = compile_operand(expression.right)
+
+    if operator is operators.is_:
+        def predicate(row):
+            a = left(row)
+            b = right(row)
+            if a is None or b is None:
+                return a is None and b is None
+            return a is b or a == b
+        return predicate
+
+    if operator is operators.isnot:
+        def predicate(row):
+            a = left(row)
+            b = right(row)
+            if a is None or b is None:
+                return not (a is None and b is None)
+            return not (a is b or a == b)
+        return predicate
+
+    matches = compile_pattern(operator, right)
+    if matches is not None:
+        negate = operator is operators.notlike_op or \
+            operator is operators.notilike_op
+
+        def predicate(row):
+            value = left(row)
+            if value is None:
+                return False
+            return matches(value) != negate
+        return predicate
+
+    comparator = COMPARATORS.get(operator)
+    if comparator is None:
+        raise NotImplementedError("unsupported operator: %s" % (operator))
+
+    if getattr(right, "is_constant", False):
+        right_value = right.value
+        if right_value is None:
+            return always_false
+
+        def predicate(row):
+            value = left(row)
+            if value is None:
+                return False
+            return comparator(value, right_value)
+        return predicate
+
+    def predicate(row):
+        a = left(row)
+        b = right(row)
+        if a is None or b is None:
+            return False
+        return comparator(a, b)
+    return predicate
+
+
+def compile_conjunction(predicates):
+    """Returns a predicate satisfied when every given predicate is
+    satisfied (False if there is no predicate)."""
+
+    if len(predicates) == 0:
+        return always_false
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def predicate(row):
+        for each in predicates:
+            if not each(row):
+                return False
+        return True
+    return predicate
+
+
+def compile_disjunction(predicates):
+    """Returns a predicate satisfied when at least one of the given
+    predicates is satisfied."""
+
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def predicate(row):
+        for each in predicates:
+            if each(row):
+                return True
+        return False
+    return predicate
+
+
+def compile_criterion(criterion):
+    """Compile a criterion into a predicate: a function that takes a row and
+    returns True if the row satisfies the criterion.
+    :param criterion: a SQLAlchemy expression or a BooleanExpression
+    """
+
+    if hasattr(criterion, "is_boolean_expression"):
+        return criterion.compile()
+    if isinstance(criterion, BinaryExpression):
+        return compile_binary_expression(criterion)
+    if isinstance(criterion, BooleanClauseList):
+        predicates = [compile_criterion(x) for x in criterion.clauses]
+        if criterion.operator is operators.or_:
+            return compile_disjunction(predicates)
+        return compile_conjunction(predicates)
+    if isinstance(criterion, Grouping):
+        return compile_criterion(criterion.element)
+    if isinstance(criterion, UnaryExpression) and \
+            criterion.operator is operators.inv:
+        negated = compile_criterion(criterion.element)
+        return lambda row: not negated(row)
+    if isinstance(criterion, True_) or criterion is True:
+        return always_true
+    if isinstance(criterion, False_) or criterion is False:
+        return always_false
+    raise NotImplementedError("unsupported criterion: %s" % (criterion))
@@ -17,19 +17,42 @@
 
 """Implementation of Discovery backend."""
 
+import calendar
 import datetime
+import heapq
 
 # RIAK
-import riak
+from oslo.db.sqlalchemy.utils import InvalidSortKey
 from nova.db.discovery.utils import get_objects
+from nova.db.discovery.utils import iter_stored_values
+from nova.db.discovery.utils import MULTIGET_BATCH_SIZE
 from nova.db.discovery.utils import is_novabase
 from nova.db.discovery.utils import find_table_name
+from nova.db.discovery import aggregates
+from nova.db.discovery import batch
+from nova.db.discovery.client import get_client
+from nova.db.discovery import indexes
+from nova.db.discovery.lazy_reference import scan_table
+from nova.db.discovery.predicates import compile_conjunction
+from nova.db.discovery.predicates import compile_criterion
+from nova.db.discovery.predicates import compile_disjunction
+from nova.db.discovery.simplifier import ObjectSimplifier
+from nova.db.discovery.simplifier import release_caches
+from nova.db.discovery import versions
+from nova.openstack.common import log as logging
+from oslo.utils import timeutils
 import itertools
 import traceback
 import inspect
 from sqlalchemy.util._collections import KeyedTuple
+from sqlalchemy.sql.expression import asc
 from sqlalchemy.sql.expression import BinaryExpression
-import pytz
+from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.sql.expression import ColumnClause
+from sqlalchemy.sql.expression import desc
+from sqlalchemy.sql.expression import literal_column
+from sqlalchemy.sql import operators
+from sqlalchemy.sql import visitors
 try:
     from desimplifier import ObjectDesimplifier
     from desimplifier import find_table_name
@@ -37,7 +60,7 @@ except:
     pass
 import uuid
 
-dbClient = riak.RiakClient(pb_port=8087, protocol='pbc')
+LOG = logging.getLogger(__name__)
 
 class Selection:
     def __init__(self, model, attributes, is_function=False, function=None, is_hidden=False):
@@ -66,240 +89,61 @@ class BooleanExpression(object):
     def __init__(self, operator, *exps):
         self.operator = operator
         self.exps = exps
+        self.predicate = None
 
     def is_boolean_expression(self):
         return True
 
-    def evaluate_criterion(self, criterion, value):
-
-        def uncapitalize(s):
-            return s[:1].lower() + s[1:] if s else ''
-
-        def getattr_rec(obj, attr, otherwise=None):
-            """ A reccursive getattr function.
-
-            :param obj: the object that will be use to perform the search
-            :param attr: the searched attribute
-            :param otherwise: value returned in case attr was not found
-            :return:
-            """
-            try:
-                if not "." in attr:
-                    return getattr(obj, attr.replace("\"", ""))
-                else:
-                    current_key = attr[:attr.index(".")]
-                    next_key = attr[attr.index(".") + 1:]
-                    if hasattr(obj, current_key):
-                        current_object = getattr(obj, current_key)
-                    elif hasattr(obj, current_key.capitalize()):
-                        current_object = getattr(obj, current_key.capitalize())
-                    elif hasattr(obj, uncapitalize(current_key)):
-                        current_object = getattr(obj, uncapitalize(current_key))
-                    else:
-                        current_object = getattr(obj, current_key)
-
-                    return getattr_rec(current_object, next_key, otherwise)
-            except AttributeError:
-                    return otherwise
-
-        criterion_str = criterion.__str__()
-
-        if "=" in criterion_str:
-            def comparator (a, b):
-                if a is None or b is None:
-                    return False
-                return "%s" %(a) == "%s" %(b) or a == b
-            op = "="
-
-        if "REGEXP" in criterion_str:
-            def comparator (a, b):
-                if a is None or b is None:
-                    return False
-                return "%s" %(a) == "%s" %(b) or a == b
-            op = "REGEXP"
-
-        if "IS" in criterion_str:
-            def comparator (a, b):
-                if a is None or b is None:
-                    if a is None and b is None:
-                        return True
-                    else:
-                        return False
-                return a is b
-            op = "IS"
-
-        if "!=" in criterion_str:
-            def comparator (a, b):
-                if a is None or b is None:
-                    return False
-                return a is not b
-            op = "!="
-
-        if "<" in criterion_str:
-            def comparator (a, b):
-                if a is None or b is None:
-                    return False
-                return a < b
-            op = "<"
-
-        if ">" in criterion_str:
-            def comparator (a, b):
-                if a is None or b is None:
-                    return False
-                return a > b
-            op = ">"
-
-        if "IN" in criterion_str:
-            def comparator (a, b):
-                if a is None or b is None:
-                    return False
-                return a == b or a is b
-            op = "IN"
-
-        split = criterion_str.split(op)
-        left = split[0].strip()
-        right = split[1].strip()
-        left_values = []
-
-        # Computing left value
-        if left.startswith(":"):
-            left_values += [criterion._orig[0].effective_value]
-        else:
-            left_values += [getattr_rec(value, left.capitalize())]
+    def compile(self):
+        """Compile the expression into a predicate, that is computed only
+        once and then reused for each evaluated row."""
 
+        if self.predicate is not None:
+            return self.predicate
 
-        # Computing right value
-        if right.startswith(":"):
-            right_value = criterion._orig[1].effective_value
-        else:
-            if hasattr(criterion, "_orig"):
-                if isinstance(criterion._orig[1], bool):
-                    right_value = criterion._orig[1]
-                else:
-                    right_type_name = "none"
-                    try:
-                        right_type_name = str(criterion._orig[1].type)
-                    except:
-                        pass
-
-                    if right_type_name == "BOOLEAN":
-                        right_value = right
-                        if right_value == "1":
-                            right_value = True
-                        else:
-                            right_value = False
-                    else:
-                        right_value = getattr_rec(value, right.capitalize())
-            elif hasattr(criterion, "is_boolean_expression") and criterion.is_boolean_expression():
-                right_value = criterion.evaluate(value)
-        # try:
-        #     print(">>> (%s)[%s] = %s <-> %s" % (value.keys(), left, left_values, right))
-        # except:
-        #     pass
-
-        result = False
-        for left_value in left_values:
-
-            if isinstance(left_value, datetime.datetime):
-                if left_value.tzinfo is None:
-                    left_value = pytz.utc.localize(left_value)
-
-            if isinstance(right_value, datetime.datetime):
-                if right_value.tzinfo is None:
-                    right_value = pytz.utc.localize(right_value)
-
-            if "NOT NULL" in right:
-                if left_value is not None:
-                    result = True
+        predicates = [compile_criterion(exp) for exp in self.exps]
+        if self.operator == "AND":
+            self.predicate = compile_conjunction(predicates)
+        elif self.operator == "OR" or self.operator == "NORMAL":
+            if len(predicates) == 0:
+                self.predicate = lambda value: False
             else:
-                if comparator(left_value, right_value):
-                    result = True
-
-        if op == "IN":
-            result = False
-            right_terms = set(criterion.right.element)
-            # print("before %s" % (right_terms))
-
-            if left_value is None and hasattr(value, "__iter__"):
-                left_key = left.split(".")[-1]
-                if value[0].has_key(left_key):
-                    left_value = value[0][left_key]
+                self.predicate = compile_disjunction(predicates)
+        else:
+            self.predicate = lambda value: True
+        return self.predicate
 
-            for right_term in right_terms:
-                try:
-                    right_value = getattr(right_term.value, "%s" % (right_term._orig_key))
-                except AttributeError:
-                    right_value = right_term.value
-
-                if isinstance(left_value, datetime.datetime):
-                    if left_value.tzinfo is None:
-                        left_value = pytz.utc.localize(left_value)
-
-                if isinstance(right_value, datetime.datetime):
-                    if right_value.tzinfo is None:
-                        right_value = pytz.utc.localize(right_value)
-                # print("comparing %s with %s" % (left_value, right_value))
-                if comparator(left_value, right_value):
-                    result = True
-        return result
+    def evaluate_criterion(self, criterion, value):
+        return compile_criterion(criterion)(value)
 
     def evaluate(self, value):
-
-        if self.operator == "AND":
-            if len(self.exps) <= 0:
-                return False
-            for exp in self.exps:
-                if hasattr(exp, "evaluate") and not exp.evaluate(value):
-                    return False
-                else:
-                    if not self.evaluate_criterion(exp, value):
-                        return False
-            return True
-
-        if self.operator == "OR" or self.operator == "NORMAL":
-            for exp in self.exps:
-                if hasattr(exp, "evaluate") and exp.evaluate(value):
-                    return True
-                else:
-                    if self.evaluate_criterion(exp, value):
-                        return True
-            return False
-
-        return True
+        return self.compile()(value)
 
 class Function:
     def __init__(self, name, field):
         self._name = name
-        if name == "count":
-            self._function = self.count
-        elif name == "sum":
-            self._function = self.sum
-        else:
-            self._function = self.sum
+        if not name in aggregates.AGGREGATE_FUNCTIONS:
+            self._name = "sum"
+        self._function = self.compute
         self._field = field
 
     def collect_field(self, rows, field):
         if rows is None:
             rows = []
+        if field is None:
+            return rows
         if "." in field:
             field = field.split(".")[1]
         result = [ getattr(row, field) for row in rows]
         return result
 
-    def count(self, rows):
-        collected_field_values = self.collect_field(rows, self._field)
-        return len(collected_field_values)
-
-    def sum(self, rows):
-        result = 0
+    def compute(self, rows):
         collected_field_values = self.collect_field(rows, self._field)
-        try:
-            result = sum(collected_field_values)
-        except:
-            pass
+        result = aggregates.aggregate(self._name, collected_field_values)
+        if result is None and self._name == "sum":
+            result = 0
         return result
 
-import re
 
 def extract_models(l):
     already_processed = set()
@@ -310,12 +154,215 @@ def extract_models(l):
             result += [selectable]
     return result
 
+def find_referenced_tables(criterion):
+    """Returns the names of the tables whose columns are used by the given
+    criterion, or None if the criterion cannot be analysed."""
+
+    if isinstance(criterion, ClauseElement):
+        result = set()
+        for element in visitors.iterate(criterion, {}):
+            table = getattr(element, "table", None)
+            if isinstance(element, ColumnClause) and table is not None:
+                result.add(table.name)
+        return result
+
+    if hasattr(criterion, "is_boolean_expression"):
+        result = set()
+        for exp in criterion.exps:
+            tables = find_referenced_tables(exp)
+            if tables is None:
+                return None
+            result |= tables
+        return result
+
+    return None
+
+def join_key(obj, columns):
+    """Compute the key used to join the given object on the given columns.
+    Returns None if one of the values is None, as None never satisfies an
+    equality."""
+
+    result = []
+    for column in columns:
+        value = getattr(obj, column, None)
+        if value is None:
+            return None
+        result += ["%s" % (value)]
+    return tuple(result)
+
+def hash_join(products, objects, index, predicates):
+    """Join partial products with the objects of a new table: a hash table is
+    built on the smaller side, and the other side is streamed to find the
+    matching pairs.
+    :param products: the partial products (lists of objects, where the
+    position of the new table is still None)
+    :param objects: the objects of the new table
+    :param index: the position of the new table in the products
+    :param predicates: a list of tuples (joined_index, joined_column,
+    column) meaning that products[joined_index].joined_column must be equal
+    to objects[i].column
+    :return: an iterator over the joined products
+    """
+
+    def product_key(product):
+        values = []
+        for (joined_index, joined_column, column) in predicates:
+            key = join_key(product[joined_index], [joined_column])
+            if key is None:
+                return None
+            values += key
+        return tuple(values)
+
+    def object_key(obj):
+        return join_key(obj, [column for (_, _, column) in predicates])
+
+    def merge(product, obj):
+        result = list(product)
+        result[index] = obj
+        return result
+
+    if not isinstance(products, list) or len(products) > len(objects):
+        table = {}
+        for obj in objects:
+            key = object_key(obj)
+            if key is not None:
+                table.setdefault(key, []).append(obj)
+        for product in products:
+            for obj in table.get(product_key(product), []):
+                yield merge(product, obj)
+    else:
+        table = {}
+        for product in products:
+            key = product_key(product)
+            if key is not None:
+                table.setdefault(key, []).append(product)
+        for obj in objects:
+            for product in table.get(object_key(obj), []):
+                yield merge(product, obj)
+
+def nested_loop_join(products, objects, index):
+    """Cartesian product between partial products and the objects of a new
+    table: it is used when no equality predicate links the new table to the
+    already joined ones."""
+
+    for product in products:
+        for obj in objects:
+            result = list(product)
+            result[index] = obj
+            yield result
+
+def extract_order_criterion(criterion):
+    """Extract the column targeted by a criterion given to order_by.
+    :return: a tuple (tablename, column_name, descending), or None if the
+    criterion does not target a column
+    """
+
+    descending = False
+    modifier = getattr(criterion, "modifier", None)
+    if modifier is operators.desc_op or modifier is operators.asc_op:
+        descending = modifier is operators.desc_op
+        criterion = criterion.element
+
+    if hasattr(criterion, "__clause_element__"):
+        criterion = criterion.__clause_element__()
+
+    column_name = getattr(criterion, "name", None)
+    if column_name is None:
+        return None
+    table = getattr(criterion, "table", None)
+    tablename = table.name if table is not None else None
+    return (tablename, column_name, descending)
+
+def normalize_sort_value(value):
+    """Convert a value into a value that can be compared with the values of
+    the same column: datetimes (with or without timezone) are converted into
+    timestamps."""
+
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) + \
+            value.microsecond / 1000000.0
+    return value
+
+class SortKey(object):
+    """Key used to sort rows according to several values, each of them being
+    sorted in ascending or descending order."""
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for (value, other_value, descending) in zip(self.values,
+                                                    other.values,
+                                                    self.descending):
+            if value == other_value:
+                continue
+            if descending:
+                return other_value < value
+            return value < other_value
+        return False
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+def paginate_query(query, model, limit, sort_keys, marker=None,
+                   sort_dir=None, sort_dirs=None):
+    """Returns a query that sorts its rows according to the given keys, and
+    that returns the page of rows that follows the marker, in the same way
+    as paginate_query of oslo.db.sqlalchemy.utils. The last sort key should
+    be unique, so that the order of rows is deterministic.
+    :param query: a RiakModelQuery
+    :param model: the model of the rows of the query
+    :param limit: the maximum number of rows of the page
+    :param sort_keys: the names of the columns used to sort the rows
+    :param marker: the last object of the previous page (or None)
+    :param sort_dir: the direction ("asc" or "desc") of every sort key
+    :param sort_dirs: the direction of each sort key
+    """
+
+    if sort_dirs is None:
+        sort_dirs = [sort_dir or "asc"] * len(sort_keys)
+    assert len(sort_dirs) == len(sort_keys)
+
+    used_keys = []
+    order_criterions = []
+    for (sort_key, current_sort_dir) in zip(sort_keys, sort_dirs):
+        if sort_key in used_keys:
+            continue
+        try:
+            sort_column = getattr(model, sort_key)
+        except AttributeError:
+            raise InvalidSortKey()
+        if current_sort_dir == "desc":
+            order_criterions += [desc(sort_column)]
+        elif current_sort_dir == "asc":
+            order_criterions += [asc(sort_column)]
+        else:
+            raise ValueError("Unknown sort direction, must be 'desc' or "
+                             "'asc'")
+        used_keys += [sort_key]
+
+    query = query.order_by(*order_criterions)
+    if marker is not None:
+        query = query.marker([getattr(marker, key) for key in used_keys])
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
 class RiakModelQuery:
 
     _funcs = []
     _initial_models = []
     _models = []
     _criterions = []
+    _order_by = []
+    _limit = None
+    _offset = None
+    _marker = None
+    _yield_per = None
 
     def all_selectable_are_functions(self):
         return all(x._is_function for x in [y for y in self._models if not y.is_hidden])
@@ -324,15 +371,20 @@ class RiakModelQuery:
         self._models = []
         self._criterions = []
         self._funcs = []
+        self._order_by = kwargs.get("order_by", [])
+        self._limit = kwargs.get("limit")
+        self._offset = kwargs.get("offset")
+        self._marker = kwargs.get("marker")
+        self._yield_per = kwargs.get("yield_per")
 
         base_model = None
         if kwargs.has_key("base_model"):
             base_model = kwargs.get("base_model")
         for arg in args:
-            if "count" in str(arg) or "sum" in str(arg):
-                function_name = re.sub("\(.*\)", "", str(arg))
-                field_id = re.sub("\)", "", re.sub(".*\(", "", str(arg)))
-                self._models += [Selection(None, None, is_function=True, function=Function(function_name, field_id))]
+            if aggregates.is_aggregate(arg):
+                function = Function(arg.name,
+                                    aggregates.get_aggregate_column(arg))
+                self._models += [Selection(None, None, is_function=True, function=function)]
             elif self.find_table_name(arg) != "none":
                 arg_as_text = "%s" % (arg)
                 attribute_name = "*"
@@ -385,6 +437,448 @@ class RiakModelQuery:
 
         return "none"
 
+    def extract_binary_expressions(self, criterions=None):
+        """Returns the binary expressions that must be satisfied by every
+        row of the query: only expressions that are combined with an "AND"
+        are returned."""
+
+        if criterions is None:
+            criterions = self._criterions
+
+        result = []
+        for criterion in criterions:
+            if isinstance(criterion, BinaryExpression):
+                result += [criterion]
+            elif hasattr(criterion, "is_boolean_expression"):
+                is_conjunction = (criterion.operator == "AND" or
+                    (criterion.operator == "NORMAL" and
+                     len(criterion.exps) == 1)
+                )
+                if is_conjunction:
+                    result += self.extract_binary_expressions(criterion.exps)
+        return result
+
+    def find_indexed_keys(self, model):
+        """Use the secondary indexes to find the keys of the objects of the
+        given model that may satisfy the criterions of the query.
+        :param model: a model class
+        :return: a set of keys, or None if no criterion can be answered with
+        an index (the whole table has then to be scanned)
+        """
+
+        if not hasattr(model, "__table__"):
+            return None
+
+        lookups = []
+        for expression in self.extract_binary_expressions():
+            lookup = indexes.extract_index_lookup(expression, model)
+            if lookup is not None:
+                lookups += [lookup]
+
+        if len(lookups) == 0 or not indexes.ensure_table_indexed(model):
+            return None
+
+        candidate_keys = None
+        try:
+            for (column_name, values) in lookups:
+                keys = indexes.find_keys(model, column_name, values)
+                if candidate_keys is None:
+                    candidate_keys = keys
+                else:
+                    candidate_keys = candidate_keys & keys
+        except Exception:
+            traceback.print_exc()
+            return None
+
+        return candidate_keys
+
+    def query_options(self):
+        """Returns the sort and pagination options of the query, so that they
+        can be given to the queries derived from it."""
+
+        return {
+            "order_by": self._order_by,
+            "limit": self._limit,
+            "offset": self._offset,
+            "marker": self._marker,
+            "yield_per": self._yield_per
+        }
+
+    def get_sort_key(self, row):
+        """Returns the key used to sort the given row."""
+
+        values = []
+        for (tablename, column_name, descending) in self._order_by:
+            obj = row
+            if isinstance(row, KeyedTuple) and tablename is not None:
+                obj = getattr(row, tablename.capitalize(), row)
+            values += [normalize_sort_value(getattr(obj, column_name, None))]
+        return SortKey(values, [x[2] for x in self._order_by])
+
+    def get_marker_key(self):
+        """Returns the key used to sort the marker of the query, or None if
+        the query has no marker."""
+
+        if self._marker is None or len(self._order_by) == 0:
+            return None
+        return SortKey([normalize_sort_value(x) for x in self._marker],
+                       [x[2] for x in self._order_by])
+
+    def paginate_rows(self, rows):
+        """Sort the given rows, and returns the page of rows selected by the
+        marker, the offset and the limit of the query. When the query has a
+        limit, only the first rows are sorted (with a heap)."""
+
+        marker_key = self.get_marker_key()
+        if marker_key is not None:
+            rows = [row for row in rows
+                    if marker_key < self.get_sort_key(row)]
+
+        offset = self._offset or 0
+        if len(self._order_by) > 0:
+            if self._limit is not None:
+                rows = heapq.nsmallest(offset + self._limit, rows,
+                                       key=self.get_sort_key)
+            else:
+                rows = sorted(rows, key=self.get_sort_key)
+
+        if self._limit is not None:
+            return rows[offset:offset + self._limit]
+        return rows[offset:]
+
+    def find_ordered_index(self, model_set):
+        """Check if the rows of the query can be read in order from an
+        ordered index: the query must select a single model, be sorted by the
+        columns of an ordered index, and have a limit.
+        :return: a tuple (columns, descending) describing the index, or None
+        """
+
+        if self._limit is None or len(model_set) != 1:
+            return None
+        if self.all_selectable_are_functions():
+            return None
+
+        model = model_set[0]._model
+        if not hasattr(model, "__table__"):
+            return None
+
+        order_by = []
+        for (tablename, column_name, descending) in self._order_by:
+            if tablename is not None and tablename != model.__tablename__:
+                return None
+            order_by += [(column_name, descending)]
+
+        ordered_index = indexes.find_ordered_index(model, order_by)
+        if ordered_index is None:
+            return None
+        if self._marker is not None and \
+                len(self._marker) != len(ordered_index[0]):
+            return None
+        if not indexes.ensure_table_indexed(model):
+            return None
+        return ordered_index
+
+    def compute_aggregates(self):
+        """Compute the aggregates selected by the query over the stored values
+        of the objects, which are not desimplified, or read them from their
+        counters when they are maintained. Returns None if the aggregates
+        cannot be computed this way (the query involves several tables, or
+        criterions that cannot be compiled)."""
+
+        model_set = extract_models(self._models)
+        if len(model_set) != 1 or \
+                not hasattr(model_set[0]._model, "__tablename__"):
+            return None
+        model = model_set[0]._model
+        tablename = model.__tablename__
+
+        functions = [x._function for x in self._models if x._is_function]
+        for function in functions:
+            if function._field is not None and \
+                    function._field.split(".")[0] != tablename:
+                return None
+        for criterion in self._criterions:
+            tables = find_referenced_tables(criterion)
+            if tables is None or not tables <= set([tablename]):
+                return None
+
+        counted = aggregates.read_counters(
+            tablename,
+            [(x._name, x._field) for x in functions],
+            self._criterions
+        )
+        if counted is not None:
+            return counted
+
+        values = self.find_stored_values(model)
+        if values is None:
+            return None
+        rows = [aggregates.RawObject(value) for value in values]
+        return [x._function(rows) for x in functions]
+
+    def find_stored_values(self, model):
+        """Returns the stored values of the objects of the given model that
+        satisfy the criterions of the query, which are evaluated on the
+        stored values without desimplifying them. Returns None if the
+        criterions cannot be evaluated this way (they involve other tables,
+        or cannot be compiled)."""
+
+        tablename = model.__tablename__
+        for criterion in self._criterions:
+            tables = find_referenced_tables(criterion)
+            if tables is None or not tables <= set([tablename]):
+                return None
+
+        try:
+            predicates = [compile_criterion(x) for x in self._criterions]
+        except NotImplementedError:
+            return None
+
+        label = tablename.capitalize()
+        keys = self.find_indexed_keys(model)
+        result = []
+        for value in get_objects(tablename, desimplify=False, keys=keys):
+            row = KeyedTuple([aggregates.RawObject(value)], labels=[label])
+            if all(predicate(row) for predicate in predicates):
+                result += [value]
+        return result
+
+    def stream_rows(self):
+        """Returns an iterator over the rows of the query, which are produced
+        lazily: keys are read from the key index (or the secondary indexes),
+        their objects are fetched by batches, filtered on their stored
+        values, and only the matching objects are desimplified. Iterating
+        stops fetching as soon as the limit of the query is reached. Returns
+        None if the query cannot be streamed (it involves several tables,
+        aggregates or a sort order)."""
+
+        model_set = extract_models(self._models)
+        showable_selection = [x for x in self._models
+                              if not x.is_hidden or x._is_function]
+        if len(model_set) != 1 or len(showable_selection) != 1 or \
+                showable_selection[0]._is_function or \
+                len(self._order_by) > 0:
+            return None
+        model = model_set[0]._model
+        if not hasattr(model, "__tablename__") or \
+                showable_selection[0]._model is not model:
+            return None
+        return self.iter_selected_rows(model, showable_selection[0])
+
+    def iter_selected_rows(self, model, selection):
+        """Generator of the rows of a query that selects a single model (see
+        stream_rows)."""
+
+        try:
+            from desimplifier import ObjectDesimplifier
+        except:
+            pass
+
+        tablename = model.__tablename__
+        label = tablename.capitalize()
+
+        """Criterions that can be compiled are evaluated on the stored
+        values; the other ones on the desimplified objects."""
+        predicates = []
+        object_criterions = []
+        for criterion in self._criterions:
+            tables = find_referenced_tables(criterion)
+            try:
+                if tables is None or not tables <= set([tablename]):
+                    raise NotImplementedError()
+                predicates += [compile_criterion(criterion)]
+            except NotImplementedError:
+                object_criterions += [criterion]
+
+        offset = self._offset or 0
+        remaining = self._limit
+        if remaining is not None and remaining <= 0:
+            return
+
+        """Without yield_per, the first batch is as large as the requested
+        page, and the next ones grow: a query whose first rows match is
+        answered without fetching the rest of the table."""
+        batch_size = self._yield_per
+        max_batch_size = None
+        if batch_size is None and remaining is not None:
+            batch_size = offset + remaining
+            max_batch_size = MULTIGET_BATCH_SIZE
+
+        object_desimplifier = ObjectDesimplifier(request_uuid=uuid.uuid1())
+        keys = self.find_indexed_keys(model)
+        for (key, value) in iter_stored_values(tablename, keys=keys,
+                                               batch_size=batch_size,
+                                               max_batch_size=max_batch_size):
+            raw_row = KeyedTuple([aggregates.RawObject(value)],
+                                 labels=[label])
+            if not all(predicate(raw_row) for predicate in predicates):
+                continue
+            try:
+                obj = object_desimplifier.desimplify(value)
+            except Exception:
+                LOG.exception("failed to desimplify %s %s", tablename, key)
+                continue
+            row = KeyedTuple([obj], labels=[label])
+            if not all(x.evaluate(row) for x in object_criterions):
+                continue
+
+            if offset > 0:
+                offset -= 1
+                continue
+            if selection._attributes != "*":
+                yield getattr(obj, selection._attributes)
+            else:
+                yield obj
+            if remaining is not None:
+                remaining -= 1
+                if remaining == 0:
+                    return
+
+    def scan_ordered_index(self, model, ordered_index, request_uuid):
+        """Returns the page of rows of the query, by reading the keys of the
+        given ordered index page by page: reading stops as soon as the page
+        is complete, so that only a few objects are fetched."""
+
+        (columns, descending) = ordered_index
+        tablename = model.__tablename__
+        label = tablename.capitalize()
+
+        candidate_keys = self.find_indexed_keys(model)
+
+        """The index is read from the first object that shares the sort value
+        of the first column of the marker: objects that do not follow the
+        marker are skipped when they are read."""
+        start_term = None
+        marker_key = self.get_marker_key()
+        if marker_key is not None:
+            start_term = indexes.compute_start_term(columns, self._marker,
+                                                    descending)
+
+        offset = self._offset or 0
+        wanted = offset + self._limit
+        page_size = min(max(wanted, 1), MULTIGET_BATCH_SIZE)
+
+        rows = []
+        for keys in indexes.iter_ordered_keys(model, columns, descending,
+                                              start_term, page_size):
+            if candidate_keys is not None:
+                keys = [key for key in keys if key in candidate_keys]
+            objects = dict([
+                (obj.id, obj) for obj in get_objects(tablename,
+                                                     request_uuid=request_uuid,
+                                                     keys=keys)
+            ])
+            for key in keys:
+                if not key in objects:
+                    continue
+                if marker_key is not None and \
+                        not marker_key < self.get_sort_key(objects[key]):
+                    continue
+                row = KeyedTuple([objects[key]], labels=[label])
+                if all(x.evaluate(row) for x in self._criterions):
+                    rows += [objects[key]]
+            if len(rows) >= wanted:
+                break
+
+        return rows[offset:wanted]
+
+    def find_equi_joins(self, tablenames):
+        """Returns the equality predicates of the query that link columns of
+        two different tables among the given tables (for instance
+        "InstanceInfoCache.instance_uuid == Instance.uuid"). Tables that are
+        joined several times are left out, as a predicate cannot tell which
+        of their copies it targets.
+        :param tablenames: the names of the joined tables
+        :return: a list of tuples (left_table, left_column, right_table,
+        right_column)
+        """
+
+        result = []
+        for expression in self.extract_binary_expressions():
+            if expression.operator is not operators.eq:
+                continue
+            left_table = getattr(expression.left, "table", None)
+            right_table = getattr(expression.right, "table", None)
+            if left_table is None or right_table is None:
+                continue
+            if left_table.name == right_table.name:
+                continue
+            if not (tablenames.count(left_table.name) == 1 and
+                    tablenames.count(right_table.name) == 1):
+                continue
+            result += [(left_table.name, expression.left.name,
+                        right_table.name, expression.right.name)]
+        return result
+
+    def join_objects(self, model_set, list_results):
+        """Join the objects fetched for each selected model. Criterions that
+        only concern a single table are applied before the join, and tables
+        are joined with a hash join when an equality predicate links them (a
+        cartesian product is only used when no such predicate exists).
+        :param model_set: the selected models
+        :param list_results: for each selected model, the list of its objects
+        :return: a tuple (products, remaining_criterions) where products is
+        an iterator over tuples of joined objects (one per selected model)
+        and remaining_criterions the criterions that still have to be
+        checked on the joined tuples
+        """
+
+        tablenames = [find_table_name(x._model) for x in model_set]
+        labels = [tablename.capitalize() for tablename in tablenames]
+
+        if len(tablenames) == 0:
+            return (iter([]), self._criterions)
+
+        # push down criterions that concern a single table (a table selected
+        # several times is filtered on the joined rows, as the criterion may
+        # target any of its copies)
+        filtered_results = [list(objects) for objects in list_results]
+        remaining_criterions = []
+        for criterion in self._criterions:
+            tables = find_referenced_tables(criterion)
+            if tables is not None and len(tables) == 1 and \
+                    tablenames.count(list(tables)[0]) == 1:
+                index = tablenames.index(list(tables)[0])
+                label = labels[index]
+                filtered_results[index] = [
+                    obj for obj in filtered_results[index]
+                    if criterion.evaluate(KeyedTuple([obj], labels=[label]))
+                ]
+            else:
+                remaining_criterions += [criterion]
+
+        equi_joins = self.find_equi_joins(tablenames)
+
+        # join the tables one after the other
+        products = [[obj] + [None] * (len(tablenames) - 1)
+                    for obj in filtered_results[0]]
+        for index in range(1, len(tablenames)):
+            predicates = []
+            for (left_table, left_column, right_table, right_column) in \
+                    equi_joins:
+                if left_table == tablenames[index] and \
+                        tablenames.index(right_table) < index:
+                    predicates += [(tablenames.index(right_table),
+                                    right_column, left_column)]
+                elif right_table == tablenames[index] and \
+                        tablenames.index(left_table) < index:
+                    predicates += [(tablenames.index(left_table),
+                                    left_column, right_column)]
+
+            if len(predicates) > 0:
+                products = hash_join(products, filtered_results[index],
+                                     index, predicates)
+            else:
+                products = nested_loop_join(products,
+                                            filtered_results[index], index)
+
+            # intermediate results are kept, so that the size of both sides
+            # of the next join is known
+            if index < len(tablenames) - 1:
+                products = list(products)
+
+        return ((tuple(product) for product in products), remaining_criterions)
+
     def construct_rows(self):
 
         """This function constructs the rows that corresponds to the current query.
@@ -449,6 +943,11 @@ class RiakModelQuery:
                 model_name = self.find_table_name(selectables[0]._model).capitalize()
                 return getattr(row, model_name)
 
+        # aggregates are computed without desimplifying objects
+        if self.all_selectable_are_functions():
+            aggregated = self.compute_aggregates()
+            if aggregated is not None:
+                return [aggregated]
 
         request_uuid = uuid.uuid1()
 
@@ -482,29 +981,59 @@ class RiakModelQuery:
                 if attribute is not None:
                     columns.add(attribute)
 
-        # construct the cartesian product
-        list_results = []
-        for selectable in model_set:
-            tablename = find_table_name(selectable._model)
-            objects = get_objects(tablename, request_uuid=request_uuid)
-            list_results += [objects]
-
-        # construct the cartesian product
-        cartesian_product = []
-        for element in itertools.product(*list_results):
-            cartesian_product += [element]
-
-        # filter elements of the cartesian product
-        for product in cartesian_product:
-            if len(product) > 0:
-                row = KeyedTuple(product, labels=labels)
-                all_criterions_satisfied = True
-
-                for criterion in self._criterions:
-                    if not criterion.evaluate(row):
-                        all_criterions_satisfied = False
-                if all_criterions_satisfied and not row in rows:
-                    rows += [extract_sub_row(row, model_set)]
+        # rows sorted by the columns of an ordered index are read from this
+        # index, until the requested page is complete
+        ordered_index = self.find_ordered_index(model_set)
+        if ordered_index is not None:
+            rows = self.scan_ordered_index(model_set[0]._model,
+                                           ordered_index, request_uuid)
+        else:
+            # fetch the objects of each table
+            list_results = []
+            for selectable in model_set:
+                tablename = find_table_name(selectable._model)
+                keys = self.find_indexed_keys(selectable._model)
+                values = None
+                if keys is None:
+                    # the request keeps the values of the scanned table, so
+                    # that the relationships of its objects resolved by the
+                    # value of a field do not scan it again
+                    values = scan_table(tablename, [request_uuid])
+                objects = get_objects(tablename, request_uuid=request_uuid,
+                                      keys=keys, values=values)
+                list_results += [objects]
+
+            # join the tables, and filter the joined rows with the criterions
+            # that could not be applied to a single table
+            (joined_products, remaining_criterions) = self.join_objects(
+                model_set,
+                list_results
+            )
+
+            # without sort order, the rows that follow the requested page are
+            # not needed
+            paginated = not self.all_selectable_are_functions()
+            max_rows = None
+            if paginated and self._limit is not None and \
+                    len(self._order_by) == 0:
+                max_rows = (self._offset or 0) + self._limit
+
+            for product in joined_products:
+                if max_rows is not None and len(rows) >= max_rows:
+                    break
+                if len(product) > 0:
+                    row = KeyedTuple(product, labels=labels)
+                    all_criterions_satisfied = True
+
+                    for criterion in remaining_criterions:
+                        if not criterion.evaluate(row):
+                            all_criterions_satisfied = False
+                            break
+                    if all_criterions_satisfied and not row in rows:
+                        rows += [extract_sub_row(row, model_set)]
+
+            if paginated:
+                rows = self.paginate_rows(rows)
 
         final_rows = []
         showable_selection = [x for x in self._models if (not x.is_hidden) or x._is_function]
@@ -555,11 +1084,9 @@ class RiakModelQuery:
         return result
 
     def first(self):
-        rows = self.all()
-        if len(rows) > 0:
-            return rows[0]
-        else:
-            None
+        for row in self.limit(1):
+            return row
+        return None
 
     def exists(self):
         return self.first() is not None
@@ -568,10 +1095,101 @@ class RiakModelQuery:
         return len(self.all())
 
     def soft_delete(self, synchronize_session=False):
-        return self
+        """Soft delete the objects selected by the query, as the soft_delete
+        of oslo.db: their deleted column is set to their id. Returns the
+        number of deleted objects."""
+
+        values = {
+            "deleted": literal_column("id"),
+            "updated_at": literal_column("updated_at"),
+            "deleted_at": timeutils.utcnow()
+        }
+        count = self.update_stored_values(values, deleted=True)
+        if count is not None:
+            return count
+
+        rows = self.all()
+        for row in rows:
+            row.soft_delete(None)
+        return len(rows)
+
+    def update_stored_values(self, values, deleted=False):
+        """Apply the given values on the stored values of the objects
+        selected by the query, and write them with a single batch: objects
+        are neither desimplified nor simplified again. Returns the number of
+        selected objects, or None if the update cannot be done this way (the
+        query involves several tables, or the values are not plain values of
+        columns).
+        :param deleted: True if the objects are soft deleted
+        """
+
+        model_set = extract_models(self._models)
+        if len(model_set) != 1 or \
+                not hasattr(model_set[0]._model, "__tablename__"):
+            return None
+        model = model_set[0]._model
+        tablename = model.__tablename__
+        columns = model.__table__.columns.keys()
+
+        """Values are simplified once, as they are stored; a column clause
+        (e.g. literal_column("id")) copies the value of another column."""
+        request_uuid = uuid.uuid1()
+        object_simplifier = ObjectSimplifier(request_uuid)
+        simplified_values = {}
+        copied_columns = {}
+        try:
+            for (field, value) in values.items():
+                if not isinstance(field, basestring) or not field in columns:
+                    return None
+                if isinstance(value, ColumnClause):
+                    if not value.name in columns:
+                        return None
+                    copied_columns[field] = value.name
+                elif isinstance(value, ClauseElement):
+                    return None
+                else:
+                    simplified_values[field] = object_simplifier.simplify(value)
+            now = object_simplifier.simplify(timeutils.utcnow())
+        finally:
+            release_caches(request_uuid)
+
+        stored_values = self.find_stored_values(model)
+        if stored_values is None:
+            return None
+
+        keys = [value["id"] for value in stored_values]
+        known_versions = batch.load_versions(tablename, keys)
+        write_batch = batch.WriteBatch()
+        for key in keys:
+            (vclock, existing_value) = known_versions[key]
+            if existing_value is None:
+                continue
+
+            new_value = dict(existing_value)
+            new_value.update(simplified_values)
+            for (field, copied_field) in copied_columns.items():
+                new_value[field] = existing_value.get(copied_field)
+            changed_fields = [field for field in values
+                              if existing_value.get(field) != new_value[field]]
+            if len(changed_fields) == 0 and not deleted:
+                continue
+
+            if not "updated_at" in values:
+                new_value["updated_at"] = now
+                changed_fields += ["updated_at"]
+            versions.stamp_changes(new_value, existing_value, changed_fields)
+            write_batch.add(tablename, key, vclock, existing_value, new_value,
+                            model, deleted=deleted)
+        write_batch.flush()
+        return len(keys)
 
     def update(self, values, synchronize_session='evaluate'):
 
+        count = self.update_stored_values(values)
+        if count is not None:
+            return count
+
+
         try:
             from desimplifier import ObjectDesimplifier
         except:
@@ -584,10 +1202,12 @@ class RiakModelQuery:
 
             print("[DEBUG-UPDATE] I shall update %s@%s with %s" % (str(id), tablename, values))
 
-            object_bucket = dbClient.bucket(tablename)
+            object_bucket = get_client().bucket(tablename)
 
             key_as_string = "%d" % (id)
-            data = object_bucket.get(key_as_string).data
+            fetched = object_bucket.get(key_as_string)
+            versions.remember_object(tablename, fetched)
+            data = fetched.data
 
             for key in values:
                 data[key] = values[key]
@@ -622,7 +1242,7 @@ class RiakModelQuery:
                     # create a binary expression
                     traceback.print_exc()
         args = self._models + _func + _criterions + self._initial_models
-        return RiakModelQuery(*args)
+        return RiakModelQuery(*args, **self.query_options())
 
     def filter_dict(self, filters):
         return self.filter_by(**filters)
@@ -634,7 +1254,7 @@ class RiakModelQuery:
         for criterion in criterions:
             _criterions += [criterion]
         args = self._models + _func + _criterions + self._initial_models
-        return RiakModelQuery(*args)
+        return RiakModelQuery(*args, **self.query_options())
 
     def join(self, *args, **kwargs):
         _func = self._funcs[:]
@@ -660,7 +1280,7 @@ class RiakModelQuery:
                 else:
                     pass
         args = _models + _func + _criterions + self._initial_models
-        return RiakModelQuery(*args)
+        return RiakModelQuery(*args, **self.query_options())
 
     def outerjoin(self, *args, **kwargs):
         return self.join(*args, **kwargs)
@@ -671,7 +1291,7 @@ class RiakModelQuery:
         _criterions = self._criterions[:]
         _initial_models = self._initial_models[:]
         args = _models + _func + _criterions + _initial_models
-        return RiakModelQuery(*args)
+        return RiakModelQuery(*args, **self.query_options())
 
     def order_by(self, *criterion):
         _func = self._funcs[:]
@@ -679,7 +1299,36 @@ class RiakModelQuery:
         _criterions = self._criterions[:]
         _initial_models = self._initial_models[:]
         args = _models + _func + _criterions + _initial_models
-        return RiakModelQuery(*args)
+        options = self.query_options()
+        options["order_by"] = self._order_by + [
+            x for x in map(extract_order_criterion, criterion) if x is not None
+        ]
+        return RiakModelQuery(*args, **options)
+
+    def limit(self, limit):
+        args = self._models + self._funcs + self._criterions + \
+            self._initial_models
+        options = self.query_options()
+        options["limit"] = limit
+        return RiakModelQuery(*args, **options)
+
+    def offset(self, offset):
+        args = self._models + self._funcs + self._criterions + \
+            self._initial_models
+        options = self.query_options()
+        options["offset"] = offset
+        return RiakModelQuery(*args, **options)
+
+    def marker(self, values):
+        """Returns a query whose rows are the rows that follow (according to
+        the sort order of the query) a row whose sorted columns have the given
+        values."""
+
+        args = self._models + self._funcs + self._criterions + \
+            self._initial_models
+        options = self.query_options()
+        options["marker"] = list(values)
+        return RiakModelQuery(*args, **options)
 
     def with_lockmode(self, mode):
         return self
@@ -691,7 +1340,20 @@ class RiakModelQuery:
         _criterions = self._criterions[:]
         _initial_models = self._initial_models[:]
         args = _models + _func + _criterions + _initial_models
-        return RiakModelQuery(*args).all()
+        return RiakModelQuery(*args, **self.query_options()).all()
+
+    def yield_per(self, count):
+        """Returns a query whose rows are fetched by batches of the given
+        size when it is iterated."""
+
+        args = self._models + self._funcs + self._criterions + \
+            self._initial_models
+        options = self.query_options()
+        options["yield_per"] = count
+        return RiakModelQuery(*args, **options)
 
     def __iter__(self):
-        return iter(self.all())
+        rows = self.stream_rows()
+        if rows is None:
+            rows = iter(self.all())
+        return rows
@@ -7,12 +7,22 @@ simplification of objects, before storing them into the discovery database.
 
 from nova.db.discovery.utils import merge_dicts
 from nova.db.discovery.utils import is_novabase
+from nova.db.discovery.cache import release_request
+from nova.db.discovery.cache import RequestCacheManager
 
+import calendar
 import uuid
 
-SIMPLE_CACHES = {}
-COMPLEX_CACHES = {}
-TARGET_CACHES = {}
+SIMPLE_CACHES = RequestCacheManager("simple")
+COMPLEX_CACHES = RequestCacheManager("complex")
+TARGET_CACHES = RequestCacheManager("target")
+
+
+def release_caches(request_uuid):
+    """Forget the simplification caches of the given request."""
+
+    release_request(request_uuid,
+                    [SIMPLE_CACHES, COMPLEX_CACHES, TARGET_CACHES])
 
 
 def extract_adress(obj):
@@ -33,21 +43,10 @@ class ObjectSimplifier(object):
     dictionnaries, novabase objects, ...) to a representation that can
     be stored in database."""
 
-    def __init__(self, request_uuid=uuid.uuid1()):
+    def __init__(self, request_uuid=None):
         self.request_uuid = (request_uuid if request_uuid is not None
             else uuid.uuid1()
         )
-        if not SIMPLE_CACHES.has_key(self.request_uuid):
-            SIMPLE_CACHES[self.request_uuid] = {}
-        if not COMPLEX_CACHES.has_key(self.request_uuid):
-            COMPLEX_CACHES[self.request_uuid] = {}
-        if not TARGET_CACHES.has_key(self.request_uuid):
-            TARGET_CACHES[self.request_uuid] = {}
-
-        self.simple_cache = SIMPLE_CACHES[self.request_uuid]
-        self.complex_cache = COMPLEX_CACHES[self.request_uuid]
-        self.target_cache = TARGET_CACHES[self.request_uuid]
-
         self.reset()
 
     def get_cache_key(self, obj):
@@ -76,7 +75,7 @@ class ObjectSimplifier(object):
 
         return {
             "simplify_strategy": "datetime",
-            "value": datetime_ref.strftime('%b %d %Y %H:%M:%S'),
+            "epoch": calendar.timegm(datetime_ref.timetuple()),
             "timezone" : str(datetime_ref.tzinfo)
         }
 
@@ -132,7 +131,7 @@ class ObjectSimplifier(object):
 
         if not self.already_processed(obj):
 
-            obj.update_foreign_keys()
+            obj.update_foreign_keys(self.request_uuid)
             key = self.get_cache_key(obj)
 
             if self.simple_cache.has_key(key):
@@ -260,9 +259,9 @@ class ObjectSimplifier(object):
     def reset(self):
         """Reset the caches of the current instance of Simplifier."""
 
-        self.simple_cache = {}
-        self.complex_cache = {}
-        self.target_cache = {}
+        self.simple_cache = SIMPLE_CACHES.reset(self.request_uuid)
+        self.complex_cache = COMPLEX_CACHES.reset(self.request_uuid)
+        self.target_cache = TARGET_CACHES.reset(self.request_uuid)
 
     def simplify(self, obj):
         """Simplify the given object."""
@@ -0,0 +1,430 @@
+"""Storage module.
+
+This module contains storages that stand in for a Riak cluster, so that the
+discovery database backend can run (and be measured) without a Riak node:
+objects are kept in memory, or in a sqlite database shared by the processes
+that use the same file.
+
+A storage is used through a Riak client whose operations are served by a
+StorageTransport instead of the connections of the client: buckets, objects,
+siblings, resolvers and codecs are those of the Riak client library, and only
+the exchanges with the cluster are emulated. The transport reproduces the
+behaviour that the backend relies on:
+
+- objects are written with the vector clock that was read: on a bucket that
+  allows siblings, a write that does not descend from every stored sibling
+  creates a new sibling;
+- secondary indexes support equality and range queries, with pagination;
+- counters are incremented atomically.
+
+"""
+
+import contextlib
+import cPickle as pickle
+import json
+import threading
+
+from riak.content import RiakContent
+from riak.riak_object import VClock
+
+from nova.db.discovery.client import DiscoveryRiakClient
+
+DEFAULT_BUCKET_PROPS = {"allow_mult": False, "last_write_wins": False,
+                        "n_val": 1}
+
+
+def normalize_term(index, term):
+    """Integer indexes (*_int) are compared as integers, other indexes as
+    strings, as Riak does."""
+
+    if index.endswith("_int"):
+        return int(term)
+    return str(term)
+
+
+class MemoryStorage(object):
+    """Storage that keeps objects, indexes and counters in the memory of the
+    process. A record of an object is a tuple (version, content_type,
+    encoded_data, indexes)."""
+
+    def __init__(self):
+        """Constructor"""
+
+        self.lock = threading.RLock()
+        """(bucket, key) -> list of records"""
+        self.objects = {}
+        """(bucket, index) -> term -> set of keys"""
+        self.indexes = {}
+        self.counters = {}
+        self.props = {}
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            yield
+
+    def read_object(self, bucket, key):
+        """Returns the records of an object (an empty list if it does not
+        exist)."""
+
+        with self.lock:
+            return list(self.objects.get((bucket, key), []))
+
+    def write_object(self, bucket, key, records):
+        """Replace the records of an object: an empty list deletes it."""
+
+        with self.lock:
+            for record in self.objects.get((bucket, key), []):
+                for (index, term) in record[3]:
+                    keys = self.indexes.get((bucket, index), {}).get(term)
+                    if keys is not None:
+                        keys.discard(key)
+            if len(records) == 0:
+                self.objects.pop((bucket, key), None)
+                return
+            self.objects[(bucket, key)] = list(records)
+            for record in records:
+                for (index, term) in record[3]:
+                    terms = self.indexes.setdefault((bucket, index), {})
+                    terms.setdefault(term, set()).add(key)
+
+    def query_index(self, bucket, index, start, end):
+        """Returns the sorted list of (term, key) of the objects whose index
+        has a term between start and end (end is None for equality)."""
+
+        with self.lock:
+            terms = self.indexes.get((bucket, index), {})
+            if end is None:
+                return [(start, key) for key in sorted(terms.get(start, []))]
+            result = []
+            for term in sorted(x for x in terms.keys() if start <= x <= end):
+                result += [(term, key) for key in sorted(terms[term])]
+            return result
+
+    def read_counter(self, bucket, key):
+        return self.counters.get((bucket, key))
+
+    def add_counter(self, bucket, key, value):
+        with self.lock:
+            self.counters[(bucket, key)] = \
+                self.counters.get((bucket, key), 0) + value
+            return self.counters[(bucket, key)]
+
+    def read_props(self, bucket):
+        return dict(DEFAULT_BUCKET_PROPS, **self.props.get(bucket, {}))
+
+    def write_props(self, bucket, props):
+        with self.lock:
+            self.props[bucket] = dict(self.props.get(bucket, {}), **props)
+
+
+"""Integer terms are stored by sqlite as strings of INTEGER_TERM_DIGITS digits
+that sort as the integers they represent (Riak integers are not bounded by the
+64 bits integers of sqlite)."""
+INTEGER_TERM_DIGITS = 64
+
+
+def encode_sqlite_term(index, term):
+    if not index.endswith("_int"):
+        return term
+    offset = 10 ** (INTEGER_TERM_DIGITS - 1)
+    return "%0*d" % (INTEGER_TERM_DIGITS, offset + term)
+
+
+def decode_sqlite_term(index, term):
+    if not index.endswith("_int"):
+        return str(term)
+    return int(term) - 10 ** (INTEGER_TERM_DIGITS - 1)
+
+
+class SqliteStorage(MemoryStorage):
+    """Storage that keeps objects, indexes and counters in a sqlite database,
+    which can be shared by several processes."""
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, "
+        "records BLOB, PRIMARY KEY (bucket, key))",
+        "CREATE TABLE IF NOT EXISTS indexes (bucket TEXT, name TEXT, "
+        "term TEXT, key TEXT)",
+        "CREATE INDEX IF NOT EXISTS indexes_terms ON indexes "
+        "(bucket, name, term)",
+        "CREATE INDEX IF NOT EXISTS indexes_keys ON indexes (bucket, key)",
+        "CREATE TABLE IF NOT EXISTS counters (bucket TEXT, key TEXT, "
+        "value INTEGER, PRIMARY KEY (bucket, key))",
+        "CREATE TABLE IF NOT EXISTS props (bucket TEXT PRIMARY KEY, "
+        "props TEXT)",
+    ]
+
+    def __init__(self, path):
+        """Constructor"""
+
+        import sqlite3
+
+        super(SqliteStorage, self).__init__()
+        self.path = path
+        self.depth = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False,
+                                          isolation_level=None)
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Operations of other processes are excluded by an immediate
+        transaction, operations of other threads by the lock. Nested
+        transactions are part of the outermost one."""
+
+        with self.lock:
+            outermost = self.depth == 0
+            if outermost:
+                self.connection.execute("BEGIN IMMEDIATE")
+            self.depth += 1
+            try:
+                yield
+            except Exception:
+                self.depth -= 1
+                if outermost:
+                    self.connection.execute("ROLLBACK")
+                raise
+            self.depth -= 1
+            if outermost:
+                self.connection.execute("COMMIT")
+
+    def read_object(self, bucket, key):
+        with self.transaction():
+            row = self.connection.execute(
+                "SELECT records FROM objects WHERE bucket = ? AND key = ?",
+                (bucket, key)).fetchone()
+        if row is None:
+            return []
+        return pickle.loads(str(row[0]))
+
+    def write_object(self, bucket, key, records):
+        import sqlite3
+
+        with self.transaction():
+            self.connection.execute(
+                "DELETE FROM indexes WHERE bucket = ? AND key = ?",
+                (bucket, key))
+            if len(records) == 0:
+                self.connection.execute(
+                    "DELETE FROM objects WHERE bucket = ? AND key = ?",
+                    (bucket, key))
+                return
+            self.connection.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?)",
+                (bucket, key, sqlite3.Binary(pickle.dumps(records, 2))))
+            entries = set()
+            for record in records:
+                entries |= set(record[3])
+            self.connection.executemany(
+                "INSERT INTO indexes VALUES (?, ?, ?, ?)",
+                [(bucket, index, encode_sqlite_term(index, term), key)
+                 for (index, term) in entries])
+
+    def query_index(self, bucket, index, start, end):
+        with self.transaction():
+            if end is None:
+                rows = self.connection.execute(
+                    "SELECT DISTINCT term, key FROM indexes WHERE "
+                    "bucket = ? AND name = ? AND term = ? ORDER BY key",
+                    (bucket, index, encode_sqlite_term(index, start)))
+            else:
+                rows = self.connection.execute(
+                    "SELECT DISTINCT term, key FROM indexes WHERE "
+                    "bucket = ? AND name = ? AND term >= ? AND term <= ? "
+                    "ORDER BY term, key",
+                    (bucket, index, encode_sqlite_term(index, start),
+                     encode_sqlite_term(index, end)))
+            return [(decode_sqlite_term(index, term), str(key))
+                    for (term, key) in rows.fetchall()]
+
+    def read_counter(self, bucket, key):
+        with self.transaction():
+            row = self.connection.execute(
+                "SELECT value FROM counters WHERE bucket = ? AND key = ?",
+                (bucket, key)).fetchone()
+        return row[0] if row is not None else None
+
+    def add_counter(self, bucket, key, value):
+        with self.transaction():
+            current = self.read_counter(bucket, key) or 0
+            self.connection.execute(
+                "INSERT OR REPLACE INTO counters VALUES (?, ?, ?)",
+                (bucket, key, current + value))
+        return current + value
+
+    def read_props(self, bucket):
+        with self.transaction():
+            row = self.connection.execute(
+                "SELECT props FROM props WHERE bucket = ?",
+                (bucket,)).fetchone()
+        props = json.loads(row[0]) if row is not None else {}
+        return dict(DEFAULT_BUCKET_PROPS, **props)
+
+    def write_props(self, bucket, props):
+        with self.transaction():
+            current = self.read_props(bucket)
+            current.update(props)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO props VALUES (?, ?)",
+                (bucket, json.dumps(current)))
+
+
+def get_version(vclock):
+    """Returns the version of the object described by a vector clock: the
+    highest version of the siblings that were read."""
+
+    if vclock is None:
+        return 0
+    return int(vclock.encode("binary"))
+
+
+class StorageTransport(object):
+    """Transport that serves the operations of a Riak client from a
+    storage."""
+
+    def __init__(self, storage):
+        """Constructor"""
+
+        self.storage = storage
+
+    def decode_records(self, robj, records):
+        """Set the siblings and the vector clock of a Riak object from the
+        records of a storage, and resolve its siblings."""
+
+        if len(records) == 0:
+            robj.siblings = []
+            return robj
+        siblings = []
+        for (version, content_type, encoded_data, indexes) in records:
+            sibling = RiakContent(robj, content_type=content_type,
+                                  indexes=set(indexes), exists=True)
+            sibling.encoded_data = encoded_data
+            siblings += [sibling]
+        robj.vclock = VClock(str(max(x[0] for x in records)), "binary")
+        robj.siblings = siblings
+        if len(robj.siblings) > 1 and robj.resolver is not None:
+            robj.resolver(robj)
+        return robj
+
+    def get(self, robj, **params):
+        records = self.storage.read_object(robj.bucket.name, robj.key)
+        return self.decode_records(robj, records)
+
+    def put(self, robj, return_body=True, **params):
+        bucket = robj.bucket.name
+        indexes = sorted((index, normalize_term(index, term))
+                         for (index, term) in robj.indexes)
+        with self.storage.transaction():
+            records = self.storage.read_object(bucket, robj.key)
+            props = self.storage.read_props(bucket)
+            seen_version = get_version(robj.vclock)
+            version = max([x[0] for x in records] + [seen_version]) + 1
+            record = (version, robj.content_type, str(robj.encoded_data),
+                      indexes)
+            if props.get("allow_mult") and \
+                    not props.get("last_write_wins"):
+                """Siblings that were not read by the writer are kept."""
+                records = [x for x in records if x[0] > seen_version]
+                records += [record]
+            else:
+                records = [record]
+            self.storage.write_object(bucket, robj.key, records)
+        if return_body:
+            self.decode_records(robj, records)
+        else:
+            robj.vclock = VClock(str(version), "binary")
+        return robj
+
+    def delete(self, robj, **params):
+        self.storage.write_object(robj.bucket.name, robj.key, [])
+        return robj
+
+    def get_index(self, bucket, index, startkey, endkey=None,
+                  return_terms=None, max_results=None, continuation=None,
+                  **params):
+        start = normalize_term(index, startkey)
+        end = normalize_term(index, endkey) if endkey is not None else None
+        entries = self.storage.query_index(bucket.name, index, start, end)
+
+        """The continuation is the last entry of the previous page."""
+        if continuation is not None:
+            (term, key) = json.loads(continuation)
+            entries = [x for x in entries if tuple(x) > (term, key)]
+        next_continuation = None
+        if max_results is not None and len(entries) > max_results:
+            entries = entries[:max_results]
+            next_continuation = json.dumps(list(entries[-1]))
+
+        if return_terms:
+            results = entries
+        else:
+            results = [key for (term, key) in entries]
+        return (results, next_continuation)
+
+    def get_bucket_props(self, bucket):
+        return self.storage.read_props(bucket.name)
+
+    def set_bucket_props(self, bucket, props):
+        self.storage.write_props(bucket.name, props)
+        return True
+
+    def get_counter(self, bucket, key, **params):
+        return self.storage.read_counter(bucket.name, key)
+
+    def update_counter(self, bucket, key, value, returnvalue=False,
+                       **params):
+        result = self.storage.add_counter(bucket.name, key, value)
+        if returnvalue:
+            return result
+        return True
+
+
+class StorageRiakClient(DiscoveryRiakClient):
+    """Riak client whose operations are served by a storage instead of a
+    Riak cluster."""
+
+    def __init__(self, storage, **kwargs):
+        """Constructor"""
+
+        super(StorageRiakClient, self).__init__(**kwargs)
+        self.storage = storage
+        self.storage_transport = StorageTransport(storage)
+
+    def _with_retries(self, pool, fn):
+        return fn(self.storage_transport)
+
+    @contextlib.contextmanager
+    def _transport(self):
+        yield self.storage_transport
+
+
+"""path -> storage: storages are shared by the clients of a process."""
+STORAGES = {}
+STORAGES_LOCK = threading.Lock()
+
+
+def get_storage(kind, path=None):
+    """Returns the storage of the given kind ("memory" or "sqlite")."""
+
+    if not kind in ["memory", "sqlite"]:
+        raise ValueError("unknown storage %s" % (kind))
+    with STORAGES_LOCK:
+        storage_key = (kind, path if kind == "sqlite" else None)
+        storage = STORAGES.get(storage_key)
+        if storage is None:
+            if kind == "memory":
+                storage = MemoryStorage()
+            else:
+                storage = SqliteStorage(path or ":memory:")
+            STORAGES[storage_key] = storage
+        return storage
+
+
+def reset_storages():
+    """Forget the storages of the process (objects of memory storages are
+    lost)."""
+
+    with STORAGES_LOCK:
+        STORAGES.clear()
@@ -0,0 +1,141 @@
+"""Table cache module.
+
+This module contains the read-through cache of the tables of the discovery
+database backend that are rarely written (flavors, their extra specs, quota
+classes, aggregates, ...). The stored values of the (non deleted) objects of
+such a table are kept in memory, with the version stamp of the table that was
+read before they were loaded.
+
+The stamp of a table is a Riak counter, which is incremented after each write
+of one of its objects: a cached table is served from memory as long as its
+stamp has not changed, which only costs the read of the counter.
+
+"""
+
+import threading
+
+from oslo.config import cfg
+
+from nova.db.discovery.client import get_client
+from nova.db.discovery import key_index
+from nova.openstack.common import log as logging
+
+table_cache_opts = [
+    cfg.ListOpt('cached_tables',
+                default=['instance_types', 'instance_type_extra_specs',
+                         'instance_type_projects', 'quota_classes',
+                         'aggregates', 'aggregate_hosts',
+                         'aggregate_metadata',
+                         'security_group_default_rules'],
+                help='Tables whose objects are cached in memory by each '
+                     'process, and validated with the version stamp of the '
+                     'table'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(table_cache_opts, group='discovery')
+
+LOG = logging.getLogger(__name__)
+
+TABLE_STAMPS_BUCKET = "table_stamps"
+
+
+def is_cached(tablename):
+    """Check if the objects of the given table are cached."""
+
+    return tablename in CONF.discovery.cached_tables
+
+
+CONFIGURED_BUCKETS = set()
+
+def get_stamps_bucket():
+    """Returns the bucket that contains the stamps of the tables: Riak
+    counters require siblings to be allowed on their bucket."""
+
+    stamps_bucket = get_client().bucket(TABLE_STAMPS_BUCKET)
+    if not TABLE_STAMPS_BUCKET in CONFIGURED_BUCKETS:
+        stamps_bucket.allow_mult = True
+        CONFIGURED_BUCKETS.add(TABLE_STAMPS_BUCKET)
+    return stamps_bucket
+
+
+def read_stamp(tablename):
+    """Returns the current version stamp of a table."""
+
+    return get_stamps_bucket().get_counter(tablename) or 0
+
+
+class TableCache(object):
+    """Class that keeps the stored values of the objects of cached tables."""
+
+    def __init__(self):
+        """Constructor"""
+
+        """tablename -> (stamp, {key: stored value})"""
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def get_values(self, tablename):
+        """Returns the stored values of the objects of a cached table, as a
+        dict key -> value, or None if the table is not cached (or its stamp
+        could not be read). The returned values must not be modified."""
+
+        if not is_cached(tablename):
+            return None
+        try:
+            stamp = read_stamp(tablename)
+        except Exception:
+            LOG.exception("could not read the stamp of %s" % (tablename))
+            return None
+
+        entry = self.tables.get(tablename)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+        """The stamp was read before the objects: if an object is written
+        during the scan, the stamp changes and the table is loaded again on
+        the next read."""
+        from nova.db.discovery.utils import fetch_stored_values
+        values = {}
+        for keys in key_index.iter_key_shards(tablename):
+            values.update(fetch_stored_values(tablename, keys))
+        with self.lock:
+            self.tables[tablename] = (stamp, values)
+        return values
+
+    def forget(self, tablename):
+        """Forget the objects of a table."""
+
+        with self.lock:
+            self.tables.pop(tablename, None)
+
+    def clear(self):
+        """Forget the objects of every table."""
+
+        with self.lock:
+            self.tables = {}
+
+
+TABLE_CACHE = TableCache()
+
+
+def get_table_values(tablename):
+    """Returns the stored values of the objects of a table if it is cached,
+    otherwise None."""
+
+    return TABLE_CACHE.get_values(tablename)
+
+
+def bump_stamp(tablename):
+    """Invalidate the cached objects of a table after one of its objects has
+    been written: its stamp is incremented, so that every process reloads
+    the table. The object must be stored (and the key index updated) before
+    the stamp is incremented."""
+
+    if not is_cached(tablename):
+        return
+    TABLE_CACHE.forget(tablename)
+    try:
+        get_stamps_bucket().update_counter(tablename, 1)
+    except Exception:
+        LOG.exception("could not increment the stamp of %s" % (tablename))
@@ -0,0 +1,289 @@
+"""Tracing module.
+
+This module contains the recorder of the calls to the database API. For each
+traced call, the recorder keeps the name of the function, its latency, the
+number of Riak operations it issued and the size of its result (the number of
+rows, or 1 for a single object). Statistics are aggregated per function, and
+the most recent traces are kept in a ring buffer, which can be flushed to a
+file by a background thread.
+
+The recorder has three modes:
+
+- "off": calls are not traced;
+- "sample": statistics are computed on every call, and a fraction of the
+  calls is kept in the ring buffer;
+- "full": every call is kept in the ring buffer.
+
+"""
+
+import collections
+import json
+import random
+import threading
+import time
+
+from oslo.config import cfg
+
+from nova.db.discovery.client import get_operation_count
+from nova.openstack.common import log as logging
+
+tracing_opts = [
+    cfg.StrOpt('trace_mode',
+               default='off',
+               help='Tracing of the calls to the database API: "off", '
+                    '"sample" or "full"'),
+    cfg.FloatOpt('trace_sample_rate',
+                 default=0.01,
+                 help='Fraction of the calls kept when trace_mode is '
+                      '"sample"'),
+    cfg.IntOpt('trace_buffer_size',
+               default=10000,
+               help='Number of traces kept in memory'),
+    cfg.StrOpt('trace_file',
+               default=None,
+               help='File to which traces are appended (one JSON document '
+                    'per line); traces are only kept in memory if unset'),
+    cfg.IntOpt('trace_flush_interval',
+               default=5,
+               help='Number of seconds between two flushes of the traces '
+                    'to the trace file'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(tracing_opts, group='discovery')
+
+LOG = logging.getLogger(__name__)
+
+TRACE_MODES = ["off", "sample", "full"]
+
+
+def get_result_size(result):
+    """Returns the size of the result of a call, without converting it into
+    a string: the number of rows of a list, 0 for None, 1 otherwise."""
+
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple, set, dict)):
+        return len(result)
+    return 1
+
+
+class CallStats(object):
+    """Statistics of the calls to a function."""
+
+    __slots__ = ["calls", "errors", "total_latency", "max_latency",
+                 "riak_operations", "result_size"]
+
+    def __init__(self):
+        """Constructor"""
+
+        self.calls = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.riak_operations = 0
+        self.result_size = 0
+
+    def as_dict(self):
+        calls = max(self.calls, 1)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "mean_latency_ms": 1000 * self.total_latency / calls,
+            "max_latency_ms": 1000 * self.max_latency,
+            "mean_riak_operations": float(self.riak_operations) / calls,
+            "mean_result_size": float(self.result_size) / calls
+        }
+
+
+class CallRecorder(object):
+    """Class that records the calls to the database API."""
+
+    def __init__(self, mode=None, sample_rate=None, buffer_size=None,
+                 trace_file=None, flush_interval=None):
+        """Constructor: options that are not given are read from the
+        configuration."""
+
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.trace_file = trace_file
+        self.flush_interval = flush_interval
+
+        self.buffer_size = buffer_size
+
+        """Ring buffers of the traces, and of the traces that have not been
+        flushed yet (created on the first trace, once the configuration has
+        been loaded)."""
+        self.traces = None
+        self.pending = None
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def get_mode(self):
+        if self.mode is not None:
+            return self.mode
+        return CONF.discovery.trace_mode
+
+    def set_mode(self, mode):
+        """Switch the recorder to the given mode ("off", "sample" or
+        "full")."""
+
+        if not mode in TRACE_MODES:
+            raise ValueError("unknown trace mode %s" % (mode))
+        self.mode = mode
+
+    def get_trace_file(self):
+        if self.trace_file is not None:
+            return self.trace_file
+        return CONF.discovery.trace_file
+
+    def call(self, name, function, *args, **kwargs):
+        """Call the given function, and record the call."""
+
+        mode = self.get_mode()
+        if mode == "off":
+            return function(*args, **kwargs)
+
+        operations = get_operation_count()
+        start = time.time()
+        failed = True
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            latency = time.time() - start
+            operations = get_operation_count() - operations
+            self.record(mode, name, start, latency, operations,
+                        get_result_size(result), failed)
+
+    def record(self, mode, name, start, latency, operations, result_size,
+               failed):
+        """Record a call in the statistics of its function, and in the ring
+        buffer if it is sampled."""
+
+        if mode == "full":
+            sampled = True
+        else:
+            sample_rate = self.sample_rate
+            if sample_rate is None:
+                sample_rate = CONF.discovery.trace_sample_rate
+            sampled = random.random() < sample_rate
+
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = CallStats()
+            stats.calls += 1
+            stats.errors += 1 if failed else 0
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+            stats.riak_operations += operations
+            stats.result_size += result_size
+
+            if sampled:
+                if self.traces is None:
+                    buffer_size = self.buffer_size or \
+                        CONF.discovery.trace_buffer_size
+                    self.traces = collections.deque(maxlen=buffer_size)
+                    self.pending = collections.deque(maxlen=buffer_size)
+                trace = (name, start, latency, operations, result_size,
+                         failed)
+                self.traces.append(trace)
+                if self.get_trace_file() is not None:
+                    self.pending.append(trace)
+                    self.start_flusher()
+
+    def start_flusher(self):
+        """Start the thread that flushes the traces, if it is not
+        running."""
+
+        if self.flusher is not None and self.flusher.is_alive():
+            return
+        self.flusher = threading.Thread(target=self.flush_periodically,
+                                        name="db-trace-flusher")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def flush_periodically(self):
+        while True:
+            interval = self.flush_interval
+            if interval is None:
+                interval = CONF.discovery.trace_flush_interval
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception("could not flush the traces of the database "
+                              "API")
+
+    def flush(self):
+        """Append the traces that have not been flushed yet to the trace
+        file."""
+
+        with self.lock:
+            traces = list(self.pending or [])
+            if self.pending is not None:
+                self.pending.clear()
+        trace_file = self.get_trace_file()
+        if len(traces) == 0 or trace_file is None:
+            return
+        lines = []
+        for (name, start, latency, operations, size, failed) in traces:
+            lines += [json.dumps({"function": name, "start": start,
+                                  "latency_ms": 1000 * latency,
+                                  "riak_operations": operations,
+                                  "result_size": size,
+                                  "failed": failed})]
+        with open(trace_file, "a") as output:
+            output.write("\n".join(lines) + "\n")
+
+    def get_traces(self):
+        """Returns the traces kept in the ring buffer, the oldest first."""
+
+        with self.lock:
+            return list(self.traces or [])
+
+    def get_stats(self):
+        """Returns the statistics of each traced function."""
+
+        with self.lock:
+            return dict((name, stats.as_dict())
+                        for (name, stats) in self.stats.items())
+
+    def reset(self):
+        """Forget the traces and the statistics."""
+
+        with self.lock:
+            self.traces = None
+            self.pending = None
+            self.stats = {}
+
+    def dump_stats(self, limit=20):
+        """Log the statistics of the functions that took the most time."""
+
+        stats = self.get_stats()
+        names = sorted(stats.keys(),
+                       key=lambda x: -stats[x]["mean_latency_ms"] *
+                       stats[x]["calls"])
+        for name in names[:limit]:
+            LOG.info("%s: %s" % (name, stats[name]))
+        return stats
+
+
+RECORDER = CallRecorder()
+
+
+def trace_call(name, function, *args, **kwargs):
+    """Call the given function of the database API, and record the
+    call."""
+
+    return RECORDER.call(name, function, *args, **kwargs)
+
+
+def get_trace_stats():
+    """Returns the statistics of the calls to the database API."""
+
+    return RECORDER.get_stats()
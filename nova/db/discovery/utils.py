@@ -7,10 +7,14 @@ discovery database backend.
 
 from oslo.db.sqlalchemy import models
 import traceback
-import riak
 import uuid
 
-RIAK_CLIENT = riak.RiakClient(pb_port=8087, protocol='pbc')
+from nova.db.discovery.client import get_client
+from nova.db.discovery import table_cache
+from nova.db.discovery import versions
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
 
 def merge_dicts(dict1, dict2):
     """Merge two dictionnaries into one dictionnary: the values containeds
@@ -59,20 +63,26 @@ def is_novabase(obj):
 
     return False
 
-def get_single_object(tablename, id, desimplify=True, request_uuid=None):
+"""Number of keys fetched with a single multiget request."""
+MULTIGET_BATCH_SIZE = 100
+
+def get_single_object(tablename, id, desimplify=True, request_uuid=None,
+                      object_desimplifier=None):
 
     try:
         from desimplifier import ObjectDesimplifier
     except:
         pass
 
-    if isinstance(id, int):
-        object_desimplifier = ObjectDesimplifier(request_uuid=request_uuid)
+    if isinstance(id, (int, long)):
+        if object_desimplifier is None:
+            object_desimplifier = ObjectDesimplifier(request_uuid=request_uuid)
 
-        object_bucket = RIAK_CLIENT.bucket(tablename)
+        object_bucket = get_client().bucket(tablename)
 
         key = "%d" % (id)
         value = object_bucket.get(key)
+        versions.remember_object(tablename, value)
 
         if desimplify:
             try:
@@ -86,34 +96,140 @@ def get_single_object(tablename, id, desimplify=True, request_uuid=None):
     else:
         return None
 
-def get_objects(tablename, desimplify=True, request_uuid=None):
+def fetch_values(tablename, keys, cached_values=None):
+    """Fetch the values associated to the given keys of a table. Objects of
+    cached tables are read from the table cache; other keys are fetched from
+    Riak.
+    :param tablename: the name of the table
+    :param keys: a list of integer keys
+    :param cached_values: the cached values of the table, if they have
+    already been read
+    :return: a dict that associates each found key to its stored value
+    """
+
+    if cached_values is None:
+        cached_values = table_cache.get_table_values(tablename)
+    if cached_values is None:
+        return fetch_stored_values(tablename, keys)
+
+    """Cached values are copied, as callers may modify them. Deleted objects
+    are not cached: they are fetched from Riak."""
+    result = dict((key, dict(cached_values[key])) for key in keys
+                  if key in cached_values)
+    missing_keys = [key for key in keys if not key in cached_values]
+    if len(missing_keys) > 0:
+        result.update(fetch_stored_values(tablename, missing_keys))
+    return result
+
+def fetch_stored_values(tablename, keys):
+    """Fetch the values associated to the given keys of a table from Riak.
+    Keys are fetched by batches: each batch is fetched with a multiget
+    request, whose parallel fetches are bounded by the size of the multiget
+    pool of the Riak client.
+    :param tablename: the name of the table
+    :param keys: a list of integer keys
+    :return: a dict that associates each found key to its stored value
+    """
+
+    object_bucket = get_client().bucket(tablename)
+    keys_as_string = ["%d" % (key) for key in keys]
+
+    result = {}
+    for offset in range(0, len(keys_as_string), MULTIGET_BATCH_SIZE):
+        batch = keys_as_string[offset:offset + MULTIGET_BATCH_SIZE]
+        for fetched in object_bucket.multiget(batch):
+            if isinstance(fetched, tuple):
+                LOG.error("failed to fetch %s %s: %s", tablename, fetched[2],
+                          fetched[3])
+                continue
+            if fetched.data is not None:
+                versions.remember_object(tablename, fetched)
+                result[int(fetched.key)] = fetched.data
+    return result
+
+def iter_stored_values(tablename, keys=None, batch_size=None,
+                       max_batch_size=None):
+    """Iterate over the stored values of the objects of the given table,
+    which are fetched lazily, one batch of keys at a time. If keys is None,
+    every object listed in the key index of the table is returned, otherwise
+    only objects identified by the given keys are fetched.
+    :param batch_size: the number of keys of the first fetched batch (by
+    default, a whole shard of the key index is fetched at once)
+    :param max_batch_size: the size of the batches is doubled after each
+    batch, up to this size (by default, it does not change)
+    :return: an iterator over tuples (key, stored value)
+    """
+
+    cached_values = table_cache.get_table_values(tablename)
+    if keys is None and cached_values is not None:
+        key_batches = [sorted(cached_values.keys())]
+    elif keys is None:
+        """Scan the table, one shard of its key index at a time."""
+        from nova.db.discovery.key_index import iter_key_shards
+        key_batches = iter_key_shards(tablename)
+    else:
+        key_batches = [sorted(keys)]
+
+    for keys in key_batches:
+        keys = [key for key in keys if isinstance(key, (int, long))]
+        offset = 0
+        while offset < len(keys):
+            step = batch_size or len(keys)
+            batch_keys = keys[offset:offset + step]
+            offset += step
+            if batch_size is not None and max_batch_size is not None:
+                batch_size = min(batch_size * 2,
+                                 max(max_batch_size, batch_size))
+            values = fetch_values(tablename, batch_keys, cached_values)
+            for key in batch_keys:
+                if key in values:
+                    yield (key, values[key])
+
+def get_objects(tablename, desimplify=True, request_uuid=None, keys=None,
+                values=None):
+    """Returns the objects of the given table. If keys is None, every
+    object listed in the key index of the table is returned, otherwise only
+    objects identified by the given keys are fetched.
+    :param values: the stored values of the objects, if they were already
+    fetched (keys is then ignored)
+    """
+
+    try:
+        from desimplifier import ObjectDesimplifier
+    except:
+        pass
 
-    key_index_bucket = RIAK_CLIENT.bucket("key_index")
-    fetched = key_index_bucket.get(tablename)
-    keys = fetched.data
+    """A single desimplifier is shared by the objects of the batch."""
+    object_desimplifier = ObjectDesimplifier(request_uuid=request_uuid)
+
+    if values is not None:
+        stored_values = [(value.get("id"), value) for value in values]
+    else:
+        stored_values = iter_stored_values(tablename, keys=keys)
 
     result = []
-    if keys != None:
-        for key in keys:
-            try:
-                key_as_string = "%d" % (key)
-
-                model_object = get_single_object(
-                    tablename,
-                    key,
-                    desimplify,
-                    request_uuid
-                )
-
-                result += [model_object]
-            except Exception as ex:
-                print("problem with key: %s" % (key))
-                traceback.print_exc()
-                pass
+    for (key, value) in stored_values:
+        if not desimplify:
+            result += [value]
+            continue
+        try:
+            result += [object_desimplifier.desimplify(value)]
+        except Exception:
+            LOG.exception("failed to desimplify %s %s", tablename, key)
 
     return result
 
 def get_models_satisfying(tablename, field, value, request_uuid=None):
+    """Returns the stored values of the objects of a table whose field has
+    the given value: the table is scanned, unless the given request already
+    scanned it (see lazy_reference.scan_table)."""
+
+    from nova.db.discovery.lazy_reference import LOADERS
+
+    if request_uuid is not None and request_uuid in LOADERS:
+        result = LOADERS.get(request_uuid).find(tablename, field, value)
+        if result is not None:
+            return result
 
     candidates = get_objects(tablename, False, request_uuid=request_uuid)
     result = []
@@ -208,11 +324,14 @@ class ReloadableRelationMixin(models.ModelBase):
 
         return result
 
-    def update_foreign_keys(self, request_uuid=uuid.uuid1()):
+    def update_foreign_keys(self, request_uuid=None):
         """Update foreign keys according to local fields' values."""
 
         from lazy_reference import LazyReference
 
+        if request_uuid is None:
+            request_uuid = uuid.uuid1()
+
         if hasattr(self, "metadata"):
             metadata = self.metadata
             tablename = self.__tablename__
@@ -0,0 +1,233 @@
+"""Versions module.
+
+This module keeps track of the last version of each object read or written
+by the discovery database backend: its vector clock and its stored value. When
+an object is saved, its fields are compared with this version, so that
+unchanged objects are not written, and changed objects are written without
+reading them first: only the changed fields are applied on the known version,
+which is written with its vector clock.
+
+Concurrent writes of an object thus create siblings in Riak, which are
+reconciled field by field: each stored value records, for each field that
+was ever changed, the time of its last change (the times are carried over
+from the version that a write replaces), and the most recent change of each
+field wins. A write based on a stale version carries the stale times of the
+fields it did not change, so it does not undo the changes made since then on
+the other branch. Times are read from the clocks of the API hosts: changes
+of the same field made on two branches within their clock skew may be
+resolved in either order.
+
+"""
+
+import collections
+import threading
+import time
+
+"""Maximum number of versions kept by a process."""
+MAX_VERSIONS = 10000
+
+"""Key of stored values that lists the fields changed by their write (the
+only record of changes of values written before FIELD_TIMES_KEY)."""
+CHANGED_FIELDS_KEY = "changed_fields"
+
+"""Key of stored values that maps each changed field to the time of its last
+change."""
+FIELD_TIMES_KEY = "field_times"
+
+
+class VersionCache(object):
+    """Class that keeps the last known versions of objects, in a LRU."""
+
+    def __init__(self, max_size=MAX_VERSIONS):
+        """Constructor"""
+
+        self.max_size = max_size
+        """(tablename, key) -> (vclock, value)"""
+        self.versions = {}
+        self.order = collections.deque()
+        self.lock = threading.Lock()
+
+    def remember(self, tablename, key, vclock, value):
+        """Remember the given version of an object (a copy of its value is
+        kept, as callers may modify the value)."""
+
+        if vclock is None or not isinstance(value, dict):
+            return
+        cache_key = (tablename, int(key))
+        with self.lock:
+            if not cache_key in self.versions:
+                self.order.append(cache_key)
+            self.versions[cache_key] = (vclock, dict(value))
+            while len(self.versions) > self.max_size:
+                self.versions.pop(self.order.popleft(), None)
+
+    def lookup(self, tablename, key):
+        """Returns the last known version of an object, as a tuple (vclock,
+        value), or None if it is not known."""
+
+        return self.versions.get((tablename, int(key)))
+
+    def forget(self, tablename, key):
+        """Forget the known version of an object."""
+
+        with self.lock:
+            self.versions.pop((tablename, int(key)), None)
+
+    def clear(self):
+        """Forget every known version."""
+
+        with self.lock:
+            self.versions = {}
+            self.order = collections.deque()
+
+
+VERSION_CACHE = VersionCache()
+
+
+def remember_object(tablename, riak_object):
+    """Remember the version of the given Riak object."""
+
+    if riak_object is None or len(riak_object.siblings) != 1:
+        return
+    VERSION_CACHE.remember(tablename, riak_object.key, riak_object.vclock,
+                           riak_object.data)
+
+
+def get_update_time(value):
+    """Returns the time of the last update of a stored value."""
+
+    updated_at = value.get("updated_at")
+    if isinstance(updated_at, dict):
+        return updated_at.get("epoch", 0)
+    return 0
+
+
+def get_field_times(value):
+    """Returns the times of the last changes of the fields of a stored
+    value, as a dict field -> time."""
+
+    field_times = value.get(FIELD_TIMES_KEY)
+    if isinstance(field_times, dict):
+        return field_times
+    """Values written before field times were recorded: their changed
+    fields changed at their update time."""
+    update_time = get_update_time(value)
+    return dict((field, update_time)
+                for field in value.get(CHANGED_FIELDS_KEY, []))
+
+
+def stamp_changes(value, previous_value, changed_fields=None):
+    """Record in a stored value, about to be written, the time of the
+    changes of its changed fields: the times of the other fields are carried
+    over from the previous value. Returns the value.
+    :param changed_fields: the changed fields, by default the fields whose
+    value differs from the previous value
+    """
+
+    if previous_value is None:
+        previous_value = {}
+    if changed_fields is None:
+        changed_fields = [field for field in value
+                          if field != FIELD_TIMES_KEY and
+                          field != CHANGED_FIELDS_KEY and
+                          previous_value.get(field) != value[field]]
+    field_times = dict(get_field_times(previous_value))
+    now = time.time()
+    for field in changed_fields:
+        field_times[field] = now
+    value[FIELD_TIMES_KEY] = field_times
+    value[CHANGED_FIELDS_KEY] = sorted(set(changed_fields))
+    return value
+
+
+def reindex(riak_object, value):
+    """Set the index entries of a Riak object from its (merged) value: a
+    soft deleted object is only indexed by its deletion time."""
+
+    from nova.db.discovery import indexes
+    from nova.db.discovery import models
+
+    classname = models.get_model_classname_from_tablename(
+        value.get("nova_classname"))
+    if classname is None:
+        return
+    if value.get("deleted"):
+        indexes.clear_indexes(riak_object, value)
+    else:
+        indexes.add_indexes(riak_object,
+                            models.get_model_class_from_name(classname),
+                            value)
+
+
+def merge_siblings(riak_object):
+    """Resolver of the buckets of objects: siblings created by concurrent
+    writes are merged field by field. The most recent sibling is used as a
+    base, and each field that an older sibling changed more recently is
+    taken from this sibling. The index entries of the merged value are
+    computed again, as they may depend on fields taken from older
+    siblings."""
+
+    if len(riak_object.siblings) < 2:
+        return
+    siblings = [x for x in riak_object.siblings if isinstance(x.data, dict)]
+    if len(siblings) == 0:
+        riak_object.siblings = riak_object.siblings[:1]
+        return
+    siblings = sorted(siblings, key=lambda x: get_update_time(x.data))
+
+    merged = siblings[-1]
+    value = dict(merged.data)
+    field_times = dict(get_field_times(value))
+    changed_fields = set(value.get(CHANGED_FIELDS_KEY, []))
+    for sibling in reversed(siblings[:-1]):
+        for (field, change_time) in get_field_times(sibling.data).items():
+            if field in sibling.data and \
+                    change_time > field_times.get(field, -1):
+                value[field] = sibling.data[field]
+                field_times[field] = change_time
+                changed_fields.add(field)
+    value[FIELD_TIMES_KEY] = field_times
+    value[CHANGED_FIELDS_KEY] = sorted(changed_fields)
+
+    merged.data = value
+    riak_object.siblings = [merged]
+    reindex(riak_object, value)
+
+
+def register_resolver(client):
+    """Merge the siblings of the objects read with the given Riak client
+    with merge_siblings (buckets that have their own resolver keep it)."""
+
+    client.resolver = merge_siblings
+    return client
+
+
+CONFIGURED_BUCKETS = set()
+
+def get_object_bucket(client, tablename):
+    """Returns the bucket that stores the objects of a table: siblings are
+    allowed on this bucket, so that concurrent writes can be reconciled."""
+
+    object_bucket = client.bucket(tablename)
+    if not tablename in CONFIGURED_BUCKETS:
+        object_bucket.allow_mult = True
+        CONFIGURED_BUCKETS.add(tablename)
+    return object_bucket
+
+
+def store_object(riak_object):
+    """Store the given Riak object. If the write created siblings (the
+    object was concurrently written), they are merged and the merged value is
+    stored, so that readers do not have to merge them again."""
+
+    merged = []
+
+    def resolver(resolved_object):
+        merge_siblings(resolved_object)
+        merged.append(True)
+
+    riak_object.resolver = resolver
+    riak_object.store()
+    if len(merged) > 0:
+        riak_object.store()
+    return riak_object
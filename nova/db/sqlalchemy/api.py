@@ -607,6 +607,44 @@ def compute_node_get_all(context, no_date_fields):
     return compute_nodes
 
 
+@require_admin_context
+def compute_node_get_all_changed_since(context, since):
+    engine = get_engine()
+
+    compute_node = models.ComputeNode.__table__
+    service = models.Service.__table__
+
+    with engine.begin() as conn:
+        # NOTE: deleted compute nodes are returned as well.
+        compute_node_query = sql.select([compute_node]).\
+                                where((compute_node.c.updated_at >= since) |
+                                      (compute_node.c.created_at >= since) |
+                                      (compute_node.c.deleted_at >= since)).\
+                                order_by(compute_node.c.service_id)
+        compute_node_rows = conn.execute(compute_node_query).fetchall()
+
+        service_ids = set(row['service_id'] for row in compute_node_rows)
+        service_rows = []
+        if service_ids:
+            service_query = sql.select([service]).\
+                                where((service.c.deleted == 0) &
+                                      (service.c.id.in_(service_ids)))
+            service_rows = conn.execute(service_query).fetchall()
+
+    services = {}
+    for proxy in service_rows:
+        services[proxy['id']] = dict(proxy.items())
+
+    compute_nodes = []
+    for proxy in compute_node_rows:
+        node = dict(proxy.items())
+        node['service'] = services.get(proxy['service_id'])
+
+        compute_nodes.append(node)
+
+    return compute_nodes
+
+
 @require_admin_context
 def compute_node_search_by_hypervisor(context, hypervisor_match):
     field = models.ComputeNode.hypervisor_hostname
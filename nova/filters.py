@@ -17,10 +17,32 @@
 Filter support
 """
 
+import collections
+
+from oslo.config import cfg
+from oslo.utils import timeutils
+
 from nova.i18n import _
 from nova import loadables
 from nova.openstack.common import log as logging
 
+filter_opts = [
+    cfg.IntOpt('filter_memo_size',
+               default=0,
+               help='Maximum number of filter results memoized across '
+                    'requests, for the filters that declare a cache key '
+                    '(e.g. ComputeCapabilitiesFilter, '
+                    'ImagePropertiesFilter). 0 disables the memoization.'),
+    cfg.IntOpt('filter_memo_ttl',
+               default=60,
+               help='Number of seconds a memoized filter result is kept. '
+                    'It bounds how long filters which read the database '
+                    '(aggregates, instances) can miss a change.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(filter_opts)
+
 LOG = logging.getLogger(__name__)
 
 
@@ -57,6 +79,46 @@ class BaseFilter(object):
         else:
             return True
 
+    def cache_key(self, obj, filter_properties):
+        """Return a hashable key of everything the result of _filter_one()
+        depends on, so that the result can be memoized across requests, or
+        None if it must not be memoized.  Override this in a subclass which
+        only overrides _filter_one().
+        """
+        return None
+
+
+class FilterMemo(object):
+    """Bounded memo of filter results, keyed on the filter class and the
+    cache key of the filtered object.  The least recently used results are
+    evicted first, and results expire after filter_memo_ttl seconds.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.results = collections.OrderedDict()
+
+    def get(self, key):
+        """Return the memoized result for a key, or None."""
+        entry = self.results.pop(key, None)
+        if entry is None:
+            return None
+        (expires, result) = entry
+        if timeutils.utcnow_ts() >= expires:
+            return None
+        self.results[key] = entry
+        return result
+
+    def set(self, key, result):
+        self.results.pop(key, None)
+        while len(self.results) >= self.size:
+            self.results.popitem(last=False)
+        self.results[key] = (timeutils.utcnow_ts() + self.ttl, result)
+
+    def clear(self):
+        self.results.clear()
+
 
 class BaseFilterHandler(loadables.BaseLoader):
     """Base class to handle loading filter classes.
@@ -64,6 +126,37 @@ class BaseFilterHandler(loadables.BaseLoader):
     This class should be subclassed where one needs to use filters.
     """
 
+    def __init__(self, loadable_cls_type):
+        super(BaseFilterHandler, self).__init__(loadable_cls_type)
+        self.memo = None
+        if CONF.filter_memo_size > 0:
+            self.memo = FilterMemo(CONF.filter_memo_size,
+                                   CONF.filter_memo_ttl)
+
+    def _filter_all(self, filter, objs, filter_properties):
+        """Call filter.filter_all(), or look up the memoized results of the
+        objects which have a cache key.
+        """
+        if self.memo is None:
+            return filter.filter_all(objs, filter_properties)
+        keys = [filter.cache_key(obj, filter_properties) for obj in objs]
+        if not any(key is not None for key in keys):
+            return filter.filter_all(objs, filter_properties)
+
+        passing_objs = []
+        for (obj, key) in zip(objs, keys):
+            if key is None:
+                passes = filter._filter_one(obj, filter_properties)
+            else:
+                key = (filter.__class__, key)
+                passes = self.memo.get(key)
+                if passes is None:
+                    passes = bool(filter._filter_one(obj, filter_properties))
+                    self.memo.set(key, passes)
+            if passes:
+                passing_objs.append(obj)
+        return passing_objs
+
     def get_filtered_objects(self, filter_classes, objs,
             filter_properties, index=0):
         list_objs = list(objs)
@@ -73,8 +166,8 @@ class BaseFilterHandler(loadables.BaseLoader):
             filter = filter_cls()
 
             if filter.run_filter_for_index(index):
-                objs = filter.filter_all(list_objs,
-                                               filter_properties)
+                objs = self._filter_all(filter, list_objs,
+                                        filter_properties)
                 if objs is None:
                     LOG.debug("Filter %(cls_name)s says to stop filtering",
                               {'cls_name': cls_name})
@@ -13,7 +13,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from oslo.config import cfg
+
 from nova.scheduler import filter_scheduler
+from nova.scheduler import shared_claims
+
+CONF = cfg.CONF
+CONF.import_opt('scheduler_share_claims', 'nova.scheduler.shared_claims')
 
 
 class CachingScheduler(filter_scheduler.FilterScheduler):
@@ -45,6 +51,11 @@ class CachingScheduler(filter_scheduler.FilterScheduler):
     more retries, because the data stored on any additional scheduler will
     be more out of date, than if it was fetched from the database.
 
+    To mitigate this, set scheduler_share_claims: the resources consumed
+    by each scheduler worker are then published to memcached, and applied
+    by the other workers to their copy of the cache before they schedule
+    (see nova.scheduler.shared_claims).
+
     In a similar way, if you have a high number of server deletes, the
     extra capacity from those deletes will not show up until the cache is
     refreshed.
@@ -53,6 +64,9 @@ class CachingScheduler(filter_scheduler.FilterScheduler):
     def __init__(self, *args, **kwargs):
         super(CachingScheduler, self).__init__(*args, **kwargs)
         self.all_host_states = None
+        self.shared_claims = None
+        if CONF.scheduler_share_claims:
+            self.shared_claims = shared_claims.SharedClaims()
 
     def run_periodic_tasks(self, context):
         """Called from a periodic tasks in the manager."""
@@ -70,8 +84,17 @@ class CachingScheduler(filter_scheduler.FilterScheduler):
             # Rather than raise an error, we fetch the list of hosts.
             self.all_host_states = self._get_up_hosts(context)
 
+        if self.shared_claims is not None:
+            self.shared_claims.apply(self.all_host_states)
         return self.all_host_states
 
+    def _consume_from_instance(self, host_state, instance_properties):
+        """Called from the filter scheduler, in a template pattern."""
+        super(CachingScheduler, self)._consume_from_instance(
+            host_state, instance_properties)
+        if self.shared_claims is not None:
+            self.shared_claims.publish(host_state, instance_properties)
+
     def _get_up_hosts(self, context):
         all_hosts_iterator = self.host_manager.get_all_host_states(context)
         return list(all_hosts_iterator)
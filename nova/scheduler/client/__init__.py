@@ -48,5 +48,8 @@ class SchedulerClient(object):
         return self.queryclient.select_destinations(
             context, request_spec, filter_properties)
 
+    def select_destinations_batch(self, context, requests):
+        return self.queryclient.select_destinations_batch(context, requests)
+
     def update_resource_stats(self, context, name, stats):
         self.reportclient.update_resource_stats(context, name, stats)
@@ -32,3 +32,15 @@ class SchedulerQueryClient(object):
         """
         return self.scheduler_rpcapi.select_destinations(
             context, request_spec, filter_properties)
+
+    def select_destinations_batch(self, context, requests):
+        """Returns the destinations best suited for each of many independent
+        requests, given as dicts with 'request_spec' and 'filter_properties'
+        as keys.
+
+        The result is a list with, for each request, a list of dicts with
+        'host', 'nodename' and 'limits' as keys, or None if no valid host
+        was found for the request.
+        """
+        return self.scheduler_rpcapi.select_destinations_batch(context,
+                                                               requests)
@@ -133,3 +133,24 @@ class Scheduler(object):
         """
         msg = _("Driver must implement select_destinations")
         raise NotImplementedError(msg)
+
+    def select_destinations_batch(self, context, requests):
+        """Selects destinations for many independent requests.
+
+        Drivers can override this method to schedule the requests together.
+
+        :param requests: A list of dicts with 'request_spec' and
+            'filter_properties' as keys, the arguments of
+            select_destinations().
+        :return: A list with, for each request, the list of dicts returned by
+            select_destinations(), or None if no valid host was found.
+        """
+        results = []
+        for request in requests:
+            try:
+                results.append(self.select_destinations(
+                    context, request['request_spec'],
+                    request['filter_properties']))
+            except exception.NoValidHost:
+                results.append(None)
+        return results
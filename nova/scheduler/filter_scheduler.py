@@ -19,9 +19,11 @@ You can customize this scheduler by specifying your own Host Filters and
 Weighing Functions.
 """
 
+import copy
 import random
 
 from oslo.config import cfg
+from oslo.serialization import jsonutils
 
 from nova.compute import rpcapi as compute_rpcapi
 from nova import exception
@@ -52,6 +54,45 @@ filter_scheduler_opts = [
 
 CONF.register_opts(filter_scheduler_opts)
 
+# Instance properties which are seen by filters: batched requests with the
+# same flavor, image, hints and properties pass on the same hosts
+SIGNATURE_INSTANCE_PROPERTIES = ('project_id', 'availability_zone',
+                                 'os_type', 'image_ref', 'instance_type_id',
+                                 'memory_mb', 'vcpus', 'root_gb',
+                                 'ephemeral_gb', 'numa_topology',
+                                 'pci_requests')
+
+
+def _request_size(request_spec):
+    """Returns a sort key of the resources requested by an instance."""
+    instance_type = request_spec.get('instance_type') or {}
+    return (instance_type.get('memory_mb') or 0,
+            instance_type.get('vcpus') or 0,
+            (instance_type.get('root_gb') or 0) +
+            (instance_type.get('ephemeral_gb') or 0))
+
+
+# Attributes of a host state changed by HostState.consume_from_instance()
+CONSUMED_ATTRIBUTES = ('free_ram_mb', 'free_disk_mb', 'vcpus_used',
+                       'updated', 'num_instances', 'num_io_ops',
+                       'numa_topology', 'pci_stats')
+
+
+def _save_consumed_state(host_state):
+    """Returns the attributes of a host state which are changed when the
+    resources of an instance are consumed from it.
+    """
+    saved = dict((key, getattr(host_state, key, None))
+                 for key in CONSUMED_ATTRIBUTES)
+    # PCI device pools are updated in place
+    saved['pci_stats'] = copy.deepcopy(saved['pci_stats'])
+    return saved
+
+
+def _restore_consumed_state(host_state, saved):
+    for (key, value) in saved.iteritems():
+        setattr(host_state, key, value)
+
 
 class FilterScheduler(driver.Scheduler):
     """Scheduler that can be used for filtering and weighing."""
@@ -166,6 +207,156 @@ class FilterScheduler(driver.Scheduler):
                            dict(request_spec=request_spec))
         return dests
 
+    def select_destinations_batch(self, context, requests):
+        """Selects hosts and nodes for many independent requests at once.
+
+        Every request is scheduled on the same snapshot of the host states,
+        the larger instances first. Filters are run once for the requests
+        with the same signature (see _get_request_signature()): after the
+        resources of an instance are consumed from a host, only this host is
+        filtered again.
+
+        :returns: a list with, for each request, the destinations returned
+                  by select_destinations(), or None if the request could not
+                  be fulfilled.
+        """
+        elevated = context.elevated()
+        hosts = list(self._get_all_host_states(elevated))
+        # (hosts passing the filters, filter properties) by signature
+        passing_hosts = {}
+        results = [None] * len(requests)
+        order = sorted(xrange(len(requests)), reverse=True,
+                       key=lambda i: _request_size(
+                           requests[i]['request_spec']))
+        for i in order:
+            request_spec = requests[i]['request_spec']
+            filter_properties = requests[i]['filter_properties']
+            self.notifier.info(context,
+                               'scheduler.select_destinations.start',
+                               dict(request_spec=request_spec))
+
+            num_instances = request_spec['num_instances']
+            # A request which cannot be fulfilled gives back the resources
+            # consumed for its first instances
+            consumed = []
+            saved_passing_hosts = dict(passing_hosts)
+            try:
+                selected_hosts = self._schedule_batched(
+                    context, hosts, passing_hosts, request_spec,
+                    filter_properties, consumed)
+            except exception.NoValidHost as ex:
+                LOG.debug('No valid host for request %(index)d: %(error)s',
+                          {'index': i, 'error': ex})
+                selected_hosts = None
+            else:
+                if len(selected_hosts) < num_instances:
+                    LOG.debug('There are %(hosts)d hosts available but '
+                              '%(num_instances)d instances requested to '
+                              'build by request %(index)d.',
+                              {'hosts': len(selected_hosts),
+                               'num_instances': num_instances, 'index': i})
+                    selected_hosts = None
+            if selected_hosts is None:
+                for (host_state, saved) in reversed(consumed):
+                    _restore_consumed_state(host_state, saved)
+                passing_hosts.clear()
+                passing_hosts.update(saved_passing_hosts)
+                continue
+
+            results[i] = [dict(host=host.obj.host,
+                               nodename=host.obj.nodename,
+                               limits=host.obj.limits)
+                          for host in selected_hosts]
+            self.notifier.info(context, 'scheduler.select_destinations.end',
+                               dict(request_spec=request_spec))
+        return results
+
+    def _schedule_batched(self, context, hosts, passing_hosts, request_spec,
+                          filter_properties, consumed):
+        """Like _schedule(), on a given list of host states: the hosts
+        passing the filters are shared with the other requests of the batch
+        through passing_hosts. The chosen host states are appended to
+        consumed, with their state before the resources of the instance were
+        consumed from them.
+
+        NOTE: the claims published by the CachingScheduler for a request
+        which is then given back are kept until the next report of the
+        compute node (see nova.scheduler.shared_claims): the other workers
+        only see less capacity meanwhile.
+        """
+        instance_properties = request_spec['instance_properties']
+        instance_uuids = request_spec.get("instance_uuids", None)
+
+        update_group_hosts = self._prepare_filter_properties(
+            context, request_spec, filter_properties)
+        signature = self._get_request_signature(
+            request_spec, filter_properties, update_group_hosts)
+
+        selected_hosts = []
+        if instance_uuids:
+            num_instances = len(instance_uuids)
+        else:
+            num_instances = request_spec.get('num_instances', 1)
+        for num in xrange(num_instances):
+            if signature is None:
+                hosts = self.host_manager.get_filtered_hosts(hosts,
+                        filter_properties, index=num)
+            else:
+                if signature not in passing_hosts:
+                    passing_hosts[signature] = (
+                        self.host_manager.get_filtered_hosts(
+                            hosts, filter_properties),
+                        filter_properties)
+                hosts = passing_hosts[signature][0]
+            if not hosts:
+                break
+
+            chosen_host = self._choose_host(hosts, filter_properties)
+            selected_hosts.append(chosen_host)
+            consumed.append((chosen_host.obj,
+                             _save_consumed_state(chosen_host.obj)))
+            self._consume_chosen_host(chosen_host, instance_properties,
+                                      filter_properties, update_group_hosts)
+
+            # The chosen host may not pass the filters of the other
+            # signatures anymore
+            for (other, (other_hosts, other_properties)) in (
+                    passing_hosts.items()):
+                if (chosen_host.obj in other_hosts and
+                        not self.host_manager.get_filtered_hosts(
+                            [chosen_host.obj], other_properties)):
+                    passing_hosts[other] = (
+                        [x for x in other_hosts if x is not chosen_host.obj],
+                        other_properties)
+        return selected_hosts
+
+    def _get_request_signature(self, request_spec, filter_properties,
+                               update_group_hosts):
+        """Returns a signature of what the filters see of a request, or None
+        if the hosts passing the filters cannot be shared with other
+        requests (server groups, retries).
+        """
+        retry = filter_properties.get('retry') or {}
+        if (update_group_hosts or retry.get('hosts') or
+                filter_properties.get('group_hosts')):
+            return None
+
+        instance_properties = request_spec.get('instance_properties') or {}
+        spec = dict((key, value) for (key, value) in request_spec.iteritems()
+                    if key not in ('instance_properties', 'instance_uuids',
+                                   'num_instances'))
+        spec['instance_properties'] = dict(
+            (key, instance_properties.get(key))
+            for key in SIGNATURE_INSTANCE_PROPERTIES)
+        properties = dict((key, value)
+                          for (key, value) in filter_properties.iteritems()
+                          if key not in ('context', 'request_spec',
+                                         'config_options', 'retry'))
+        try:
+            return jsonutils.dumps([spec, properties], sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
     def _provision_resource(self, context, weighed_host, request_spec,
             filter_properties, requested_networks, injected_files,
             admin_password, is_first_time, instance_uuid=None,
@@ -256,21 +447,10 @@ class FilterScheduler(driver.Scheduler):
         """
         elevated = context.elevated()
         instance_properties = request_spec['instance_properties']
-        instance_type = request_spec.get("instance_type", None)
         instance_uuids = request_spec.get("instance_uuids", None)
 
-        update_group_hosts = self._setup_instance_group(context,
-                filter_properties)
-
-        config_options = self._get_configuration_options()
-
-        filter_properties.update({'context': context,
-                                  'request_spec': request_spec,
-                                  'config_options': config_options,
-                                  'instance_type': instance_type})
-
-        self.populate_filter_properties(request_spec,
-                                        filter_properties)
+        update_group_hosts = self._prepare_filter_properties(
+            context, request_spec, filter_properties)
 
         # Find our local list of acceptable hosts by repeatedly
         # filtering and weighing our options. Each time we choose a
@@ -297,38 +477,77 @@ class FilterScheduler(driver.Scheduler):
 
             LOG.debug("Filtered %(hosts)s", {'hosts': hosts})
 
-            weighed_hosts = self.host_manager.get_weighed_hosts(hosts,
-                    filter_properties)
-
-            LOG.debug("Weighed %(hosts)s", {'hosts': weighed_hosts})
-
-            scheduler_host_subset_size = CONF.scheduler_host_subset_size
-            if scheduler_host_subset_size > len(weighed_hosts):
-                scheduler_host_subset_size = len(weighed_hosts)
-            if scheduler_host_subset_size < 1:
-                scheduler_host_subset_size = 1
-
-            chosen_host = random.choice(
-                weighed_hosts[0:scheduler_host_subset_size])
+            chosen_host = self._choose_host(hosts, filter_properties)
             selected_hosts.append(chosen_host)
 
             # Now consume the resources so the filter/weights
             # will change for the next instance.
-            # NOTE (baoli) adding and deleting pci_requests is a temporary
-            # fix to avoid DB access in consume_from_instance() while getting
-            # pci_requests. The change can be removed once pci_requests is
-            # part of the instance object that is passed into the scheduler
-            # APIs
-            pci_requests = filter_properties.get('pci_requests')
-            if pci_requests:
-                instance_properties['pci_requests'] = pci_requests
-            chosen_host.obj.consume_from_instance(instance_properties)
-            if pci_requests:
-                del instance_properties['pci_requests']
-            if update_group_hosts is True:
-                filter_properties['group_hosts'].add(chosen_host.obj.host)
+            self._consume_chosen_host(chosen_host, instance_properties,
+                                      filter_properties, update_group_hosts)
         return selected_hosts
 
+    def _prepare_filter_properties(self, context, request_spec,
+                                   filter_properties):
+        """Stuff the request and the server group info into
+        filter_properties before filtering hosts.
+
+        :returns: True if the hosts of the server group must be updated
+                  with the chosen hosts.
+        """
+        instance_type = request_spec.get("instance_type", None)
+
+        update_group_hosts = self._setup_instance_group(context,
+                filter_properties)
+
+        config_options = self._get_configuration_options()
+
+        filter_properties.update({'context': context,
+                                  'request_spec': request_spec,
+                                  'config_options': config_options,
+                                  'instance_type': instance_type})
+
+        self.populate_filter_properties(request_spec,
+                                        filter_properties)
+        return update_group_hosts
+
+    def _choose_host(self, hosts, filter_properties):
+        """Weigh the filtered hosts and choose one of the best ones."""
+        scheduler_host_subset_size = CONF.scheduler_host_subset_size
+        if scheduler_host_subset_size > len(hosts):
+            scheduler_host_subset_size = len(hosts)
+        if scheduler_host_subset_size < 1:
+            scheduler_host_subset_size = 1
+
+        # Only the subset of best hosts is needed
+        weighed_hosts = self.host_manager.get_weighed_hosts(hosts,
+                filter_properties, limit=scheduler_host_subset_size)
+
+        LOG.debug("Weighed %(hosts)s", {'hosts': weighed_hosts})
+
+        return random.choice(weighed_hosts[0:scheduler_host_subset_size])
+
+    def _consume_chosen_host(self, chosen_host, instance_properties,
+                             filter_properties, update_group_hosts):
+        """Consume the resources of an instance from the chosen host."""
+        # NOTE (baoli) adding and deleting pci_requests is a temporary
+        # fix to avoid DB access in consume_from_instance() while getting
+        # pci_requests. The change can be removed once pci_requests is
+        # part of the instance object that is passed into the scheduler
+        # APIs
+        pci_requests = filter_properties.get('pci_requests')
+        if pci_requests:
+            instance_properties['pci_requests'] = pci_requests
+        self._consume_from_instance(chosen_host.obj, instance_properties)
+        if pci_requests:
+            del instance_properties['pci_requests']
+        if update_group_hosts is True:
+            filter_properties['group_hosts'].add(chosen_host.obj.host)
+
     def _get_all_host_states(self, context):
         """Template method, so a subclass can implement caching."""
         return self.host_manager.get_all_host_states(context)
+
+    def _consume_from_instance(self, host_state, instance_properties):
+        """Template method, so a subclass can share the consumed resources.
+        """
+        host_state.consume_from_instance(instance_properties)
@@ -32,6 +32,14 @@ class BaseHostFilter(filters.BaseFilter):
         """
         raise NotImplementedError()
 
+    def filter_columns(self, host_table, filter_properties):
+        """Vectorized host_passes(), evaluated over the columns of a
+        nova.scheduler.host_table.HostTable. Return an array of booleans
+        (one per host of the table), or None if the filter has to run per
+        host. Override this in a subclass.
+        """
+        return None
+
 
 class HostFilterHandler(filters.BaseFilterHandler):
     def __init__(self):
@@ -31,6 +31,15 @@ class AggregateInstanceExtraSpecsFilter(filters.BaseHostFilter):
     # Aggregate data and instance type does not change within a request
     run_filter_once_per_request = True
 
+    def cache_key(self, host_state, filter_properties):
+        # NOTE: aggregates are not versioned: their changes are seen once
+        # the memoized results expire
+        instance_type = filter_properties.get('instance_type')
+        if not instance_type or 'extra_specs' not in instance_type:
+            return None
+        return (host_state.host,
+                tuple(sorted(instance_type['extra_specs'].iteritems())))
+
     def host_passes(self, host_state, filter_properties):
         """Return a list of hosts that can create instance_type
 
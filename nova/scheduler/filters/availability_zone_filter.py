@@ -36,6 +36,16 @@ class AvailabilityZoneFilter(filters.BaseHostFilter):
     # Availability zones do not change within a request
     run_filter_once_per_request = True
 
+    def cache_key(self, host_state, filter_properties):
+        # NOTE: aggregates are not versioned: their changes are seen once
+        # the memoized results expire
+        spec = filter_properties.get('request_spec', {})
+        props = spec.get('instance_properties', {})
+        availability_zone = props.get('availability_zone')
+        if not availability_zone:
+            return None
+        return (host_state.host, availability_zone)
+
     def host_passes(self, host_state, filter_properties):
         spec = filter_properties.get('request_spec', {})
         props = spec.get('instance_properties', {})
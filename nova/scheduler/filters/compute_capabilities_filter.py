@@ -71,6 +71,16 @@ class ComputeCapabilitiesFilter(filters.BaseHostFilter):
                 return False
         return True
 
+    def cache_key(self, host_state, filter_properties):
+        # Capabilities are read from the host state, which is versioned by
+        # its update time
+        instance_type = filter_properties.get('instance_type')
+        if (not instance_type or 'extra_specs' not in instance_type or
+                host_state.updated is None):
+            return None
+        return (host_state.host, host_state.nodename, host_state.updated,
+                tuple(sorted(instance_type['extra_specs'].iteritems())))
+
     def host_passes(self, host_state, filter_properties):
         """Return a list of hosts that can create instance_type."""
         instance_type = filter_properties.get('instance_type')
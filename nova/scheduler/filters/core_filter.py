@@ -80,6 +80,25 @@ class CoreFilter(BaseCoreFilter):
     def _get_cpu_allocation_ratio(self, host_state, filter_properties):
         return CONF.cpu_allocation_ratio
 
+    def filter_columns(self, host_table, filter_properties):
+        instance_type = filter_properties.get('instance_type')
+        if not instance_type:
+            return None
+
+        # Fail safe: hosts that do not report their VCPUs pass
+        unknown_vcpus = host_table.column('vcpus_total') == 0
+        if unknown_vcpus.any():
+            LOG.warning(_LW("VCPUs not set; assuming CPU collection broken"))
+
+        instance_vcpus = instance_type['vcpus']
+        vcpus_total = (host_table.column('vcpus_total') *
+                       CONF.cpu_allocation_ratio)
+        host_table.set_limits('vcpu', vcpus_total,
+                              ~unknown_vcpus & (vcpus_total > 0))
+
+        free_vcpus = vcpus_total - host_table.column('vcpus_used')
+        return unknown_vcpus | (free_vcpus >= instance_vcpus)
+
 
 class AggregateCoreFilter(BaseCoreFilter):
     """AggregateCoreFilter with per-aggregate CPU subscription flag.
@@ -64,6 +64,25 @@ class DiskFilter(filters.BaseHostFilter):
         host_state.limits['disk_gb'] = disk_gb_limit
         return True
 
+    def filter_columns(self, host_table, filter_properties):
+        instance_type = filter_properties.get('instance_type')
+        if not instance_type:
+            return None
+        requested_disk = (1024 * (instance_type['root_gb'] +
+                                 instance_type['ephemeral_gb']) +
+                         instance_type['swap'])
+
+        free_disk_mb = host_table.column('free_disk_mb')
+        total_usable_disk_mb = host_table.column('total_usable_disk_gb') * 1024
+
+        disk_mb_limit = total_usable_disk_mb * CONF.disk_allocation_ratio
+        used_disk_mb = total_usable_disk_mb - free_disk_mb
+        usable_disk_mb = disk_mb_limit - used_disk_mb
+        passes = usable_disk_mb >= requested_disk
+
+        host_table.set_limits('disk_gb', disk_mb_limit / 1024, passes)
+        return passes
+
 
 class AggregateDiskFilter(DiskFilter):
     """AggregateDiskFilter with per-aggregate disk allocation ratio flag.
@@ -72,6 +91,10 @@ class AggregateDiskFilter(DiskFilter):
     found.
     """
 
+    def filter_columns(self, host_table, filter_properties):
+        # The allocation ratio is read per host, from its aggregates
+        return None
+
     def _get_disk_allocation_ratio(self, host_state, filter_properties):
         # TODO(uni): DB query in filter is a performance hit, especially for
         # system with lots of hosts. Will need a general solution here to fix
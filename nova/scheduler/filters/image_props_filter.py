@@ -94,6 +94,17 @@ class ImagePropertiesFilter(filters.BaseHostFilter):
                    'hypervisor_version': hypervisor_version})
         return False
 
+    def cache_key(self, host_state, filter_properties):
+        spec = filter_properties.get('request_spec', {})
+        image_props = spec.get('image', {}).get('properties', {})
+        supp_instances = host_state.supported_instances or []
+        return (host_state.host, host_state.nodename,
+                host_state.hypervisor_version,
+                tuple(tuple(x) for x in supp_instances),
+                tuple(image_props.get(key) for key in
+                      ('architecture', 'hypervisor_type', 'vm_mode',
+                       'hypervisor_version_requires')))
+
     def host_passes(self, host_state, filter_properties):
         """Check if host passes specified image properties.
 
@@ -54,6 +54,9 @@ class IoOpsFilter(filters.BaseHostFilter):
                          'max_io_ops': max_io_ops})
         return passes
 
+    def filter_columns(self, host_table, filter_properties):
+        return host_table.column('num_io_ops') < CONF.max_io_ops_per_host
+
 
 class AggregateIoOpsFilter(IoOpsFilter):
     """AggregateIoOpsFilter with per-aggregate the max io operations.
@@ -61,6 +64,10 @@ class AggregateIoOpsFilter(IoOpsFilter):
     Fall back to global max_io_ops_per_host if no per-aggregate setting found.
     """
 
+    def filter_columns(self, host_table, filter_properties):
+        # The maximum is read per host, from its aggregates
+        return None
+
     def _get_max_io_ops_per_host(self, host_state, filter_properties):
         # TODO(uni): DB query in filter is a performance hit, especially for
         # system with lots of hosts. Will need a general solution here to fix
@@ -48,6 +48,10 @@ class NumInstancesFilter(filters.BaseHostFilter):
                          'max_instances': max_instances})
         return passes
 
+    def filter_columns(self, host_table, filter_properties):
+        return (host_table.column('num_instances') <
+                CONF.max_instances_per_host)
+
 
 class AggregateNumInstancesFilter(NumInstancesFilter):
     """AggregateNumInstancesFilter with per-aggregate the max num instances.
@@ -56,6 +60,10 @@ class AggregateNumInstancesFilter(NumInstancesFilter):
     found.
     """
 
+    def filter_columns(self, host_table, filter_properties):
+        # The maximum is read per host, from its aggregates
+        return None
+
     def _get_max_instances_per_host(self, host_state, filter_properties):
         # TODO(uni): DB query in filter is a performance hit, especially for
         # system with lots of hosts. Will need a general solutnumn here to fix
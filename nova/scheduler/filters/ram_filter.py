@@ -72,6 +72,22 @@ class RamFilter(BaseRamFilter):
     def _get_ram_allocation_ratio(self, host_state, filter_properties):
         return self.ram_allocation_ratio
 
+    def filter_columns(self, host_table, filter_properties):
+        instance_type = filter_properties.get('instance_type')
+        if not instance_type:
+            return None
+        requested_ram = instance_type['memory_mb']
+        free_ram_mb = host_table.column('free_ram_mb')
+        total_usable_ram_mb = host_table.column('total_usable_ram_mb')
+
+        memory_mb_limit = total_usable_ram_mb * self.ram_allocation_ratio
+        used_ram_mb = total_usable_ram_mb - free_ram_mb
+        usable_ram = memory_mb_limit - used_ram_mb
+        passes = usable_ram >= requested_ram
+
+        host_table.set_limits('memory_mb', memory_mb_limit, passes)
+        return passes
+
 
 class AggregateRamFilter(BaseRamFilter):
     """AggregateRamFilter with per-aggregate ram subscription flag.
@@ -26,6 +26,18 @@ class TypeAffinityFilter(filters.BaseHostFilter):
     (spread) set to 1 (default).
     """
 
+    def cache_key(self, host_state, filter_properties):
+        # NOTE: host_passes reads the instances of the host from the
+        # database, not from its host state: an instance of another type
+        # placed on the host since its last compute node report (e.g. by
+        # another scheduler) is seen once the host reports again or the
+        # memoized result expires, up to filter_memo_ttl seconds later
+        instance_type = filter_properties.get('instance_type')
+        if not instance_type or host_state.updated is None:
+            return None
+        return (host_state.host, host_state.nodename, host_state.updated,
+                instance_type['id'])
+
     def host_passes(self, host_state, filter_properties):
         """Dynamically limits hosts to one instance type
 
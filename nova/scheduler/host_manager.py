@@ -18,6 +18,7 @@ Manage hosts in the current zone.
 """
 
 import collections
+import datetime
 import UserDict
 
 from oslo.config import cfg
@@ -32,6 +33,7 @@ from nova.i18n import _, _LW
 from nova.openstack.common import log as logging
 from nova.pci import stats as pci_stats
 from nova.scheduler import filters
+from nova.scheduler import host_table
 from nova.scheduler import weights
 from nova.virt import hardware
 
@@ -58,6 +60,17 @@ host_manager_opts = [
     cfg.ListOpt('scheduler_weight_classes',
                 default=['nova.scheduler.weights.all_weighers'],
                 help='Which weight class names to use for weighing hosts'),
+    cfg.BoolOpt('scheduler_incremental_host_state_refresh',
+                default=False,
+                help='Only read the compute nodes created, updated or '
+                     'deleted since the previous refresh of the host '
+                     'states, instead of every compute node. The services '
+                     'of the hosts are still read on every refresh.'),
+    cfg.IntOpt('scheduler_host_state_full_refresh_interval',
+               default=600,
+               help='Interval in seconds between the refreshes that read '
+                    'every compute node, when host states are refreshed '
+                    'incrementally. A value <= 0 disables them.'),
     ]
 
 CONF = cfg.CONF
@@ -65,6 +78,10 @@ CONF.register_opts(host_manager_opts)
 
 LOG = logging.getLogger(__name__)
 
+# Compute nodes are read from a little before the last change seen, so that
+# rows written meanwhile with an earlier timestamp are not missed.
+CHANGED_SINCE_MARGIN = datetime.timedelta(seconds=5)
+
 
 class ReadOnlyDict(UserDict.IterableUserDict):
     """A read-only dict."""
@@ -274,6 +291,11 @@ class HostManager(object):
 
     def __init__(self):
         self.host_state_map = {}
+        # State keys of the known compute nodes, by compute node ID
+        self.compute_node_keys = {}
+        # Latest change of a compute node seen by the last refresh
+        self.last_compute_node_change = None
+        self.last_full_refresh = None
         self.filter_handler = filters.HostFilterHandler()
         self.filter_classes = self.filter_handler.get_matching_classes(
                 CONF.scheduler_available_filters)
@@ -375,23 +397,38 @@ class HostManager(object):
                     return name_to_cls_map.values()
             hosts = name_to_cls_map.itervalues()
 
+        if host_table.is_enabled():
+            return host_table.filter_hosts(self.filter_handler,
+                    filter_classes, hosts, filter_properties, index)
         return self.filter_handler.get_filtered_objects(filter_classes,
                 hosts, filter_properties, index)
 
-    def get_weighed_hosts(self, hosts, weight_properties):
-        """Weigh the hosts."""
-        return self.weight_handler.get_weighed_objects(self.weight_classes,
-                hosts, weight_properties)
+    def get_weighed_hosts(self, hosts, weight_properties, limit=None):
+        """Weigh the hosts.
+
+        :param limit: if set, only the given number of best hosts are
+                      returned
+        """
+        if host_table.is_enabled():
+            return host_table.weigh_hosts(self.weight_handler,
+                    self.weight_classes, hosts, weight_properties, limit)
+        weighed_hosts = self.weight_handler.get_weighed_objects(
+                self.weight_classes, hosts, weight_properties)
+        return weighed_hosts[:limit]
 
     def get_all_host_states(self, context):
         """Returns a list of HostStates that represents all the hosts
         the HostManager knows about. Also, each of the consumable resources
         in HostState are pre-populated and adjusted based on data in the db.
         """
+        if self._can_refresh_incrementally():
+            self._refresh_changed_host_states(context)
+            return self.host_state_map.itervalues()
 
         # Get resource usage across the available compute nodes:
         compute_nodes = db.compute_node_get_all(context)
         seen_nodes = set()
+        self.compute_node_keys = {}
         for compute in compute_nodes:
             service = compute['service']
             if not service:
@@ -408,13 +445,101 @@ class HostManager(object):
                 self.host_state_map[state_key] = host_state
             host_state.update_service(dict(service.iteritems()))
             seen_nodes.add(state_key)
+            self.compute_node_keys[compute['id']] = state_key
 
         # remove compute nodes from host_state_map if they are not active
         dead_nodes = set(self.host_state_map.keys()) - seen_nodes
         for state_key in dead_nodes:
-            host, node = state_key
-            LOG.info(_("Removing dead compute node %(host)s:%(node)s "
-                       "from scheduler") % {'host': host, 'node': node})
-            del self.host_state_map[state_key]
+            self._remove_host_state(state_key)
 
+        self.last_compute_node_change = self._get_last_change(compute_nodes)
+        self.last_full_refresh = timeutils.utcnow()
         return self.host_state_map.itervalues()
+
+    def _can_refresh_incrementally(self):
+        """Check if the host states can be refreshed from the compute nodes
+        that changed since the last refresh.
+        """
+        if not CONF.scheduler_incremental_host_state_refresh:
+            return False
+        if (self.last_full_refresh is None or
+                self.last_compute_node_change is None):
+            return False
+        interval = CONF.scheduler_host_state_full_refresh_interval
+        return (interval <= 0 or
+                not timeutils.is_older_than(self.last_full_refresh, interval))
+
+    @staticmethod
+    def _get_last_change(compute_nodes):
+        """Returns the latest creation, update or deletion time of the given
+        compute nodes, or None.
+        """
+        last_change = None
+        for compute in compute_nodes:
+            for key in ('created_at', 'updated_at', 'deleted_at'):
+                changed_at = compute.get(key)
+                if changed_at is not None and (last_change is None or
+                                               changed_at > last_change):
+                    last_change = changed_at
+        return last_change
+
+    def _remove_host_state(self, state_key):
+        host, node = state_key
+        LOG.info(_("Removing dead compute node %(host)s:%(node)s "
+                   "from scheduler") % {'host': host, 'node': node})
+        del self.host_state_map[state_key]
+
+    def _refresh_changed_host_states(self, context):
+        """Refresh the host states from the compute nodes created, updated
+        or deleted since the last refresh: the other compute nodes are
+        neither read nor parsed again, only their service is refreshed.
+        """
+        since = self.last_compute_node_change - CHANGED_SINCE_MARGIN
+        compute_nodes = db.compute_node_get_all_changed_since(context, since)
+        services = {}
+        for service in db.service_get_all(context):
+            if service['binary'] == 'nova-compute':
+                services[service['host']] = dict(service.iteritems())
+
+        # Deleted compute nodes are handled first, so that a node created
+        # again with the same host and hypervisor hostname is kept
+        compute_nodes = sorted(compute_nodes,
+                               key=lambda x: not x.get('deleted'))
+        for compute in compute_nodes:
+            state_key = self.compute_node_keys.pop(compute['id'], None)
+            service = compute['service']
+            if compute.get('deleted') or not service:
+                if not compute.get('deleted'):
+                    LOG.warn(_LW("No service for compute ID %s"),
+                             compute['id'])
+                if state_key in self.host_state_map:
+                    self._remove_host_state(state_key)
+                continue
+            host = service['host']
+            node = compute.get('hypervisor_hostname')
+            state_key = (host, node)
+            host_state = self.host_state_map.get(state_key)
+            if host_state is None:
+                host_state = self.host_state_cls(host, node, compute=compute)
+                self.host_state_map[state_key] = host_state
+            elif host_state.updated != compute['updated_at']:
+                # NOTE: compute nodes read again because of the margin are
+                # not parsed again
+                host_state.update_from_compute_node(compute)
+            self.compute_node_keys[compute['id']] = state_key
+
+        # Refresh the services of every host: hosts whose service is deleted
+        # are removed
+        for (compute_id, state_key) in self.compute_node_keys.items():
+            service = services.get(state_key[0])
+            if service is None:
+                del self.compute_node_keys[compute_id]
+                if state_key in self.host_state_map:
+                    self._remove_host_state(state_key)
+                continue
+            self.host_state_map[state_key].update_service(service)
+
+        last_change = self._get_last_change(compute_nodes)
+        if last_change is not None:
+            self.last_compute_node_change = max(self.last_compute_node_change,
+                                                last_change)
@@ -0,0 +1,231 @@
+# Copyright (c) 2014 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Columnar host state table.
+
+The resources of the host states (free RAM and disk, vCPUs, instances, I/O
+operations and metrics) are copied into numpy columns, so that the filters
+and weighers which provide a vectorized kernel (filter_columns() and
+weigh_columns()) are evaluated over every host at once. Filters and weighers
+without a kernel still run per host, on the hosts that passed the kernels.
+"""
+
+from oslo.config import cfg
+
+from nova.i18n import _, _LW
+from nova.openstack.common import log as logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+host_table_opts = [
+    cfg.BoolOpt('scheduler_use_host_table',
+                default=False,
+                help='Filter and weigh hosts over a columnar table of their '
+                     'resources (requires numpy). Filters and weighers that '
+                     'provide a vectorized kernel are evaluated over every '
+                     'host at once, the other ones still run per host.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(host_table_opts)
+
+LOG = logging.getLogger(__name__)
+
+# HostState attributes copied into the columns of the table
+COLUMNS = ('free_ram_mb', 'total_usable_ram_mb', 'free_disk_mb',
+           'total_usable_disk_gb', 'vcpus_total', 'vcpus_used',
+           'num_instances', 'num_io_ops')
+
+_warned_unavailable = False
+
+
+def is_enabled():
+    """Check if hosts are filtered and weighed over a host table."""
+    global _warned_unavailable
+
+    if not CONF.scheduler_use_host_table:
+        return False
+    if numpy is None:
+        if not _warned_unavailable:
+            LOG.warn(_LW("scheduler_use_host_table is set but numpy is not "
+                         "installed: hosts are filtered and weighed one by "
+                         "one"))
+            _warned_unavailable = True
+        return False
+    return True
+
+
+class HostTable(object):
+    """Columns of the resources of a list of host states.
+
+    The table also tracks the hosts that are still selected while filters
+    are applied, so that filters only set the limits of these hosts.
+    """
+
+    def __init__(self, host_states):
+        self.host_states = list(host_states)
+        self.columns = {}
+        for name in COLUMNS:
+            column = numpy.array([getattr(x, name) for x in self.host_states],
+                                 dtype=numpy.float64)
+            if numpy.isnan(column).any():
+                raise ValueError(_("%s is not set on every host") % name)
+            self.columns[name] = column
+        self.metrics = {}
+        self.selected = self.new_column(True)
+
+    def __len__(self):
+        return len(self.host_states)
+
+    def new_column(self, value):
+        """Returns a column filled with the given value."""
+        return numpy.full(len(self.host_states), value)
+
+    def column(self, name):
+        """Returns the column of a HostState attribute."""
+        return self.columns[name]
+
+    def metric(self, name):
+        """Returns a tuple (values, available) of columns for a metric of
+        the hosts: the value of a host that does not report the metric is
+        0.
+        """
+        if name not in self.metrics:
+            values = self.new_column(0.0)
+            available = self.new_column(False)
+            for (i, host_state) in enumerate(self.host_states):
+                item = host_state.metrics.get(name)
+                if item is not None:
+                    values[i] = item.value
+                    available[i] = True
+            self.metrics[name] = (values, available)
+        return self.metrics[name]
+
+    def set_limits(self, name, limits, passes):
+        """Set a resource limit on the selected hosts that pass a filter."""
+        for i in numpy.flatnonzero(self.selected & passes):
+            self.host_states[i].limits[name] = float(limits[i])
+
+    def selected_hosts(self):
+        """Returns the host states that are still selected."""
+        return [self.host_states[i] for i in numpy.flatnonzero(self.selected)]
+
+
+def normalize(weights, minval, maxval):
+    """Vectorized nova.weights.normalize()."""
+    minval = float(minval)
+    maxval = float(maxval)
+    if minval == maxval:
+        return numpy.zeros(len(weights))
+    return (weights - minval) / (maxval - minval)
+
+
+def filter_hosts(filter_handler, filter_classes, hosts, filter_properties,
+                 index=0):
+    """Filter hosts like filter_handler.get_filtered_objects(): the
+    vectorized filters are applied first over a host table, then the other
+    filters run on the remaining hosts.
+    """
+    hosts = list(hosts)
+    try:
+        table = HostTable(hosts)
+    except (TypeError, ValueError) as e:
+        LOG.debug("Filtering hosts one by one: %s", e)
+        return filter_handler.get_filtered_objects(filter_classes, hosts,
+                                                   filter_properties, index)
+
+    LOG.debug("Starting with %d host(s)", len(table))
+    remaining_classes = []
+    for filter_cls in filter_classes:
+        host_filter = filter_cls()
+        passes = None
+        if host_filter.run_filter_for_index(index):
+            passes = host_filter.filter_columns(table, filter_properties)
+        if passes is None:
+            remaining_classes.append(filter_cls)
+            continue
+
+        table.selected &= passes
+        num_selected = numpy.count_nonzero(table.selected)
+        if not num_selected:
+            LOG.info(_("Filter %s returned 0 hosts"), filter_cls.__name__)
+            return []
+        LOG.debug("Filter %(cls_name)s returned %(obj_len)d host(s)",
+                  {'cls_name': filter_cls.__name__, 'obj_len': num_selected})
+
+    return filter_handler.get_filtered_objects(remaining_classes,
+                                               table.selected_hosts(),
+                                               filter_properties, index)
+
+
+def weigh_hosts(weight_handler, weigher_classes, hosts, weight_properties,
+                limit=None):
+    """Weigh hosts like weight_handler.get_weighed_objects(): the weights of
+    the vectorized weighers are computed over a host table, the other ones
+    per host.
+
+    :param limit: if set, only the given number of best hosts are returned
+                  (they are selected with a partition, before being sorted)
+    """
+    hosts = list(hosts)
+    try:
+        table = HostTable(hosts)
+    except (TypeError, ValueError) as e:
+        LOG.debug("Weighing hosts one by one: %s", e)
+        weighed_hosts = weight_handler.get_weighed_objects(
+            weigher_classes, hosts, weight_properties)
+        return weighed_hosts[:limit]
+    if not len(table):
+        return []
+
+    totals = numpy.zeros(len(table))
+    weighed_objs = None
+    for weigher_cls in weigher_classes:
+        weigher = weigher_cls()
+        weights = weigher.weigh_columns(table, weight_properties)
+        if weights is None:
+            if weighed_objs is None:
+                weighed_objs = [weight_handler.object_class(x, 0.0)
+                                for x in table.host_states]
+            weights = numpy.array(
+                weigher.weigh_objects(weighed_objs, weight_properties),
+                dtype=numpy.float64)
+            minval = weigher.minval
+            maxval = weigher.maxval
+        else:
+            # Same bounds as BaseWeigher.weigh_objects(): the minval and
+            # maxval set by a weigher are extended by the computed weights
+            minval = weights.min()
+            if weigher.minval is not None:
+                minval = min(weigher.minval, minval)
+            maxval = weights.max()
+            if weigher.maxval is not None:
+                maxval = max(weigher.maxval, maxval)
+        totals += weigher.weight_multiplier() * normalize(weights, minval,
+                                                          maxval)
+
+    # Hosts are sorted by decreasing weight, hosts with the same weight
+    # keeping their order (as the stable sort of get_weighed_objects())
+    candidates = numpy.arange(len(table))
+    if limit is not None and limit < len(table):
+        best = numpy.argpartition(-totals, limit - 1)[:limit]
+        candidates = numpy.flatnonzero(totals >= totals[best].min())
+    order = candidates[numpy.lexsort((candidates, -totals[candidates]))]
+    return [weight_handler.object_class(table.host_states[i], float(totals[i]))
+            for i in order[:limit]]
@@ -60,7 +60,7 @@ QUOTAS = quota.QUOTAS
 class SchedulerManager(manager.Manager):
     """Chooses a host to run instances on."""
 
-    target = messaging.Target(version='3.0')
+    target = messaging.Target(version='3.1')
 
     def __init__(self, scheduler_driver=None, *args, **kwargs):
         if not scheduler_driver:
@@ -174,3 +174,15 @@ class SchedulerManager(manager.Manager):
         dests = self.driver.select_destinations(context, request_spec,
             filter_properties)
         return jsonutils.to_primitive(dests)
+
+    def select_destinations_batch(self, context, requests):
+        """Returns the destinations best suited for each of many independent
+        requests, given as dicts with 'request_spec' and 'filter_properties'
+        as keys.
+
+        The result is a list with, for each request, a list of dicts with
+        'host', 'nodename' and 'limits' as keys, or None if no valid host
+        was found for the request.
+        """
+        results = self.driver.select_destinations_batch(context, requests)
+        return jsonutils.to_primitive(results)
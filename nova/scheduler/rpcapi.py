@@ -19,6 +19,7 @@ Client side of the scheduler manager RPC API.
 from oslo.config import cfg
 from oslo import messaging
 
+from nova import exception
 from nova.objects import base as objects_base
 from nova import rpc
 
@@ -84,6 +85,8 @@ class SchedulerAPI(object):
         existing methods in 3.x after that point should be done such that they
         can handle the version_cap being set to 3.0.
 
+        * 3.1 - Add select_destinations_batch()
+
     '''
 
     VERSION_ALIASES = {
@@ -106,3 +109,21 @@ class SchedulerAPI(object):
         cctxt = self.client.prepare()
         return cctxt.call(ctxt, 'select_destinations',
             request_spec=request_spec, filter_properties=filter_properties)
+
+    def select_destinations_batch(self, ctxt, requests):
+        version = '3.1'
+        if not self.client.can_send_version(version):
+            # NOTE: the scheduler does not know batches: the requests are
+            # sent one by one
+            results = []
+            for request in requests:
+                try:
+                    results.append(self.select_destinations(
+                        ctxt, request['request_spec'],
+                        request['filter_properties']))
+                except exception.NoValidHost:
+                    results.append(None)
+            return results
+        cctxt = self.client.prepare(version=version)
+        return cctxt.call(ctxt, 'select_destinations_batch',
+                          requests=requests)
@@ -0,0 +1,223 @@
+# Copyright (c) 2014 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Resource claims shared by scheduler workers.
+
+Each scheduler worker caching host states consumes the resources of the
+instances it schedules from its own copy. The claims are also published to
+memcached (see memcached_servers), so that the other workers apply them to
+their copy before scheduling:
+
+- a claim on a host is numbered with an atomic increment of the claim
+  counter of the host, so concurrent claims never overwrite each other;
+- a claim is then stored under its number, and expires after
+  scheduler_shared_claims_ttl seconds;
+- claims older than the last report of a compute node are already counted
+  in its resources, and are not applied again.
+"""
+
+import datetime
+import hashlib
+
+from oslo.config import cfg
+from oslo.utils import timeutils
+
+from nova.i18n import _LW
+from nova.openstack.common import log as logging
+from nova.openstack.common import memorycache
+
+shared_claims_opts = [
+    cfg.BoolOpt('scheduler_share_claims',
+                default=False,
+                help='Share the resources claimed by the scheduler workers '
+                     'that cache host states (CachingScheduler) through the '
+                     'memcached servers set by memcached_servers, so that '
+                     'each worker sees the claims of the other ones. '
+                     'Without memcached servers, claims are only shared '
+                     'within a process.'),
+    cfg.IntOpt('scheduler_shared_claims_ttl',
+               default=600,
+               help='Number of seconds a shared claim is kept. It should '
+                    'be longer than the interval between the resource '
+                    'reports of the compute nodes.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(shared_claims_opts)
+
+LOG = logging.getLogger(__name__)
+
+# Instance fields used by HostState.consume_from_instance() which are
+# published with a claim (PCI requests are not shared)
+CLAIM_FIELDS = ('root_gb', 'ephemeral_gb', 'memory_mb', 'vcpus', 'vm_state',
+                'task_state', 'numa_topology')
+
+# Maximum number of claims on a host read at once: older claims are skipped
+# (a worker that starts does not read every claim ever numbered)
+MAX_READ_CLAIMS = 256
+
+
+def _host_key(state_key):
+    """Returns the memcached key prefix of the claims on a host: host and
+    node names are hashed, as they may contain characters memcached does not
+    allow in keys.
+    """
+    return 'scheduler-claims-%s' % hashlib.md5(
+        '%s\0%s' % state_key).hexdigest()
+
+
+def _counter_key(state_key):
+    return _host_key(state_key) + '-count'
+
+
+def _claim_key(state_key, number):
+    return '%s-%d' % (_host_key(state_key), number)
+
+
+class SharedClaims(object):
+    """Claims on hosts, published to and read from a memcached client."""
+
+    def __init__(self, client=None):
+        if client is None:
+            client = memorycache.get_client()
+        self.client = client
+        # Claims known by this worker, by state key: {number: claim}
+        self.claims = {}
+        # Number of the last claim read, by state key: the claims after it
+        # are all read, except the gaps
+        self.last_numbers = {}
+        # Claims numbered but not stored yet, by state key: {number: time the
+        # number was first seen}. They are read again until they are stored
+        # or older than scheduler_shared_claims_ttl.
+        self.gaps = {}
+        # HostState.updated after the claims were last applied, by state key
+        self.applied = {}
+
+    def _get_multi(self, keys):
+        if hasattr(self.client, 'get_multi'):
+            return self.client.get_multi(keys)
+        result = {}
+        for key in keys:
+            value = self.client.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def _next_number(self, state_key):
+        counter_key = _counter_key(state_key)
+        number = self.client.incr(counter_key)
+        if number is None:
+            # The counter does not exist yet: add() fails if another worker
+            # created it meanwhile, then the increment succeeds.
+            self.client.add(counter_key, '0')
+            number = self.client.incr(counter_key)
+        return number
+
+    def publish(self, host_state, instance):
+        """Publish the claim of an instance, already consumed from the given
+        host state.
+        """
+        state_key = (host_state.host, host_state.nodename)
+        claim = {'created_at': timeutils.utcnow(),
+                 'instance': dict((key, instance[key]) for key in CLAIM_FIELDS
+                                  if key in instance)}
+        try:
+            number = self._next_number(state_key)
+            if number is None:
+                raise ValueError(_counter_key(state_key))
+            self.client.set(_claim_key(state_key, number), claim,
+                            time=CONF.scheduler_shared_claims_ttl)
+        except Exception as e:
+            LOG.warn(_LW("Could not publish a claim on %(host)s:%(node)s: "
+                         "%(error)s"), {'host': host_state.host,
+                                        'node': host_state.nodename,
+                                        'error': e})
+            return
+        self.claims.setdefault(state_key, {})[number] = claim
+        self.applied[state_key] = host_state.updated
+
+    def apply(self, host_states):
+        """Apply to the given host states the claims published by the other
+        workers since they were last applied, and return the host states.
+
+        A host state whose compute node was reported again since then has
+        been reset to this report: every known claim created after the
+        report is applied again, including the claims of this worker.
+        """
+        host_states = list(host_states)
+        state_keys = [(x.host, x.nodename) for x in host_states]
+        read_numbers = {}
+        try:
+            counters = self._get_multi([_counter_key(x) for x in state_keys])
+            claim_keys = []
+            for state_key in state_keys:
+                number = int(counters.get(_counter_key(state_key)) or 0)
+                first = max(self.last_numbers.get(state_key, 0),
+                            number - MAX_READ_CLAIMS) + 1
+                read_numbers[state_key] = range(first, number + 1)
+                known = self.claims.get(state_key, {})
+                claim_keys += [_claim_key(state_key, i)
+                               for i in read_numbers[state_key]
+                               if i not in known]
+            fetched = self._get_multi(claim_keys) if claim_keys else {}
+        except Exception as e:
+            LOG.warn(_LW("Could not read the shared claims: %s"), e)
+            return host_states
+
+        now = timeutils.utcnow()
+        expired = now - datetime.timedelta(
+            seconds=CONF.scheduler_shared_claims_ttl)
+        for (host_state, state_key) in zip(host_states, state_keys):
+            known = self.claims.setdefault(state_key, {})
+            gaps = self.gaps.setdefault(state_key, {})
+            numbers = []
+            last_number = self.last_numbers.get(state_key, 0)
+            complete = True
+            for i in read_numbers[state_key]:
+                if i not in known:
+                    claim = fetched.get(_claim_key(state_key, i))
+                    if claim is not None:
+                        gaps.pop(i, None)
+                        if claim['created_at'] >= expired:
+                            known[i] = claim
+                            numbers.append(i)
+                    elif gaps.setdefault(i, now) < expired:
+                        # The claim was never stored, or already expired
+                        del gaps[i]
+                    else:
+                        # The claim is numbered but not stored yet: it is
+                        # read again next time
+                        complete = False
+                if complete:
+                    last_number = i
+            self.last_numbers[state_key] = last_number
+            for i in [x for x in gaps if x <= last_number]:
+                del gaps[i]
+
+            reported = host_state.updated
+            if (state_key not in self.applied or
+                    self.applied[state_key] != reported):
+                numbers = [i for (i, claim) in known.iteritems()
+                           if reported is None or
+                           claim['created_at'] > reported]
+            for i in sorted(numbers):
+                host_state.consume_from_instance(known[i]['instance'])
+            self.applied[state_key] = host_state.updated
+
+            for (i, claim) in known.items():
+                if claim['created_at'] < expired:
+                    del known[i]
+        return host_states
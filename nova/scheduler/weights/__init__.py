@@ -37,7 +37,14 @@ class WeighedHost(weights.WeighedObject):
 
 class BaseHostWeigher(weights.BaseWeigher):
     """Base class for host weights."""
-    pass
+
+    def weigh_columns(self, host_table, weight_properties):
+        """Vectorized _weigh_object(), evaluated over the columns of a
+        nova.scheduler.host_table.HostTable. Return an array of weights (one
+        per host of the table), or None if the weigher has to run per host.
+        Override this in a subclass.
+        """
+        return None
 
 
 class HostWeightHandler(weights.BaseWeightHandler):
@@ -49,3 +49,6 @@ class IoOpsWeigher(weights.BaseHostWeigher):
         to be the default.
         """
         return host_state.num_io_ops
+
+    def weigh_columns(self, host_table, weight_properties):
+        return host_table.column('num_io_ops')
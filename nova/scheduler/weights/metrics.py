@@ -102,3 +102,20 @@ class MetricsWeigher(weights.BaseHostWeigher):
                         return CONF.metrics.weight_of_unavailable
 
         return value
+
+    def weigh_columns(self, host_table, weight_properties):
+        weights = host_table.new_column(0.0)
+        unavailable = host_table.new_column(False)
+
+        for (name, ratio) in self.setting:
+            values, available = host_table.metric(name)
+            if not available.all():
+                if CONF.metrics.required:
+                    # Let _weigh_object() raise ComputeHostMetricNotFound
+                    return None
+                if ratio * self.weight_multiplier() != 0:
+                    unavailable |= ~available
+            weights += values * ratio
+
+        weights[unavailable] = CONF.metrics.weight_of_unavailable
+        return weights
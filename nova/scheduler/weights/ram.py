@@ -45,3 +45,6 @@ class RAMWeigher(weights.BaseHostWeigher):
     def _weigh_object(self, host_state, weight_properties):
         """Higher weights win.  We want spreading to be the default."""
         return host_state.free_ram_mb
+
+    def weigh_columns(self, host_table, weight_properties):
+        return host_table.column('free_ram_mb')
@@ -0,0 +1,66 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fixtures
+from oslo.config import cfg
+
+from nova.db.discovery import aggregates
+from nova.db.discovery import allocator
+from nova.db.discovery import cache
+from nova.db.discovery import client
+from nova.db.discovery import codec
+from nova.db.discovery import guards
+from nova.db.discovery import indexes
+from nova.db.discovery import key_index
+from nova.db.discovery import storage
+from nova.db.discovery import table_cache
+from nova.db.discovery import versions
+
+CONF = cfg.CONF
+
+
+class StorageFixture(fixtures.Fixture):
+    """Back the discovery database backend by an empty memory storage, and
+    forget what the modules of the backend know of the previous storage.
+    """
+
+    def setUp(self):
+        super(StorageFixture, self).setUp()
+        CONF.set_override('storage', 'memory', group='discovery')
+        self.addCleanup(CONF.clear_override, 'storage', group='discovery')
+        self._reset()
+        self.addCleanup(self._reset)
+
+    def _reset(self):
+        storage.reset_storages()
+        client.reset_client()
+        for configured in (aggregates.CONFIGURED_BUCKETS,
+                           guards.CONFIGURED_BUCKETS,
+                           table_cache.CONFIGURED_BUCKETS,
+                           versions.CONFIGURED_BUCKETS):
+            configured.clear()
+        key_index.KEY_INDEX_BUCKET_CONFIGURED = False
+        key_index.MIGRATED_TABLES.clear()
+        aggregates.COUNTED_READY.clear()
+        indexes.INDEXED_TABLES.clear()
+        allocator.ID_ALLOCATOR.leases.clear()
+        allocator.ID_ALLOCATOR.counters_configured = False
+        codec.SCHEMA_REGISTRY.schemas.clear()
+        codec.SCHEMA_REGISTRY.model_schema_ids.clear()
+        table_cache.TABLE_CACHE.clear()
+        versions.VERSION_CACHE.clear()
+        for manager in cache.CACHE_MANAGERS:
+            manager.clear()
+
+    @property
+    def storage(self):
+        return storage.get_storage('memory')
@@ -0,0 +1,107 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.db.discovery import aggregates
+from nova.db.discovery import batch
+from nova.db.discovery import guards
+from nova.db.discovery import models
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+from nova.tests.db.discovery import test_batch
+
+
+class CountersTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(CountersTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self.stubs.Set(guards.time, 'sleep', lambda delay: None)
+        self.key = aggregates.get_counter_key(
+            'instances', ('project_id',), {'project_id': 'fake-project'},
+            None)
+        self.counters_bucket = aggregates.get_counters_bucket()
+
+    def _store_instances(self, count):
+        # Objects stored before the counters are built, which are off
+        write_batch = batch.WriteBatch()
+        for i in xrange(1, count + 1):
+            write_batch.add('instances', i, None, None,
+                            test_batch._instance(i), models.Instance)
+        write_batch.flush()
+        self.counters_bucket.update_counter(self.key, 5)
+
+    def test_ensure_counters(self):
+        self._store_instances(2)
+        self.assertTrue(aggregates.ensure_counters('instances'))
+        self.assertEqual(2, self.counters_bucket.get_counter(self.key))
+
+        # Another worker finds the counters ready
+        aggregates.COUNTED_READY.clear()
+        with mock.patch.object(aggregates, 'rebuild_counters') as rebuild:
+            self.assertTrue(aggregates.ensure_counters('instances'))
+        self.assertFalse(rebuild.called)
+        self.assertEqual(2, self.counters_bucket.get_counter(self.key))
+
+    def test_rebuilt_by_another_worker_meanwhile(self):
+        self._store_instances(2)
+        status_bucket = aggregates.get_client().bucket(
+            aggregates.AGGREGATES_STATUS_BUCKET)
+
+        guarded = guards.guarded
+
+        def rebuilt_meanwhile(name, **kwargs):
+            status_bucket.new('instances', data={'ready': True}).store()
+            return guarded(name, **kwargs)
+
+        with mock.patch.object(aggregates.guards, 'guarded',
+                               side_effect=rebuilt_meanwhile):
+            with mock.patch.object(aggregates, 'rebuild_counters') as rebuild:
+                self.assertTrue(aggregates.ensure_counters('instances'))
+        self.assertFalse(rebuild.called)
+
+    def test_rebuild_waits_for_guard(self):
+        self._store_instances(1)
+        guard = guards.Guard(aggregates.counters_guard_name('instances'))
+        guard.acquire()
+        self.assertFalse(aggregates.ensure_counters('instances'))
+        guard.release()
+        self.assertTrue(aggregates.ensure_counters('instances'))
+        self.assertEqual(1, self.counters_bucket.get_counter(self.key))
+
+    def test_counters_updated_during_scan(self):
+        self._store_instances(1)
+        aggregates.forget_counters('instances')
+        aggregates.COUNTED_READY.clear()
+        iter_key_shards = aggregates.key_index.iter_key_shards
+
+        def update_during_scan(tablename):
+            self.counters_bucket.update_counter(self.key, 1)
+            return iter_key_shards(tablename)
+
+        with mock.patch.object(aggregates.key_index, 'iter_key_shards',
+                               side_effect=update_during_scan) as scan:
+            self.assertFalse(aggregates.ensure_counters('instances'))
+        self.assertEqual(aggregates.REBUILD_ATTEMPTS, scan.call_count)
+        self.assertNotIn('instances', aggregates.COUNTED_READY)
+
+    def test_forget_counters(self):
+        self._store_instances(1)
+        self.assertTrue(aggregates.ensure_counters('instances'))
+        aggregates.forget_counters('instances')
+        self.assertNotIn('instances', aggregates.COUNTED_READY)
+        status = aggregates.get_client().bucket(
+            aggregates.AGGREGATES_STATUS_BUCKET).get('instances')
+        self.assertFalse(status.data['ready'])
+        self.assertEqual([self.key], [x for x in status.data['keys']
+                                      if x == self.key])
@@ -0,0 +1,61 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.db.discovery import allocator
+from nova.db.discovery import key_index
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+class IdAllocatorTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(IdAllocatorTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+
+    def test_allocate(self):
+        id_allocator = allocator.IdAllocator(block_size=3)
+        self.assertEqual([1, 2, 3, 4, 5],
+                         [id_allocator.allocate('instances')
+                          for i in xrange(5)])
+        self.assertEqual(1, id_allocator.allocate('services'))
+
+    def test_processes_lease_distinct_blocks(self):
+        allocators = [allocator.IdAllocator(block_size=2) for i in xrange(2)]
+        ids = [x.allocate('instances') for i in xrange(3)
+               for x in allocators]
+        self.assertEqual(sorted(ids), sorted(set(ids)))
+        self.assertEqual([1, 3, 2, 4, 5, 7], ids)
+
+    def test_counter_above_existing_keys(self):
+        key_index.add_keys('instances', [1, 1500])
+        id_allocator = allocator.IdAllocator(block_size=10)
+        self.assertTrue(id_allocator.allocate('instances') > 1500)
+
+    def test_first_leases_interleaved_above_existing_keys(self):
+        # The second process leases its first block while the first one
+        # moves the counter above the existing keys
+        key_index.add_keys('instances', [5])
+        first = allocator.IdAllocator(block_size=10)
+        second = allocator.IdAllocator(block_size=10)
+        second_ids = []
+        find_highest_existing_key = first.find_highest_existing_key
+
+        def interleave(tablename):
+            second_ids.extend(second.allocate(tablename)
+                              for i in xrange(10))
+            return find_highest_existing_key(tablename)
+
+        self.stubs.Set(first, 'find_highest_existing_key', interleave)
+        first_ids = [first.allocate('instances') for i in xrange(10)]
+        self.assertEqual(range(11, 21), second_ids)
+        self.assertEqual(range(21, 31), first_ids)
@@ -0,0 +1,68 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests of the database API of the discovery backend, on a memory
+storage."""
+
+import datetime
+import imp
+
+import mock
+from oslo.utils import timeutils
+
+from nova import context
+from nova.db.discovery import api as db_api
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+from nova.tests.db.discovery import test_bench
+
+
+class ComputeNodeTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(ComputeNodeTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        bench = imp.load_source('discovery_bench', test_bench.BENCH_PATH)
+        bench.use_storage('memory', None)
+        self.context = context.get_admin_context()
+        with bench.silenced():
+            bench.populate(self.context, 2, 0, 1)
+            self.compute_nodes = db_api.compute_node_get_all(self.context,
+                                                             False)
+            self.since = timeutils.utcnow() - datetime.timedelta(seconds=60)
+            db_api.compute_node_delete(self.context,
+                                       self.compute_nodes[0]['id'])
+
+    def test_changed_since_returns_deleted(self):
+        result = db_api.compute_node_get_all_changed_since(self.context,
+                                                           self.since)
+        by_id = dict((x['id'], x) for x in result)
+        self.assertEqual(sorted(x['id'] for x in self.compute_nodes),
+                         sorted(by_id))
+        deleted = by_id[self.compute_nodes[0]['id']]
+        self.assertTrue(deleted['deleted'])
+        self.assertIsNotNone(deleted['deleted_at'])
+        self.assertIsNone(deleted['service'])
+        self.assertFalse(by_id[self.compute_nodes[1]['id']]['deleted'])
+
+    def test_changed_since_skips_old_deletions(self):
+        since = timeutils.utcnow() + datetime.timedelta(seconds=60)
+        self.assertEqual(
+            [], db_api.compute_node_get_all_changed_since(self.context,
+                                                          since))
+
+    def test_changed_since_reads_recent_deletions_only(self):
+        since = timeutils.utcnow() + datetime.timedelta(seconds=60)
+        with mock.patch.object(db_api, 'fetch_stored_values',
+                               wraps=db_api.fetch_stored_values) as fetch:
+            db_api.compute_node_get_all_changed_since(self.context, since)
+        fetch.assert_called_once_with('compute_nodes', [])
@@ -0,0 +1,118 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.db.discovery import aggregates
+from nova.db.discovery import batch
+from nova.db.discovery import client
+from nova.db.discovery import key_index
+from nova.db.discovery import models
+from nova.db.discovery import versions
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+def _instance(key, **values):
+    value = {'id': key, 'nova_classname': 'instances',
+             'uuid': 'fake-uuid-%d' % key, 'project_id': 'fake-project',
+             'user_id': 'fake-user', 'vcpus': 2, 'memory_mb': 512}
+    value.update(values)
+    return value
+
+
+class WriteBatchTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(WriteBatchTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+
+    def _flush(self, writes, concurrency=None):
+        known_versions = batch.load_versions('instances',
+                                             [x['id'] for x in writes])
+        write_batch = batch.WriteBatch(concurrency=concurrency)
+        for value in writes:
+            (vclock, previous_value) = known_versions[value['id']]
+            write_batch.add('instances', value['id'], vclock, previous_value,
+                            value, models.Instance,
+                            deleted=bool(value.get('deleted')))
+        return write_batch.flush()
+
+    def _get_counter(self, field=None):
+        key = aggregates.get_counter_key('instances', ('project_id',),
+                                         {'project_id': 'fake-project'},
+                                         field)
+        return aggregates.get_counters_bucket().get_counter(key) or 0
+
+    def test_flush(self):
+        stored = self._flush([_instance(i) for i in xrange(1, 4)],
+                             concurrency=2)
+        self.assertEqual(3, len(stored))
+        self.assertTrue(all(x.stored for x in stored))
+
+        bucket = versions.get_object_bucket(client.get_client(), 'instances')
+        self.assertEqual('fake-uuid-2', bucket.get('2').data['uuid'])
+        self.assertEqual(['2'], bucket.get_index('uuid_bin', 'fake-uuid-2'))
+        self.assertEqual([1, 2, 3], key_index.get_keys('instances'))
+        self.assertEqual(3, self._get_counter())
+        self.assertEqual(6, self._get_counter('vcpus'))
+
+    def test_flush_counts_operations_for_caller(self):
+        self._flush([_instance(1)])
+        operations = client.get_operation_count()
+        self._flush([_instance(i) for i in xrange(2, 5)], concurrency=1)
+        sequential = client.get_operation_count() - operations
+
+        operations = client.get_operation_count()
+        self._flush([_instance(i) for i in xrange(5, 8)], concurrency=3)
+        self.assertEqual(sequential,
+                         client.get_operation_count() - operations)
+
+    def test_flush_update_and_delete(self):
+        self._flush([_instance(1), _instance(2)])
+        self._flush([_instance(1, vcpus=4), _instance(2, deleted=2)])
+
+        bucket = versions.get_object_bucket(client.get_client(), 'instances')
+        self.assertEqual(4, bucket.get('1').data['vcpus'])
+        self.assertEqual([], bucket.get_index('uuid_bin', 'fake-uuid-2'))
+        self.assertEqual([1], key_index.get_keys('instances'))
+        self.assertEqual(1, self._get_counter())
+        self.assertEqual(4, self._get_counter('vcpus'))
+
+    def test_flush_empty(self):
+        self.assertEqual([], batch.WriteBatch().flush())
+
+    def test_load_versions(self):
+        self._flush([_instance(1)])
+        versions.VERSION_CACHE.clear()
+        known_versions = batch.load_versions('instances', [1, 2])
+        self.assertEqual('fake-uuid-1', known_versions[1][1]['uuid'])
+        self.assertIsNotNone(known_versions[1][0])
+        self.assertIsNone(known_versions[2][1])
+
+    def test_flush_raises_failure_after_other_writes(self):
+        store_object = versions.store_object
+
+        def fail_second(riak_object):
+            if riak_object.key == '2':
+                raise ValueError('fake')
+            return store_object(riak_object)
+
+        with mock.patch.object(batch.versions, 'store_object', fail_second):
+            with mock.patch.object(batch.LOG, 'exception') as exception:
+                self.assertRaises(ValueError, self._flush,
+                                  [_instance(i) for i in xrange(1, 4)],
+                                  concurrency=2)
+        exception.assert_called_once_with(mock.ANY, 'instances', 2)
+        self.assertEqual([1, 3], key_index.get_keys('instances'))
+        self.assertEqual(2, self._get_counter())
+        self.assertIsNone(versions.VERSION_CACHE.lookup('instances', 2))
@@ -0,0 +1,69 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Round trips of the hot calls of the discovery database API, measured by
+tools/db/discovery_bench.py on a memory storage."""
+
+import imp
+import optparse
+import os
+
+import nova
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+BENCH_PATH = os.path.join(os.path.dirname(nova.__file__), os.pardir,
+                          'tools', 'db', 'discovery_bench.py')
+
+# Round trips allowed to each call of the benchmark (averaged over two
+# calls, the first one with cold caches), for 5 services (and compute
+# nodes), 20 instances and 2 projects
+ROUND_TRIP_BUDGETS = {
+    'instance_get_all_by_filters': 75,
+    'compute_node_get_all': 30,
+    'quota_reserve': 85,
+    'service_update': 45,
+    'instance_update': 4,
+}
+
+
+class DiscoveryBenchTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(DiscoveryBenchTestCase, self).setUp()
+        self.storage = self.useFixture(storage_fixture.StorageFixture())
+        self.bench = imp.load_source('discovery_bench', BENCH_PATH)
+
+    def _bench_api(self, services=5, instances=20, projects=2):
+        options = optparse.Values({'storage': 'memory', 'storage_path': None,
+                                   'services': services,
+                                   'instances': instances,
+                                   'projects': projects, 'repeat': 2})
+        return self.bench.bench_api(options)
+
+    def test_populate(self):
+        self.bench.use_storage('memory', None)
+        context = self.bench.nova_context.get_admin_context()
+        with self.bench.silenced():
+            (service_ids, instance_uuids) = self.bench.populate(context, 2,
+                                                                6, 2)
+        self.assertEqual(2, len(service_ids))
+        self.assertEqual(6, len(set(instance_uuids)))
+
+    def test_round_trip_budgets(self):
+        results = self._bench_api()
+        self.assertEqual(sorted(ROUND_TRIP_BUDGETS), sorted(results))
+        for (name, budget) in ROUND_TRIP_BUDGETS.items():
+            round_trips = results[name][1]
+            self.assertTrue(round_trips <= budget,
+                            '%s: %.1f round trips, budget %d' %
+                            (name, round_trips, budget))
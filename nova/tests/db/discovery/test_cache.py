@@ -0,0 +1,67 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.db.discovery import cache
+from nova import test
+
+
+class RequestCacheManagerTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(RequestCacheManagerTestCase, self).setUp()
+        self.manager = cache.RequestCacheManager('fake', max_size=2, ttl=10)
+        self.addCleanup(cache.CACHE_MANAGERS.remove, self.manager)
+
+    @mock.patch('time.time', return_value=100)
+    def test_get(self, mock_time):
+        first = self.manager.get('request1')
+        first['key'] = 'value'
+        self.assertIs(first, self.manager.get('request1'))
+        second = self.manager.reset('request1')
+        self.assertEqual({}, second)
+        self.assertIs(second, self.manager.get('request1'))
+        self.assertEqual(2, self.manager.hits)
+        self.assertEqual(1, self.manager.misses)
+
+    @mock.patch('time.time', return_value=100)
+    def test_least_recently_used_are_evicted(self, mock_time):
+        self.manager.get('request1')
+        self.manager.get('request2')
+        self.manager.get('request1')
+        self.manager.get('request3')
+        self.assertIn('request1', self.manager)
+        self.assertNotIn('request2', self.manager)
+        self.assertIn('request3', self.manager)
+        self.assertEqual(1, self.manager.evictions)
+
+    @mock.patch('time.time')
+    def test_expired_are_evicted(self, mock_time):
+        mock_time.return_value = 100
+        self.manager.get('request1')
+        mock_time.return_value = 111
+        self.manager.get('request2')
+        self.assertNotIn('request1', self.manager)
+        self.assertEqual(1, len(self.manager))
+
+    def test_request_scope(self):
+        with cache.request_scope(managers=[self.manager]) as request_uuid:
+            self.manager.get(request_uuid)
+            self.assertIn(request_uuid, self.manager)
+        self.assertNotIn(request_uuid, self.manager)
+
+    def test_stats(self):
+        self.manager.get('request1')
+        self.assertIn({'name': 'fake', 'size': 1, 'max_size': 2, 'hits': 0,
+                       'misses': 1, 'evictions': 0},
+                      cache.get_cache_stats())
@@ -0,0 +1,71 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+
+from nova.db.discovery import client
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+class ClientTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(ClientTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+
+    def test_parse_options(self):
+        self.assertEqual(2, client.parse_quorum('2'))
+        self.assertEqual('quorum', client.parse_quorum('quorum'))
+        self.assertIsNone(client.parse_quorum(None))
+        self.assertEqual({'host': 'riak-1', 'pb_port': 10017},
+                         client.parse_node('riak-1:10017'))
+        self.assertEqual({'host': 'riak-1',
+                          'pb_port': client.DEFAULT_PB_PORT},
+                         client.parse_node('riak-1'))
+
+    def test_set_default_options(self):
+        params = {'r': 1, 'pr': None}
+        client.set_default_options(params, {'r': 2, 'pr': 'quorum',
+                                            'timeout': None})
+        self.assertEqual({'r': 1, 'pr': 'quorum'}, params)
+
+    def test_client_per_process(self):
+        riak_client = client.get_client()
+        self.assertIs(riak_client, client.get_client())
+        client.reset_client()
+        self.assertIsNot(riak_client, client.get_client())
+
+    def test_count_operations(self):
+        bucket = client.get_client().bucket('services')
+        operations = client.get_operation_count()
+        bucket.new('1', data={'id': 1}).store()
+        bucket.get('1')
+        bucket.get_index('host_bin', 'fake-host')
+        bucket.multiget(['1', '2', '3'])
+        self.assertEqual(6, client.get_operation_count() - operations)
+
+    def test_count_operations_of_greenthreads(self):
+        bucket = client.get_client().bucket('services')
+        operations = client.get_operation_count()
+        counter = client.get_operation_counter()
+
+        def fetch(key):
+            client.use_operation_counter(counter)
+            return bucket.get(key)
+
+        pool = eventlet.GreenPool(2)
+        list(pool.imap(fetch, ['1', '2', '3']))
+        # Operations of greenthreads that do not share the counter of the
+        # thread are not counted for it
+        pool.spawn(bucket.get, '4').wait()
+        self.assertEqual(3, client.get_operation_count() - operations)
@@ -0,0 +1,83 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.db.discovery import client
+from nova.db.discovery import codec
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+DATETIME = {'simplify_strategy': 'datetime', 'epoch': 1400000000,
+            'timezone': 'UTC'}
+REFERENCE = {'simplify_strategy': 'novabase', 'tablename': 'instances',
+             'novabase_classname': 'Instance', 'id': 7}
+
+
+class CodecTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(CodecTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+
+    def test_encode_decode_value(self):
+        value = {'created_at': DATETIME, 'instance': REFERENCE,
+                 'network': {'simplify_strategy': 'ipnetwork',
+                             'value': '10.0.0.0/24'},
+                 'tags': ['~d', 'not', 'a', 'datetime'], 'count': 3}
+        encoded = codec.encode_value(value)
+        self.assertEqual([codec.DATETIME_TAG, 1400000000, 'UTC'],
+                         encoded['created_at'])
+        self.assertEqual(codec.LIST_TAG, encoded['tags'][0])
+        self.assertEqual(value, codec.decode_value(encoded))
+
+    def test_compact_round_trip(self):
+        value = {'id': 3, 'nova_classname': 'instances',
+                 'metadata_novabase_classname': 'Instance',
+                 'pid': 1234, 'rid': 'fake-request',
+                 'uuid': 'fake-uuid', 'created_at': DATETIME,
+                 'extra_field': [REFERENCE]}
+        compact = codec.to_compact(value)
+        self.assertEqual(codec.COMPACT_FORMAT_VERSION, compact[0])
+        self.assertNotIn('pid', compact[3])
+        self.assertEqual({'extra_field': [codec.encode_value(REFERENCE)]},
+                         compact[3])
+
+        # The schema is read back from the storage by another process
+        codec.SCHEMA_REGISTRY.schemas.clear()
+        decoded = codec.from_compact(compact)
+        self.assertEqual(3, decoded['id'])
+        self.assertEqual('fake-uuid', decoded['uuid'])
+        self.assertEqual(DATETIME, decoded['created_at'])
+        self.assertEqual([REFERENCE], decoded['extra_field'])
+        self.assertEqual('instances', decoded['nova_classname'])
+        self.assertEqual('Instance', decoded['metadata_novabase_classname'])
+        self.assertIsNone(decoded['host'])
+        self.assertNotIn('pid', decoded)
+
+    def test_from_compact_unknown_version(self):
+        self.assertRaises(ValueError, codec.from_compact,
+                          [codec.COMPACT_FORMAT_VERSION + 1, None, [], {}])
+
+    def test_from_compact_unknown_schema(self):
+        self.assertRaises(KeyError, codec.from_compact,
+                          [codec.COMPACT_FORMAT_VERSION, 'instances-0', [],
+                           {}])
+
+    def test_stored_values(self):
+        bucket = client.get_client().bucket('instances')
+        for codec_name in ('json', 'compact'):
+            value = {'id': 1, 'nova_classname': 'instances',
+                     'uuid': 'fake-%s' % codec_name}
+            bucket.new(codec_name, data=value,
+                       content_type=codec.get_content_type(codec_name)).store()
+        self.assertEqual('fake-json', bucket.get('json').data['uuid'])
+        self.assertEqual('fake-compact', bucket.get('compact').data['uuid'])
+        self.assertRaises(ValueError, codec.get_content_type, 'fake')
@@ -0,0 +1,75 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+from oslo.db import exception as db_exc
+
+from nova.db.discovery import guards
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+class GuardTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(GuardTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self.stubs.Set(guards.time, 'sleep', lambda delay: None)
+
+    def test_acquire_release(self):
+        guard = guards.Guard('fake')
+        other = guards.Guard('fake', max_attempts=2)
+        guard.acquire()
+        self.assertFalse(other.try_acquire())
+        guard.release()
+        self.assertTrue(other.try_acquire())
+        other.release()
+
+    def test_acquire_gives_up(self):
+        guard = guards.Guard('fake')
+        guard.acquire()
+        other = guards.Guard('fake', max_attempts=3)
+        self.assertRaises(db_exc.DBDeadlock, other.acquire)
+        self.assertEqual(3, other.attempts)
+
+    def test_expired_lease(self):
+        guard = guards.Guard('fake', lease_duration=10)
+        with mock.patch.object(guards.time, 'time', return_value=100):
+            guard.acquire()
+        other = guards.Guard('fake')
+        with mock.patch.object(guards.time, 'time', return_value=111):
+            self.assertTrue(other.try_acquire())
+        with mock.patch.object(guards.LOG, 'warning') as warning:
+            guard.release()
+        self.assertTrue(warning.called)
+
+    def test_concurrent_writes_lose(self):
+        # Both guards read the free guard before writing it: the second
+        # write creates siblings, and is withdrawn
+        guard = guards.Guard('fake')
+        other = guards.Guard('fake')
+        guards_bucket = guards.get_guards_bucket()
+        free = guards_bucket.get('fake')
+        get = mock.Mock(side_effect=lambda key: free)
+        guard.try_acquire()
+        with mock.patch.object(guards_bucket.__class__, 'get', get):
+            self.assertFalse(other.try_acquire())
+        self.assertEqual(guard.token,
+                         guards_bucket.get('fake').data['owner'])
+
+    def test_guarded(self):
+        with guards.guarded('fake') as guard:
+            self.assertEqual(guard.token,
+                             guards.get_guards_bucket().get('fake').
+                             data['owner'])
+        self.assertIsNone(guards.get_guards_bucket().get('fake').
+                          data['owner'])
@@ -0,0 +1,146 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from oslo.utils import timeutils
+
+from nova.db.discovery import client
+from nova.db.discovery import indexes
+from nova.db.discovery import key_index
+from nova.db.discovery import models
+from nova.db.discovery.query import RiakModelQuery
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+def _instance(key, **values):
+    value = {'id': key, 'nova_classname': 'instances',
+             'metadata_novabase_classname': 'Instance',
+             'uuid': 'fake-uuid-%d' % key, 'host': 'host-%d' % (key % 2),
+             'project_id': 'fake-project', 'deleted': 0}
+    value.update(values)
+    return value
+
+
+class IndexesTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(IndexesTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self.bucket = client.get_client().bucket('instances')
+
+    def _store(self, values, indexed=True):
+        for value in values:
+            riak_object = self.bucket.new(str(value['id']), data=value)
+            if indexed:
+                indexes.add_indexes(riak_object, models.Instance, value)
+            riak_object.store()
+        key_index.add_keys('instances', [x['id'] for x in values])
+
+    def test_add_indexes(self):
+        riak_object = self.bucket.new('1', data={})
+        indexes.add_indexes(riak_object, models.Instance,
+                            _instance(1, created_at={'epoch': 100}))
+        entries = dict(riak_object.indexes)
+        self.assertEqual('fake-uuid-1', entries['uuid_bin'])
+        self.assertEqual('host-1', entries['host_bin'])
+        self.assertEqual(0, entries['deleted_int'])
+        self.assertEqual(100 * indexes.ORDER_TERM_FACTOR + 1,
+                         entries['order_created_at_id_int'])
+        self.assertEqual(-1, entries['order_id_desc_int'])
+        self.assertNotIn('display_name_bin', entries)
+
+        indexes.clear_indexes(riak_object)
+        self.assertEqual(set(), riak_object.indexes)
+
+    def test_find_keys(self):
+        self._store([_instance(i) for i in xrange(1, 5)])
+        self.assertEqual(set([2]),
+                         indexes.find_keys(models.Instance, 'uuid',
+                                           ['fake-uuid-2']))
+        self.assertEqual(set([1, 3]),
+                         indexes.find_keys(models.Instance, 'host',
+                                           ['host-1', 'host-9']))
+        self.assertEqual(set([1, 2, 3, 4]),
+                         indexes.find_keys(models.Instance, 'deleted', [0]))
+        self.assertEqual(set(),
+                         indexes.find_keys(models.Instance, 'uuid', [None]))
+
+    def test_extract_index_lookup(self):
+        lookup = indexes.extract_index_lookup
+        self.assertEqual(('uuid', ['a']),
+                         lookup(models.Instance.uuid == 'a',
+                                models.Instance))
+        self.assertEqual(('host', ['a', 'b']),
+                         lookup(models.Instance.host.in_(['a', 'b']),
+                                models.Instance))
+        self.assertIsNone(lookup(models.Instance.uuid != 'a',
+                                 models.Instance))
+        self.assertIsNone(lookup(models.Instance.display_name == 'a',
+                                 models.Instance))
+        self.assertIsNone(lookup(models.Instance.uuid == 'a',
+                                 models.Service))
+
+    def test_reindex_on_first_use(self):
+        self._store([_instance(i) for i in xrange(1, 4)], indexed=False)
+        self.assertFalse(indexes.is_table_indexed(models.Instance))
+        self.assertEqual([], self.bucket.get_index('uuid_bin',
+                                                   'fake-uuid-2'))
+
+        result = RiakModelQuery(models.Instance).\
+            filter_by(uuid='fake-uuid-2').all()
+        self.assertEqual([2], [x.id for x in result])
+        self.assertEqual(['2'], self.bucket.get_index('uuid_bin',
+                                                      'fake-uuid-2'))
+
+        # Another process reads the index status
+        indexes.INDEXED_TABLES.clear()
+        self.assertTrue(indexes.is_table_indexed(models.Instance))
+
+    def test_reindex_after_index_change(self):
+        self._store([_instance(1)])
+        status_bucket = client.get_client().bucket(
+            indexes.INDEX_STATUS_BUCKET)
+        status_bucket.new('instances', data={'columns': ['uuid'],
+                                             'ordered': []}).store()
+        self.assertFalse(indexes.is_table_indexed(models.Instance))
+        self.assertTrue(indexes.ensure_table_indexed(models.Instance))
+        self.assertEqual(indexes.get_index_status(models.Instance),
+                         status_bucket.get('instances').data)
+
+    def test_find_deleted_keys(self):
+        self._store([_instance(i) for i in xrange(1, 4)])
+        RiakModelQuery(models.Instance).filter_by(id=2).soft_delete()
+        self.assertEqual([], self.bucket.get_index('uuid_bin', 'fake-uuid-2'))
+
+        now = timeutils.utcnow()
+        self.assertEqual(set([2]), indexes.find_deleted_keys(
+            models.Instance, now - datetime.timedelta(seconds=60)))
+        self.assertEqual(set(), indexes.find_deleted_keys(
+            models.Instance, now + datetime.timedelta(seconds=60)))
+
+    def test_reindex_deleted_objects(self):
+        deleted_at = {'simplify_strategy': 'datetime', 'epoch': 100,
+                      'timezone': 'None'}
+        self._store([_instance(1), _instance(2, deleted=2,
+                                             deleted_at=deleted_at)],
+                    indexed=False)
+        key_index.remove_key('instances', 2)
+        since = datetime.datetime.utcfromtimestamp(50)
+        self.assertEqual(set(), indexes.find_deleted_keys(models.Instance,
+                                                          since))
+
+        self.assertTrue(indexes.ensure_table_indexed(models.Instance))
+        self.assertEqual(set([2]), indexes.find_deleted_keys(models.Instance,
+                                                             since))
+        self.assertEqual(['1'], self.bucket.get_index('deleted_int', 0))
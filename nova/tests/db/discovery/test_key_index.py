@@ -0,0 +1,71 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.db.discovery import key_index
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+class KeyIndexTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(KeyIndexTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+
+    def test_empty(self):
+        self.assertEqual([], key_index.get_keys('instances'))
+        self.assertEqual(0, key_index.get_highest_key('instances'))
+
+    def test_keys_are_sharded(self):
+        key_index.add_keys('instances', [3, 1, 2500, 1200])
+        key_index.add_key('instances', 4)
+        key_index.remove_key('instances', 1)
+
+        self.assertEqual([0, 1, 2], key_index.get_shard_numbers('instances'))
+        self.assertEqual([[3, 4], [1200], [2500]],
+                         list(key_index.iter_key_shards('instances')))
+        self.assertEqual([3, 4, 1200, 2500], key_index.get_keys('instances'))
+        self.assertEqual(2500, key_index.get_highest_key('instances'))
+        self.assertEqual([], key_index.get_keys('services'))
+
+    def test_removed_keys_never_come_back(self):
+        key_index.add_key('instances', 1)
+        key_index.remove_key('instances', 1)
+        key_index.add_key('instances', 1)
+        self.assertEqual([], key_index.get_keys('instances'))
+
+    def test_merge_siblings(self):
+        riak_object = mock.Mock(siblings=[
+            mock.Mock(data={'added': [1, 2], 'removed': [2]}),
+            mock.Mock(data={'added': [3], 'removed': [1]})])
+        key_index.merge_siblings(riak_object)
+        self.assertEqual(1, len(riak_object.siblings))
+        self.assertEqual({'added': [1, 2, 3], 'removed': [1, 2]},
+                         riak_object.siblings[0].data)
+
+    def test_legacy_keys(self):
+        key_index.get_key_index_bucket().new('instances',
+                                             data=[2, 1001]).store()
+        key_index.add_key('instances', 5)
+        self.assertEqual([2, 5, 1001], key_index.get_keys('instances'))
+        self.assertEqual(1001, key_index.get_highest_key('instances'))
+        # The legacy list was moved into the shards, and is not read again
+        self.assertIsNone(
+            key_index.get_key_index_bucket().get('instances').data)
+        self.assertEqual({'added': [2, 5], 'removed': []},
+                         key_index.get_key_index_bucket().get(
+                             key_index.get_shard_name('instances', 0)).data)
+        key_index.get_key_index_bucket().new('instances',
+                                             data=[3]).store()
+        self.assertEqual([2, 5, 1001], key_index.get_keys('instances'))
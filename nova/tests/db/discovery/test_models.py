@@ -0,0 +1,60 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import imp
+
+from nova import context
+from nova.db.discovery import lazy_reference
+from nova.db.discovery import models
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+from nova.tests.db.discovery import test_bench
+
+
+class SaveTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(SaveTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self.bench = imp.load_source('discovery_bench', test_bench.BENCH_PATH)
+        self.bench.use_storage('memory', None)
+        self.context = context.get_admin_context()
+
+    def _service(self, host):
+        with self.bench.silenced():
+            service = models.Service()
+            service.update({'host': host, 'binary': 'nova-compute',
+                            'topic': 'compute', 'report_count': 0})
+        return service
+
+    def test_save_sees_updated_reference(self):
+        service = self._service('host-1')
+        with self.bench.silenced():
+            compute_node = models.ComputeNode()
+            compute_node.update({'service_id': service.id, 'vcpus': 1,
+                                 'memory_mb': 512, 'local_gb': 10,
+                                 'vcpus_used': 0, 'memory_mb_used': 0,
+                                 'local_gb_used': 0, 'hypervisor_type': 'fake',
+                                 'hypervisor_version': 1, 'cpu_info': '',
+                                 'hypervisor_hostname': 'node-1'})
+            self.assertEqual('host-1', compute_node.service.host)
+
+            service.update({'host': 'host-2'})
+            compute_node.update({'vcpus_used': 1})
+            self.assertEqual('host-2', compute_node.service.host)
+
+    def test_save_releases_its_loader(self):
+        loaders = len(lazy_reference.LOADERS)
+        service = self._service('host-1')
+        with self.bench.silenced():
+            service.update({'report_count': 1})
+        self.assertEqual(loaders, len(lazy_reference.LOADERS))
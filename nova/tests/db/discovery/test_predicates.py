@@ -0,0 +1,117 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from sqlalchemy import and_
+from sqlalchemy import not_
+from sqlalchemy import or_
+from sqlalchemy.util._collections import KeyedTuple
+
+from nova.db.discovery.aggregates import RawObject
+from nova.db.discovery import models
+from nova.db.discovery import predicates
+from nova.db.discovery.query import RiakModelQuery
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+Instance = models.Instance
+
+
+def _row(**values):
+    values.setdefault('nova_classname', 'instances')
+    return KeyedTuple([RawObject(values)], labels=['Instances'])
+
+
+class PredicatesTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(PredicatesTestCase, self).setUp()
+        self.rows = [_row(id=1, host='compute-1', vm_state='active'),
+                     _row(id=2, host='compute-2', vm_state='error'),
+                     _row(id=3, host=None, vm_state='active')]
+
+    def _ids(self, criterion):
+        predicate = predicates.compile_criterion(criterion)
+        return [row.Instances.id for row in self.rows if predicate(row)]
+
+    def test_eq(self):
+        self.assertEqual([2], self._ids(Instance.host == 'compute-2'))
+        # Values are also compared with their string representation
+        self.assertEqual([2], self._ids(Instance.id == '2'))
+
+    def test_ne(self):
+        self.assertEqual([1], self._ids(Instance.host != 'compute-2'))
+        self.assertEqual([2], self._ids(Instance.vm_state != 'active'))
+
+    def test_none(self):
+        self.assertEqual([3], self._ids(Instance.host == None))
+        self.assertEqual([1, 2], self._ids(Instance.host != None))
+        self.assertEqual([], self._ids(Instance.host.in_([None])))
+
+    def test_comparisons(self):
+        self.assertEqual([1, 2], self._ids(Instance.id < 3))
+        self.assertEqual([2, 3], self._ids(Instance.id >= 2))
+
+    def test_datetimes(self):
+        created_at = {'simplify_strategy': 'datetime', 'epoch': 100,
+                      'timezone': 'UTC'}
+        self.rows = [_row(id=1, created_at=created_at)]
+        self.assertEqual([1], self._ids(
+            Instance.created_at < datetime.datetime.utcfromtimestamp(101)))
+
+    def test_in(self):
+        self.assertEqual([1, 3], self._ids(Instance.id.in_([1, 3, 4])))
+        self.assertEqual([2], self._ids(Instance.id.notin_([1, 3])))
+        self.assertEqual([1], self._ids(Instance.host.in_(['compute-1',
+                                                           None])))
+
+    def test_like(self):
+        self.assertEqual([1, 2], self._ids(Instance.host.like('compute-%')))
+        self.assertEqual([2], self._ids(Instance.host.like('%_2')))
+        self.assertEqual([1, 2], self._ids(Instance.host.ilike('COMPUTE%')))
+        self.assertEqual([2], self._ids(Instance.host.notlike('%1')))
+        self.assertEqual([1, 2], self._ids(Instance.host.contains('pute')))
+        self.assertEqual([1], self._ids(Instance.host.endswith('-1')))
+        # Characters of the pattern are not regular expressions
+        self.assertEqual([], self._ids(Instance.host.like('compute.1')))
+
+    def test_regex(self):
+        self.assertEqual([2], self._ids(Instance.host.op('REGEXP')('-[2-9]$')))
+        self.assertEqual([1, 2], self._ids(Instance.host.op('REGEXP')('^c')))
+
+    def test_and_or(self):
+        self.assertEqual([1], self._ids(and_(Instance.vm_state == 'active',
+                                             Instance.host != None)))
+        self.assertEqual([2, 3], self._ids(or_(Instance.vm_state == 'error',
+                                               Instance.host == None)))
+        self.assertEqual([1, 3], self._ids(not_(Instance.id == 2)))
+        self.assertEqual([2], self._ids(
+            and_(Instance.id > 1, or_(Instance.host == 'compute-2',
+                                      Instance.id > 5))))
+
+    def test_unsupported_operator(self):
+        self.assertRaises(NotImplementedError, predicates.compile_criterion,
+                          Instance.id.op('&')(1))
+
+
+class StoredValuesTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(StoredValuesTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+
+    def test_unsupported_operator_falls_back(self):
+        rows = RiakModelQuery(Instance).filter(Instance.id.op('&')(1))
+        self.assertIsNone(rows.find_stored_values(Instance))
+        rows = RiakModelQuery(Instance).filter(Instance.id == 1)
+        self.assertEqual([], rows.find_stored_values(Instance))
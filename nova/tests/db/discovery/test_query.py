@@ -0,0 +1,337 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import datetime
+
+import mock
+from sqlalchemy import asc
+from sqlalchemy import desc
+from sqlalchemy import literal_column
+
+from nova.db.discovery import batch
+from nova.db.discovery import client
+from nova.db.discovery import desimplifier
+from nova.db.discovery import indexes
+from nova.db.discovery import key_index
+from nova.db.discovery import models
+from nova.db.discovery import query
+from nova.db.discovery.query import RiakModelQuery
+from nova.db.discovery import table_cache
+from nova.db.discovery import utils
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+FakeObject = collections.namedtuple('FakeObject', ['id', 'host'])
+FakeRow = collections.namedtuple('FakeRow', ['id', 'created_at'])
+
+"""Creation times of the instances stored by the tests, several of them
+sharing a second."""
+CREATED_AT = {1: 100, 2: 200, 3: 100, 4: 300, 5: 200, 6: 100}
+ASCENDING = [1, 3, 6, 2, 5, 4]
+
+
+def _datetime(epoch):
+    return datetime.datetime.utcfromtimestamp(epoch)
+
+
+def _instance(key):
+    return {'id': key, 'nova_classname': 'instances',
+            'metadata_novabase_classname': 'Instance',
+            'uuid': 'fake-uuid-%d' % key, 'host': 'host-%d' % (key % 2),
+            'project_id': 'fake-project', 'deleted': 0,
+            'created_at': {'simplify_strategy': 'datetime',
+                           'epoch': CREATED_AT[key], 'timezone': 'None'}}
+
+
+class FakeSelectable(object):
+    def __init__(self, model):
+        self._model = model
+
+
+class JoinTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(JoinTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self.instances = [FakeObject(1, 'a'), FakeObject(2, 'b'),
+                          FakeObject(3, None)]
+        self.services = [FakeObject(10, 'b'), FakeObject(11, 'a'),
+                         FakeObject(12, 'a')]
+
+    def _ids(self, products):
+        return sorted(tuple(x.id for x in product) for product in products)
+
+    def test_hash_join(self):
+        products = [[x, None] for x in self.instances]
+        predicates = [(0, 'host', 'host')]
+        expected = [(1, 11), (1, 12), (2, 10)]
+        # The hash table is built on the products, or on the objects when
+        # the products are streamed
+        self.assertEqual(expected, self._ids(
+            query.hash_join(products, self.services, 1, predicates)))
+        self.assertEqual(expected, self._ids(
+            query.hash_join(iter(products), self.services, 1, predicates)))
+
+    def test_hash_join_small_products(self):
+        products = [[self.instances[0], None]]
+        self.assertEqual([(1, 11), (1, 12)], self._ids(
+            query.hash_join(products, self.services, 1,
+                            [(0, 'host', 'host')])))
+
+    def test_nested_loop_join(self):
+        products = [[x, None] for x in self.instances[:2]]
+        self.assertEqual(6, len(list(
+            query.nested_loop_join(products, self.services, 1))))
+
+    def test_join_objects(self):
+        model_set = [FakeSelectable(models.Instance),
+                     FakeSelectable(models.Service)]
+        rows = RiakModelQuery(models.Instance, models.Service).\
+            filter(models.Instance.host == models.Service.host).\
+            filter(models.Instance.id < 3)
+        (products, remaining) = rows.join_objects(
+            model_set, [self.instances, self.services])
+        self.assertEqual([(1, 11), (1, 12), (2, 10)], self._ids(products))
+        # The single table criterion was applied before the join
+        self.assertEqual(1, len(remaining))
+
+    def test_join_objects_repeated_table(self):
+        model_set = [FakeSelectable(models.Instance),
+                     FakeSelectable(models.Instance)]
+        rows = RiakModelQuery(models.Instance).\
+            filter(models.Instance.id < 2)
+        (products, remaining) = rows.join_objects(
+            model_set, [self.instances, self.instances])
+        # The criterion may target either copy: it is kept for the joined
+        # rows
+        self.assertEqual(9, len(list(products)))
+        self.assertEqual(1, len(remaining))
+
+
+def _store_instances():
+    bucket = client.get_client().bucket('instances')
+    for key in CREATED_AT:
+        value = _instance(key)
+        riak_object = bucket.new(str(key), data=value)
+        indexes.add_indexes(riak_object, models.Instance, value)
+        riak_object.store()
+    key_index.add_keys('instances', sorted(CREATED_AT))
+    return bucket
+
+
+class PaginationTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(PaginationTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        _store_instances()
+
+    def _query(self, direction, marker=None, limit=None):
+        rows = RiakModelQuery(models.Instance).\
+            order_by(direction(models.Instance.created_at),
+                     direction(models.Instance.id))
+        if marker is not None:
+            rows = rows.marker(marker)
+        if limit is not None:
+            rows = rows.limit(limit)
+        return rows
+
+    def _pages(self, direction, limit):
+        result = []
+        marker = None
+        while True:
+            page = self._query(direction, marker, limit).all()
+            result += [[x.id for x in page]]
+            if len(page) < limit:
+                return result
+            marker = [page[-1].created_at, page[-1].id]
+
+    def test_ordered_indexes(self):
+        find = indexes.find_ordered_index
+        self.assertEqual((('created_at', 'id'), False),
+                         find(models.Instance, [('created_at', False)]))
+        self.assertEqual((('id',), True),
+                         find(models.Instance, [('id', True)]))
+        self.assertIsNone(find(models.Instance, [('created_at', False),
+                                                 ('id', True)]))
+        self.assertIsNone(find(models.Instance, [('host', False)]))
+        self.assertIn(('created_at', 'id'), indexes.ORDERED_INDEXES)
+
+    def test_paginate_rows(self):
+        rows = [FakeRow(key, _datetime(CREATED_AT[key]))
+                for key in CREATED_AT]
+        paginate = lambda x: [row.id for row in x.paginate_rows(rows)]
+        self.assertEqual(ASCENDING, paginate(self._query(asc)))
+        self.assertEqual(ASCENDING[::-1], paginate(self._query(desc)))
+        self.assertEqual([6, 2], paginate(
+            self._query(asc, [_datetime(100), 3], limit=2)))
+        self.assertEqual([2, 6, 3, 1], paginate(
+            self._query(desc, [_datetime(200), 5])))
+
+    def test_scan_ordered_index(self):
+        with mock.patch.object(indexes, 'iter_ordered_keys',
+                               wraps=indexes.iter_ordered_keys) as scan:
+            self.assertEqual([[1, 3], [6, 2], [5, 4], []],
+                             self._pages(asc, 2))
+            self.assertEqual([[4, 5, 2, 6], [3, 1]], self._pages(desc, 4))
+        self.assertEqual(6, scan.call_count)
+
+    def test_marker_between_ties(self):
+        # The marker is not stored: it falls within a second shared by
+        # several objects, which the ordered index does not tell apart
+        marker = _datetime(100) + datetime.timedelta(milliseconds=500)
+        self.assertEqual([2, 5, 4],
+                         [x.id for x in self._query(asc, [marker, 1],
+                                                    limit=5).all()])
+        self.assertEqual([6, 3, 1],
+                         [x.id for x in self._query(desc, [marker, 2],
+                                                    limit=5).all()])
+        # The objects are sorted in memory when the query has no limit
+        self.assertEqual([6, 3, 1],
+                         [x.id for x in self._query(desc, [marker, 2]).all()])
+
+
+class UpdateTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(UpdateTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self.bucket = _store_instances()
+        self.flush = mock.patch.object(batch.WriteBatch, 'flush',
+                                       autospec=True,
+                                       side_effect=batch.WriteBatch.flush)
+        self.flush_mock = self.flush.start()
+        self.addCleanup(self.flush.stop)
+
+    def _query(self):
+        return RiakModelQuery(models.Instance)
+
+    def test_update(self):
+        count = self._query().filter_by(host='host-1').\
+            update({'vm_state': 'error',
+                    'display_name': literal_column('uuid')})
+        self.assertEqual(3, count)
+        # The objects are written with a single batch
+        self.assertEqual(1, self.flush_mock.call_count)
+        for key in CREATED_AT:
+            value = self.bucket.get(str(key)).data
+            if key % 2 == 1:
+                self.assertEqual('error', value['vm_state'])
+                self.assertEqual(value['uuid'], value['display_name'])
+                self.assertIsNotNone(value['updated_at'])
+            else:
+                self.assertNotIn('vm_state', value)
+        self.assertEqual([1, 3, 5], sorted(
+            x.id for x in self._query().filter_by(vm_state='error').all()))
+
+    def test_update_falls_back(self):
+        rows = self._query().filter_by(id=1)
+        self.assertIsNone(rows.update_stored_values(
+            {'vcpus': models.Instance.vcpus + 1}))
+        self.assertIsNone(rows.update_stored_values({'unknown': 1}))
+        self.assertEqual(0, self.flush_mock.call_count)
+
+    def test_soft_delete(self):
+        self.assertEqual(2, self._query().filter(
+            models.Instance.id.in_([2, 4])).soft_delete())
+        self.assertEqual(1, self.flush_mock.call_count)
+
+        value = self.bucket.get('2').data
+        self.assertEqual(2, value['deleted'])
+        self.assertIsNotNone(value['deleted_at'])
+        # Deleted objects leave the secondary indexes and the key index
+        self.assertEqual([], self.bucket.get_index('uuid_bin', 'fake-uuid-2'))
+        self.assertEqual(['6'], self.bucket.get_index('host_bin', 'host-0'))
+        self.assertEqual([1, 3, 5, 6], key_index.get_keys('instances'))
+        self.assertEqual([1, 3, 5, 6],
+                         sorted(x.id for x in self._query().all()))
+
+    def test_bump_stamp(self):
+        self.flags(cached_tables=['instances'], group='discovery')
+        stamp = table_cache.read_stamp('instances')
+        self._query().filter_by(host='host-1').update({'vm_state': 'error'})
+        self.assertEqual(stamp + 1, table_cache.read_stamp('instances'))
+        self._query().filter_by(id=1).soft_delete()
+        self.assertEqual(stamp + 2, table_cache.read_stamp('instances'))
+
+
+class StreamingTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(StreamingTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        _store_instances()
+
+    def _query(self):
+        return RiakModelQuery(models.Instance)
+
+    def _ids(self, rows):
+        return [x.id for x in rows]
+
+    def test_stream_rows(self):
+        rows = self._query().filter_by(host='host-1')
+        self.assertEqual([1, 3, 5], self._ids(rows.all()))
+        self.assertEqual([1, 3, 5], self._ids(rows.stream_rows()))
+        self.assertEqual([1, 3, 5], self._ids(iter(rows)))
+
+        rows = self._query().filter(models.Instance.id >= 2).offset(1).limit(2)
+        self.assertEqual(self._ids(rows.all()), self._ids(rows))
+        self.assertEqual([3, 4], self._ids(rows))
+
+    def test_stream_rows_skips_undesimplifiable(self):
+        desimplify = desimplifier.ObjectDesimplifier.desimplify
+
+        def fail_second(self, value):
+            if isinstance(value, dict) and value.get('id') == 2:
+                raise ValueError('corrupted')
+            return desimplify(self, value)
+
+        self.stubs.Set(desimplifier.ObjectDesimplifier, 'desimplify',
+                       fail_second)
+        with mock.patch.object(query.LOG, 'exception') as exception:
+            self.assertEqual([1, 3], self._ids(self._query().limit(2)))
+        exception.assert_called_once_with(mock.ANY, 'instances', 2)
+
+    def test_stream_rows_of_attribute(self):
+        rows = RiakModelQuery(models.Instance.uuid).filter_by(id=2)
+        self.assertEqual(['fake-uuid-2'], list(rows.stream_rows()))
+
+    def test_not_streamed(self):
+        self.assertIsNone(self._query().order_by(
+            asc(models.Instance.id)).stream_rows())
+        self.assertIsNone(RiakModelQuery(models.Instance,
+                                         models.Service).stream_rows())
+        rows = self._query().order_by(desc(models.Instance.id))
+        self.assertEqual([6, 5, 4, 3, 2, 1], self._ids(iter(rows)))
+
+    def test_yield_per(self):
+        with mock.patch.object(utils, 'fetch_values',
+                               wraps=utils.fetch_values) as fetch:
+            rows = list(self._query().yield_per(4))
+        self.assertEqual(self._ids(self._query().all()), self._ids(rows))
+        self.assertEqual([[1, 2, 3, 4], [5, 6]],
+                         [x[0][1] for x in fetch.call_args_list])
+
+    def test_limit_stops_fetching(self):
+        with mock.patch.object(utils, 'fetch_values',
+                               wraps=utils.fetch_values) as fetch:
+            self.assertEqual([1], self._ids(self._query().limit(1)))
+        self.assertEqual([[1]], [x[0][1] for x in fetch.call_args_list])
+
+    def test_first_and_exists(self):
+        self.assertEqual(2, self._query().filter_by(host='host-0').first().id)
+        self.assertTrue(self._query().filter_by(host='host-0').exists())
+        rows = self._query().filter_by(host='unknown')
+        self.assertIsNone(rows.first())
+        self.assertFalse(rows.exists())
+        self.assertEqual([], rows.all())
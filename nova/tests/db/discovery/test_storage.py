@@ -0,0 +1,130 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.db.discovery import client
+from nova.db.discovery import storage
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+class MemoryStorageTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(MemoryStorageTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self.client = client.get_client()
+
+    def test_store_and_get(self):
+        bucket = self.client.bucket('fake')
+        bucket.new('1', data={'a': 1}).store()
+        self.assertEqual({'a': 1}, bucket.get('1').data)
+        self.assertIsNone(bucket.get('2').data)
+        bucket.get('1').delete()
+        self.assertIsNone(bucket.get('1').data)
+
+    def test_concurrent_writes_create_siblings(self):
+        bucket = self.client.bucket('fake')
+        bucket.allow_mult = True
+        # Siblings are kept as they are stored
+        bucket.resolver = lambda riak_object: None
+        bucket.new('1', data={'a': 1}).store()
+        first = bucket.get('1')
+        second = bucket.get('1')
+        first.data = {'a': 2}
+        first.store()
+        second.data = {'a': 3}
+        second.store()
+        self.assertEqual([{'a': 2}, {'a': 3}],
+                         sorted(x.data for x in bucket.get('1').siblings))
+
+    def test_writes_without_siblings_replace(self):
+        bucket = self.client.bucket('fake')
+        bucket.new('1', data={'a': 1}).store()
+        first = bucket.get('1')
+        second = bucket.get('1')
+        first.data = {'a': 2}
+        first.store()
+        second.data = {'a': 3}
+        second.store()
+        self.assertEqual(1, len(bucket.get('1').siblings))
+        self.assertEqual({'a': 3}, bucket.get('1').data)
+
+    def test_indexes(self):
+        bucket = self.client.bucket('fake')
+        for (key, term) in [('1', 5), ('2', 7), ('3', 7), ('4', 12)]:
+            riak_object = bucket.new(key, data={})
+            riak_object.add_index('value_int', term)
+            riak_object.add_index('name_bin', 'name-%d' % term)
+            riak_object.store()
+        self.assertEqual(['2', '3'], bucket.get_index('value_int', 7))
+        self.assertEqual(['2', '3'], bucket.get_index('name_bin', 'name-7'))
+        self.assertEqual(['1', '2', '3'],
+                         bucket.get_index('value_int', 0, 10))
+
+        page = bucket.get_index('value_int', 0, 20, max_results=2)
+        self.assertEqual(['1', '2'], list(page))
+        next_page = bucket.get_index('value_int', 0, 20, max_results=2,
+                                     continuation=page.continuation)
+        self.assertEqual(['3', '4'], list(next_page))
+
+        # Index entries of a rewritten object are replaced
+        riak_object = bucket.get('2')
+        riak_object.remove_index('value_int')
+        riak_object.add_index('value_int', 12)
+        riak_object.store()
+        self.assertEqual(['3'], bucket.get_index('value_int', 7))
+
+    def test_counters(self):
+        bucket = self.client.bucket('fake')
+        self.assertIsNone(bucket.get_counter('counter'))
+        bucket.update_counter('counter', 2)
+        bucket.update_counter('counter', 3)
+        self.assertEqual(5, bucket.get_counter('counter'))
+
+    def test_get_storage(self):
+        self.assertIs(storage.get_storage('memory'),
+                      storage.get_storage('memory'))
+        self.assertRaises(ValueError, storage.get_storage, 'fake')
+
+
+class SqliteStorageTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(SqliteStorageTestCase, self).setUp()
+        self.storage = storage.SqliteStorage(':memory:')
+
+    def test_objects(self):
+        records = [(1, 'application/json', '{}', [('value_int', 3)])]
+        self.storage.write_object('fake', '1', records)
+        self.assertEqual(records, self.storage.read_object('fake', '1'))
+        self.storage.write_object('fake', '1', [])
+        self.assertEqual([], self.storage.read_object('fake', '1'))
+
+    def test_indexes(self):
+        for (key, term) in [('1', -4), ('2', 3), ('3', 3), ('4', 10)]:
+            self.storage.write_object('fake', key,
+                                      [(1, 'application/json', '{}',
+                                        [('value_int', term)])])
+        self.assertEqual([(3, '2'), (3, '3')],
+                         self.storage.query_index('fake', 'value_int', 3,
+                                                  None))
+        self.assertEqual([(-4, '1'), (3, '2'), (3, '3')],
+                         self.storage.query_index('fake', 'value_int', -5,
+                                                  5))
+
+    def test_counters_and_props(self):
+        self.assertEqual(2, self.storage.add_counter('fake', 'counter', 2))
+        self.assertEqual(5, self.storage.add_counter('fake', 'counter', 3))
+        self.assertEqual(5, self.storage.read_counter('fake', 'counter'))
+        self.storage.write_props('fake', {'allow_mult': True})
+        self.assertTrue(self.storage.read_props('fake')['allow_mult'])
+        self.assertEqual(1, self.storage.read_props('fake')['n_val'])
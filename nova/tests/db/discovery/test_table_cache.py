@@ -0,0 +1,89 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.db.discovery import batch
+from nova.db.discovery import client
+from nova.db.discovery import models
+from nova.db.discovery.query import RiakModelQuery
+from nova.db.discovery import table_cache
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+def _flavor(key, **values):
+    value = {'id': key, 'nova_classname': 'instance_types',
+             'metadata_novabase_classname': 'InstanceTypes',
+             'name': 'flavor-%d' % key, 'flavorid': str(key),
+             'memory_mb': 512, 'vcpus': 1, 'deleted': 0}
+    value.update(values)
+    return value
+
+
+class TableCacheTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(TableCacheTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self._write([_flavor(1), _flavor(2)])
+
+    def _write(self, values):
+        known_versions = batch.load_versions('instance_types',
+                                             [x['id'] for x in values])
+        write_batch = batch.WriteBatch()
+        for value in values:
+            (vclock, previous_value) = known_versions[value['id']]
+            write_batch.add('instance_types', value['id'], vclock,
+                            previous_value, value, models.InstanceTypes)
+        write_batch.flush()
+
+    def _read(self):
+        operations = client.get_operation_count()
+        values = table_cache.get_table_values('instance_types')
+        return (values, client.get_operation_count() - operations)
+
+    def test_not_cached(self):
+        self.assertFalse(table_cache.is_cached('instances'))
+        self.assertIsNone(table_cache.get_table_values('instances'))
+
+    def test_cached_until_stamp_changes(self):
+        (values, _) = self._read()
+        self.assertEqual([1, 2], sorted(values))
+        (cached, operations) = self._read()
+        self.assertIs(values, cached)
+        # Only the stamp of the table was read
+        self.assertEqual(1, operations)
+
+        # Another process writes an object of the table
+        table_cache.get_stamps_bucket().update_counter('instance_types', 1)
+        (values, _) = self._read()
+        self.assertIsNot(cached, values)
+
+    def test_invalidated_by_batch_writes(self):
+        stamp = table_cache.read_stamp('instance_types')
+        self._read()
+        self._write([_flavor(2, memory_mb=1024), _flavor(3)])
+        # The stamp is bumped once per table and batch
+        self.assertEqual(stamp + 1, table_cache.read_stamp('instance_types'))
+        (values, _) = self._read()
+        self.assertEqual([1, 2, 3], sorted(values))
+        self.assertEqual(1024, values[2]['memory_mb'])
+
+    def test_invalidated_by_soft_delete(self):
+        self._read()
+        RiakModelQuery(models.InstanceTypes).filter_by(id=1).soft_delete()
+        (values, _) = self._read()
+        self.assertEqual([2], sorted(values))
+
+        flavor = RiakModelQuery(models.InstanceTypes).filter_by(id=2).first()
+        flavor.soft_delete(None)
+        (values, _) = self._read()
+        self.assertEqual({}, values)
@@ -0,0 +1,153 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+
+import fixtures
+import mock
+
+from nova.db.discovery import client
+from nova.db.discovery import tracing
+from nova import test
+
+
+class StopFlushing(Exception):
+    pass
+
+
+class CallRecorderTestCase(test.NoDBTestCase):
+
+    def _recorder(self, mode, **kwargs):
+        return tracing.CallRecorder(mode=mode, **kwargs)
+
+    def _fetch(self, rows):
+        client.count_operations(2)
+        return rows
+
+    def test_off(self):
+        recorder = self._recorder('off')
+        self.assertEqual([1], recorder.call('fetch', self._fetch, [1]))
+        self.assertEqual({}, recorder.get_stats())
+        self.assertEqual([], recorder.get_traces())
+
+    def test_full(self):
+        recorder = self._recorder('full')
+        recorder.call('fetch', self._fetch, [1, 2])
+        recorder.call('fetch', self._fetch, None)
+        stats = recorder.get_stats()['fetch']
+        self.assertEqual(2, stats['calls'])
+        self.assertEqual(2.0, stats['mean_riak_operations'])
+        self.assertEqual(1.0, stats['mean_result_size'])
+        traces = recorder.get_traces()
+        self.assertEqual(['fetch', 'fetch'], [x[0] for x in traces])
+        self.assertEqual([2, 0], [x[4] for x in traces])
+
+    def test_sample(self):
+        recorder = self._recorder('sample', sample_rate=0.0)
+        recorder.call('fetch', self._fetch, [1])
+        self.assertEqual(1, recorder.get_stats()['fetch']['calls'])
+        self.assertEqual([], recorder.get_traces())
+
+        recorder.sample_rate = 1.0
+        recorder.call('fetch', self._fetch, [1])
+        self.assertEqual(2, recorder.get_stats()['fetch']['calls'])
+        self.assertEqual(1, len(recorder.get_traces()))
+
+    def test_errors(self):
+        recorder = self._recorder('full')
+
+        def fail():
+            raise ValueError('fake')
+
+        self.assertRaises(ValueError, recorder.call, 'fail', fail)
+        self.assertEqual(1, recorder.get_stats()['fail']['errors'])
+        self.assertTrue(recorder.get_traces()[0][5])
+
+    def test_set_mode(self):
+        recorder = self._recorder(None)
+        self.flags(trace_mode='full', group='discovery')
+        self.assertEqual('full', recorder.get_mode())
+        recorder.set_mode('off')
+        self.assertEqual('off', recorder.get_mode())
+        self.assertRaises(ValueError, recorder.set_mode, 'verbose')
+
+    def test_ring_buffer(self):
+        recorder = self._recorder('full', buffer_size=3)
+        for rows in xrange(5):
+            recorder.call('fetch', self._fetch, range(rows))
+        self.assertEqual([2, 3, 4], [x[4] for x in recorder.get_traces()])
+        self.assertEqual(5, recorder.get_stats()['fetch']['calls'])
+
+        recorder.reset()
+        self.assertEqual([], recorder.get_traces())
+        self.assertEqual({}, recorder.get_stats())
+
+
+class FlushTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(FlushTestCase, self).setUp()
+        self.trace_file = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'traces')
+        self.recorder = tracing.CallRecorder(mode='full', buffer_size=2,
+                                             trace_file=self.trace_file,
+                                             flush_interval=0)
+        self.stubs.Set(self.recorder, 'start_flusher', lambda: None)
+
+    def _read_traces(self):
+        with open(self.trace_file) as traces:
+            return [json.loads(line) for line in traces]
+
+    def test_flush(self):
+        for rows in xrange(3):
+            self.recorder.call('fetch', lambda: range(rows))
+        self.recorder.flush()
+        # Traces that did not fit in the buffer are lost
+        self.assertEqual([1, 2], [x['result_size']
+                                  for x in self._read_traces()])
+        self.recorder.call('update', lambda: None)
+        self.recorder.flush()
+        self.recorder.flush()
+        self.assertEqual(['fetch', 'fetch', 'update'],
+                         [x['function'] for x in self._read_traces()])
+
+    def test_flush_periodically(self):
+        sleeps = []
+
+        def sleep(interval):
+            sleeps.append(interval)
+            if len(sleeps) > 2:
+                raise StopFlushing()
+
+        self.recorder.call('fetch', lambda: [1])
+        with mock.patch.object(tracing.time, 'sleep', sleep):
+            with mock.patch.object(self.recorder, 'flush',
+                                   side_effect=[None, IOError('full')]):
+                with mock.patch.object(tracing.LOG, 'exception') as log:
+                    self.assertRaises(StopFlushing,
+                                      self.recorder.flush_periodically)
+        self.assertEqual([0, 0, 0], sleeps)
+        # A failed flush is logged, and the thread keeps flushing
+        self.assertEqual(1, log.call_count)
+
+    def test_start_flusher(self):
+        recorder = tracing.CallRecorder(mode='full',
+                                        trace_file=self.trace_file)
+        with mock.patch.object(tracing.threading, 'Thread') as thread:
+            thread.return_value.is_alive.return_value = True
+            recorder.call('fetch', lambda: [1])
+            recorder.call('fetch', lambda: [1])
+        thread.assert_called_once_with(target=recorder.flush_periodically,
+                                       name='db-trace-flusher')
+        thread.return_value.start.assert_called_once_with()
+        self.assertTrue(thread.return_value.daemon)
@@ -0,0 +1,78 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.db.discovery import client
+from nova.db.discovery import desimplifier
+from nova.db.discovery import key_index
+from nova.db.discovery import utils
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+class MultigetTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(MultigetTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self.bucket = client.get_client().bucket('services')
+        for key in (1, 2, 4):
+            self.bucket.new(str(key), data={'id': key, 'host': 'h%d' % key,
+                                            'nova_classname': 'services'}
+                            ).store()
+        key_index.add_keys('services', [1, 2, 4])
+
+    def test_fetch_stored_values_skips_missing_keys(self):
+        values = utils.fetch_stored_values('services', [1, 2, 3, 4])
+        self.assertEqual([1, 2, 4], sorted(values.keys()))
+        self.assertEqual('h4', values[4]['host'])
+
+    def test_fetch_stored_values_by_batches(self):
+        self.stubs.Set(utils, 'MULTIGET_BATCH_SIZE', 2)
+        with mock.patch.object(type(self.bucket), 'multiget',
+                               autospec=True,
+                               side_effect=type(self.bucket).multiget
+                               ) as multiget:
+            values = utils.fetch_stored_values('services', [1, 2, 3, 4])
+        self.assertEqual([1, 2, 4], sorted(values.keys()))
+        self.assertEqual([['1', '2'], ['3', '4']],
+                         [call[0][1] for call in multiget.call_args_list])
+
+    def test_fetch_stored_values_logs_failed_fetches(self):
+        fetched = self.bucket.get('1')
+        failure = ('default', 'services', '2', IOError('timeout'))
+        with mock.patch.object(type(self.bucket), 'multiget',
+                               return_value=[fetched, failure]):
+            with mock.patch.object(utils.LOG, 'error') as error:
+                values = utils.fetch_stored_values('services', [1, 2])
+        self.assertEqual([1], values.keys())
+        self.assertEqual(1, error.call_count)
+        self.assertEqual('2', error.call_args[0][2])
+
+    def test_get_objects_skips_missing_keys(self):
+        objects = utils.get_objects('services', desimplify=False,
+                                    keys=[1, 3, 4])
+        self.assertEqual([1, 4], [x['id'] for x in objects])
+
+    def test_get_objects_logs_undesimplifiable_objects(self):
+        def fail_second(self, value):
+            if value['id'] == 2:
+                raise ValueError('corrupted')
+            return value
+
+        self.stubs.Set(desimplifier.ObjectDesimplifier, 'desimplify',
+                       fail_second)
+        with mock.patch.object(utils.LOG, 'exception') as exception:
+            objects = utils.get_objects('services', keys=[1, 2, 4])
+        self.assertEqual([1, 4], [x['id'] for x in objects])
+        exception.assert_called_once_with(mock.ANY, 'services', 2)
@@ -0,0 +1,123 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.db.discovery import client
+from nova.db.discovery import indexes
+from nova.db.discovery import models
+from nova.db.discovery import versions
+from nova import test
+from nova.tests.db.discovery import storage_fixture
+
+
+def _datetime(epoch):
+    return {'simplify_strategy': 'datetime', 'epoch': epoch,
+            'timezone': 'UTC'}
+
+
+class MergeSiblingsTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(MergeSiblingsTestCase, self).setUp()
+        self.useFixture(storage_fixture.StorageFixture())
+        self.bucket = versions.get_object_bucket(client.get_client(),
+                                                 'instances')
+        self.time = 1000
+        self.stubs.Set(versions.time, 'time', self._time)
+
+    def _time(self):
+        self.time += 1
+        return self.time
+
+    def _write(self, base, **changes):
+        """Write the given changes on a version read before, with its
+        vector clock: returns the new version."""
+        value = dict(base.data if base is not None else
+                     {'id': 1, 'nova_classname': 'instances', 'deleted': 0,
+                      'host': 'host1', 'uuid': 'fake-uuid'})
+        value.update(changes)
+        value['updated_at'] = _datetime(self.time)
+        versions.stamp_changes(value, base and base.data,
+                               list(changes) + ['updated_at'])
+        riak_object = self.bucket.new('1', data=value)
+        riak_object.vclock = base and base.vclock
+        indexes.add_indexes(riak_object, models.Instance, value)
+        riak_object.store()
+        return riak_object
+
+    def test_stamp_changes(self):
+        value = versions.stamp_changes({'host': 'host2', 'uuid': 'fake'},
+                                       {'host': 'host1', 'uuid': 'fake',
+                                        versions.FIELD_TIMES_KEY:
+                                        {'uuid': 5}})
+        self.assertEqual({'host': 1001, 'uuid': 5},
+                         value[versions.FIELD_TIMES_KEY])
+        self.assertEqual(['host'], value[versions.CHANGED_FIELDS_KEY])
+
+    def test_merge_recomputes_indexes(self):
+        created = self._write(None)
+        self._write(created, host='host2')
+        self._write(created, progress=50)
+
+        merged = self.bucket.get('1')
+        self.assertEqual('host2', merged.data['host'])
+        self.assertEqual(50, merged.data['progress'])
+        self.assertIn(('host_bin', 'host2'), merged.indexes)
+        self.assertNotIn(('host_bin', 'host1'), merged.indexes)
+
+        versions.store_object(merged)
+        self.assertEqual(['1'], self.bucket.get_index('host_bin', 'host2'))
+        self.assertEqual([], self.bucket.get_index('host_bin', 'host1'))
+
+    def test_stale_write_does_not_undo_changes(self):
+        created = self._write(None)
+        changed = self._write(created, host='host2')
+        self._write(changed, progress=10)
+        # Written from the first version, after the other changes
+        self._write(created, task_state='spawning')
+
+        merged = self.bucket.get('1')
+        self.assertEqual('host2', merged.data['host'])
+        self.assertEqual(10, merged.data['progress'])
+        self.assertEqual('spawning', merged.data['task_state'])
+
+    def test_concurrent_changes_of_a_field(self):
+        created = self._write(None)
+        self._write(created, host='host2')
+        self._write(created, host='host3')
+        self.assertEqual('host3', self.bucket.get('1').data['host'])
+
+    def test_merge_soft_deleted(self):
+        created = self._write(None)
+        self._write(created, deleted=1)
+        self._write(created, host='host2')
+
+        merged = self.bucket.get('1')
+        self.assertEqual(1, merged.data['deleted'])
+        self.assertEqual(set(), merged.indexes)
+
+    def test_merge_legacy_values(self):
+        riak_object = mock.Mock(siblings=[
+            mock.Mock(data={'host': 'host2', 'progress': 0,
+                            'updated_at': _datetime(10),
+                            versions.CHANGED_FIELDS_KEY: ['host']}),
+            mock.Mock(data={'host': 'host1', 'progress': 10,
+                            'updated_at': _datetime(20),
+                            versions.CHANGED_FIELDS_KEY: ['progress']})])
+        versions.merge_siblings(riak_object)
+        self.assertEqual(1, len(riak_object.siblings))
+        value = riak_object.siblings[0].data
+        self.assertEqual('host2', value['host'])
+        self.assertEqual(10, value['progress'])
+        self.assertEqual({'host': 10, 'progress': 20},
+                         value[versions.FIELD_TIMES_KEY])
@@ -5935,6 +5935,36 @@ class ComputeNodeTestCase(test.TestCase, ModelsObjectComparatorMixin):
         self._assertEqualListsOfObjects(expected, result,
                                         ignored_keys=['stats'])
 
+    def test_compute_node_get_all_changed_since(self):
+        since = self.item['created_at'] + datetime.timedelta(seconds=1)
+        self.assertEqual([], db.compute_node_get_all_changed_since(self.ctxt,
+                                                                   since))
+
+        timeutils.set_time_override(since)
+        self.addCleanup(timeutils.clear_time_override)
+        compute_node_data = self.compute_node_dict.copy()
+        compute_node_data['hypervisor_hostname'] = 'abracadabra105'
+        node = db.compute_node_create(self.ctxt, compute_node_data)
+        db.compute_node_update(self.ctxt, self.item['id'], {'vcpus': 4})
+
+        nodes = sorted(db.compute_node_get_all_changed_since(self.ctxt,
+                                                             since),
+                       key=lambda n: n['id'])
+        self.assertEqual([self.item['id'], node['id']],
+                         [n['id'] for n in nodes])
+        self.assertEqual(4, nodes[0]['vcpus'])
+        self.assertEqual(self.service['id'], nodes[1]['service']['id'])
+
+        # Deleted compute nodes are returned as well
+        db.compute_node_delete(self.ctxt, node['id'])
+        nodes = db.compute_node_get_all_changed_since(
+            self.ctxt, since + datetime.timedelta(seconds=1))
+        self.assertEqual([], nodes)
+        nodes = db.compute_node_get_all_changed_since(self.ctxt, since)
+        deleted = [n for n in nodes if n['id'] == node['id']]
+        self.assertEqual(1, len(deleted))
+        self.assertTrue(deleted[0]['deleted'])
+
     def test_compute_node_get(self):
         compute_node_id = self.item['id']
         node = db.compute_node_get(self.ctxt, compute_node_id)
@@ -97,3 +97,19 @@ class TestComputeCapabilitiesFilter(test.NoDBTestCase):
             especs={'opt1:a': '1', 'capabilities:opt1:b:aa': '2',
                     'trust:trusted_host': 'true'},
             passes=True)
+
+    def test_cache_key(self):
+        especs = {'capabilities:opt1': '1'}
+        filter_properties = {'instance_type': {'extra_specs': especs}}
+        host = fakes.FakeHostState('host1', 'node1', {'updated': None})
+        self.assertIsNone(self.filt_cls.cache_key(host, filter_properties))
+
+        host.updated = 'fake-time1'
+        key = self.filt_cls.cache_key(host, filter_properties)
+        self.assertEqual(key, self.filt_cls.cache_key(host, filter_properties))
+        host.updated = 'fake-time2'
+        self.assertNotEqual(key,
+                            self.filt_cls.cache_key(host, filter_properties))
+        self.assertIsNone(self.filt_cls.cache_key(
+            host, {'instance_type': {'memory_mb': 1024}}))
+
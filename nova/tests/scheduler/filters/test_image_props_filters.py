@@ -187,3 +187,26 @@ class TestImagePropsFilter(test.NoDBTestCase):
                         'hypervisor_version': hypervisor_version}
         host = fakes.FakeHostState('host1', 'node1', capabilities)
         self.assertTrue(self.filt_cls.host_passes(host, filter_properties))
+
+    def test_image_properties_filter_cache_key(self):
+        img_props = {'properties': {'architecture': arch.X86_64,
+                                    'hypervisor_type': hvtype.KVM,
+                                    'vm_mode': vm_mode.HVM}}
+        filter_properties = {'request_spec': {'image': img_props}}
+        hypervisor_version = utils.convert_version_to_int('6.0.0')
+        capabilities = {'supported_instances':
+                        [[arch.X86_64, hvtype.KVM, vm_mode.HVM]],
+                        'hypervisor_version': hypervisor_version}
+        host1 = fakes.FakeHostState('host1', 'node1', capabilities)
+        host2 = fakes.FakeHostState('host1', 'node1', capabilities)
+        key = self.filt_cls.cache_key(host1, filter_properties)
+        self.assertEqual(key, self.filt_cls.cache_key(host2,
+                                                      filter_properties))
+
+        host2.hypervisor_version = utils.convert_version_to_int('6.1.0')
+        self.assertNotEqual(key, self.filt_cls.cache_key(host2,
+                                                         filter_properties))
+        img_props['properties']['vm_mode'] = vm_mode.XEN
+        self.assertNotEqual(key, self.filt_cls.cache_key(host1,
+                                                         filter_properties))
+
@@ -79,6 +79,17 @@ class SchedulerQueryClientTestCase(test.TestCase):
             'fake_request_spec',
             'fake_prop')
 
+    @mock.patch.object(scheduler_rpcapi.SchedulerAPI,
+                       'select_destinations_batch')
+    def test_select_destinations_batch(self, mock_select_destinations_batch):
+        self.client.select_destinations_batch(
+            context=self.context,
+            requests='fake_requests'
+        )
+        mock_select_destinations_batch.assert_called_once_with(
+            self.context,
+            'fake_requests')
+
 
 class SchedulerClientTestCase(test.TestCase):
 
@@ -101,6 +112,17 @@ class SchedulerClientTestCase(test.TestCase):
         mock_select_destinations.assert_called_once_with(
             'ctxt', 'fake_spec', 'fake_prop')
 
+    @mock.patch.object(scheduler_query_client.SchedulerQueryClient,
+                       'select_destinations_batch')
+    def test_select_destinations_batch(self, mock_select_destinations_batch):
+        self.assertIsNone(self.client.queryclient.instance)
+
+        self.client.select_destinations_batch('ctxt', 'fake_requests')
+
+        self.assertIsNotNone(self.client.queryclient.instance)
+        mock_select_destinations_batch.assert_called_once_with(
+            'ctxt', 'fake_requests')
+
     @mock.patch.object(scheduler_report_client.SchedulerReportClient,
                        'update_resource_stats')
     def test_update_resource_stats(self, mock_update_resource_stats):
@@ -30,6 +30,7 @@ from nova import exception
 from nova import objects
 from nova.scheduler import driver
 from nova.scheduler import filter_scheduler
+from nova.scheduler.filters import ram_filter
 from nova.scheduler import host_manager
 from nova.scheduler import utils as scheduler_utils
 from nova.scheduler import weights
@@ -655,6 +656,113 @@ class FilterSchedulerTestCase(test_scheduler.SchedulerTestCase):
                 self.assertIn('reason', e.kwargs)
                 self.assertTrue(len(e.kwargs['reason']) > 0)
 
+    def _get_batch_request(self, memory_mb, num_instances=1,
+                           scheduler_hints=None):
+        instance_type = {'memory_mb': memory_mb, 'root_gb': 0,
+                         'ephemeral_gb': 0, 'vcpus': 1}
+        instance_properties = dict(instance_type, project_id=1,
+                                   os_type='Linux', numa_topology=None)
+        request_spec = {'instance_type': instance_type,
+                        'instance_properties': instance_properties,
+                        'num_instances': num_instances}
+        filter_properties = {}
+        if scheduler_hints:
+            filter_properties['scheduler_hints'] = scheduler_hints
+        return {'request_spec': request_spec,
+                'filter_properties': filter_properties}
+
+    def _stub_batch_hosts(self, free_ram_mbs):
+        self.flags(scheduler_default_filters=['RamFilter'],
+                   scheduler_weight_classes=[
+                       'nova.scheduler.weights.ram.RAMWeigher'])
+        self.stubs.Set(ram_filter.RamFilter, 'ram_allocation_ratio', 1.0)
+        self.driver = filter_scheduler.FilterScheduler()
+        hosts = [fakes.FakeHostState('host%d' % i, 'node%d' % i,
+                                     {'free_ram_mb': free_ram_mb,
+                                      'total_usable_ram_mb': 4096})
+                 for (i, free_ram_mb) in enumerate(free_ram_mbs)]
+        get_all_host_states = mock.Mock(return_value=iter(hosts))
+        self.stubs.Set(self.driver, '_get_all_host_states',
+                       get_all_host_states)
+        return get_all_host_states
+
+    def test_select_destinations_batch(self):
+        get_all_host_states = self._stub_batch_hosts([1024, 2048, 3072])
+        requests = [self._get_batch_request(512),
+                    self._get_batch_request(2048, num_instances=2),
+                    self._get_batch_request(1024)]
+
+        results = self.driver.select_destinations_batch(self.context,
+                                                        requests)
+
+        # One snapshot is shared, and the larger requests are placed first
+        self.assertEqual(1, get_all_host_states.call_count)
+        self.assertEqual([[('host2', 'node2')],
+                          [('host2', 'node2'), ('host1', 'node1')],
+                          [('host0', 'node0')]],
+                         [[(x['host'], x['nodename']) for x in result]
+                          for result in results])
+
+    def test_select_destinations_batch_filters_once_per_signature(self):
+        self._stub_batch_hosts([4096, 4096, 4096])
+        requests = [self._get_batch_request(1024) for i in xrange(3)]
+        requests.append(self._get_batch_request(
+            1024, scheduler_hints={'fake': 'hint'}))
+
+        with mock.patch.object(self.driver.host_manager,
+                               'get_filtered_hosts',
+                               wraps=self.driver.host_manager.
+                               get_filtered_hosts) as get_filtered_hosts:
+            results = self.driver.select_destinations_batch(self.context,
+                                                            requests)
+
+        self.assertNotIn(None, results)
+        # The hosts are filtered once per signature, then only the chosen
+        # host is filtered again for each signature
+        full_passes = [x for x in get_filtered_hosts.call_args_list
+                       if len(x[0][0]) > 1]
+        self.assertEqual(2, len(full_passes))
+
+    def test_select_destinations_batch_consumes_between_picks(self):
+        self._stub_batch_hosts([1024, 1536])
+        requests = [self._get_batch_request(1024) for i in xrange(3)]
+
+        results = self.driver.select_destinations_batch(self.context,
+                                                        requests)
+
+        self.assertEqual(['host1', 'host0', None],
+                         [result and result[0]['host']
+                          for result in results])
+
+    def test_select_destinations_batch_no_valid_host(self):
+        self._stub_batch_hosts([1024])
+        requests = [self._get_batch_request(2048),
+                    self._get_batch_request(512)]
+
+        with mock.patch.object(self.driver.notifier, 'info') as mock_info:
+            results = self.driver.select_destinations_batch(self.context,
+                                                            requests)
+
+        self.assertIsNone(results[0])
+        self.assertEqual('host0', results[1][0]['host'])
+        self.assertEqual(3, mock_info.call_count)
+
+    def test_select_destinations_batch_gives_back_partial_request(self):
+        get_all_host_states = self._stub_batch_hosts([1024, 1024])
+        hosts = list(get_all_host_states.return_value)
+        get_all_host_states.return_value = iter(hosts)
+        requests = [self._get_batch_request(1024, num_instances=3),
+                    self._get_batch_request(512)]
+
+        results = self.driver.select_destinations_batch(self.context,
+                                                        requests)
+
+        # The two instances placed for the first request are given back
+        self.assertIsNone(results[0])
+        self.assertEqual(1, len(results[1]))
+        self.assertEqual([0, 1], sorted(x.num_instances for x in hosts))
+        self.assertEqual([512, 1024], sorted(x.free_ram_mb for x in hosts))
+
     def test_handles_deleted_instance(self):
         """Test instance deletion while being scheduled."""
 
@@ -18,6 +18,9 @@ Tests For Scheduler Host Filters.
 import inspect
 import sys
 
+import mock
+from oslo.utils import timeutils
+
 from nova import filters
 from nova import loadables
 from nova import test
@@ -204,3 +207,81 @@ class FiltersTestCase(test.NoDBTestCase):
                                                      filter_objs_initial,
                                                      filter_properties)
         self.assertIsNone(result)
+
+
+class MemoizedFilter(filters.BaseFilter):
+    """Test filter memoized on the name of its objects."""
+
+    def cache_key(self, obj, filter_properties):
+        if obj.startswith('nokey'):
+            return None
+        return obj
+
+    def _filter_one(self, obj, filter_properties):
+        return obj.endswith('pass')
+
+
+class FilterMemoTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(FilterMemoTestCase, self).setUp()
+
+        def _fake_base_loader_init(*args, **kwargs):
+            pass
+
+        self.stubs.Set(loadables.BaseLoader, '__init__',
+                       _fake_base_loader_init)
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+
+    def test_memo_disabled(self):
+        filter_handler = filters.BaseFilterHandler(filters.BaseFilter)
+        self.assertIsNone(filter_handler.memo)
+
+    def test_get_filtered_objects_memoized(self):
+        self.flags(filter_memo_size=10)
+        filter_handler = filters.BaseFilterHandler(filters.BaseFilter)
+        objs = ['obj1-pass', 'obj2-fail', 'nokey-pass']
+
+        with mock.patch.object(MemoizedFilter, '_filter_one',
+                               wraps=MemoizedFilter()._filter_one) as one:
+            result = filter_handler.get_filtered_objects([MemoizedFilter],
+                                                         objs, {})
+            self.assertEqual(['obj1-pass', 'nokey-pass'], result)
+            self.assertEqual(3, one.call_count)
+
+            result = filter_handler.get_filtered_objects([MemoizedFilter],
+                                                         objs, {})
+            self.assertEqual(['obj1-pass', 'nokey-pass'], result)
+            # Only the object without a cache key is filtered again
+            self.assertEqual(4, one.call_count)
+
+    def test_get_filtered_objects_without_cache_key(self):
+        self.flags(filter_memo_size=10)
+        filter_handler = filters.BaseFilterHandler(filters.BaseFilter)
+        with mock.patch.object(Filter1, 'filter_all',
+                               return_value=['obj1']) as filter_all:
+            result = filter_handler.get_filtered_objects([Filter1],
+                                                         ['obj1', 'obj2'], {})
+        self.assertEqual(['obj1'], result)
+        filter_all.assert_called_once_with(['obj1', 'obj2'], {})
+        self.assertEqual(0, len(filter_handler.memo.results))
+
+    def test_memo_evicts_least_recently_used(self):
+        memo = filters.FilterMemo(2, 60)
+        memo.set('a', True)
+        memo.set('b', False)
+        self.assertTrue(memo.get('a'))
+        memo.set('c', True)
+        self.assertIsNone(memo.get('b'))
+        self.assertTrue(memo.get('a'))
+        self.assertTrue(memo.get('c'))
+
+    def test_memo_expires(self):
+        memo = filters.FilterMemo(2, 60)
+        memo.set('a', False)
+        timeutils.advance_time_seconds(59)
+        self.assertFalse(memo.get('a'))
+        timeutils.advance_time_seconds(1)
+        self.assertIsNone(memo.get('a'))
+        self.assertEqual(0, len(memo.results))
+
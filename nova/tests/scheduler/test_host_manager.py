@@ -16,6 +16,8 @@
 Tests For HostManager
 """
 
+import datetime
+
 import mock
 from oslo.serialization import jsonutils
 from oslo.utils import timeutils
@@ -387,6 +389,137 @@ class HostManagerChangedNodesTestCase(test.NoDBTestCase):
         self.assertEqual(len(host_states_map), 0)
 
 
+class HostManagerIncrementalRefreshTestCase(test.NoDBTestCase):
+    """Test case for the incremental refresh of the host states."""
+
+    def setUp(self):
+        super(HostManagerIncrementalRefreshTestCase, self).setUp()
+        self.flags(scheduler_incremental_host_state_refresh=True)
+        self.host_manager = host_manager.HostManager()
+        self.context = 'fake_context'
+        self.now = timeutils.utcnow()
+        timeutils.set_time_override(self.now)
+        self.addCleanup(timeutils.clear_time_override)
+        self.compute_nodes = [
+            self._compute_node(x, self.now - datetime.timedelta(minutes=x))
+            for x in xrange(1, 5)]
+        self.services = [dict(id=x, host='host%d' % x, disabled=False,
+                              binary='nova-compute') for x in xrange(1, 5)]
+        self.services.append(dict(id=5, host='host1', disabled=False,
+                                  binary='nova-scheduler'))
+
+    def _compute_node(self, compute_id, updated_at, **kwargs):
+        compute = dict(id=compute_id, local_gb=1024, memory_mb=1024,
+                       vcpus=1, disk_available_least=None, free_ram_mb=512,
+                       vcpus_used=1, free_disk_gb=512, local_gb_used=0,
+                       created_at=updated_at, updated_at=updated_at,
+                       deleted_at=None, deleted=0,
+                       service=dict(host='host%d' % compute_id,
+                                    disabled=False),
+                       hypervisor_hostname='node%d' % compute_id,
+                       host_ip='127.0.0.1', hypervisor_version=0,
+                       numa_topology=None)
+        compute.update(kwargs)
+        return compute
+
+    @mock.patch.object(db, 'service_get_all')
+    @mock.patch.object(db, 'compute_node_get_all_changed_since')
+    @mock.patch.object(db, 'compute_node_get_all')
+    def _refresh(self, changed_nodes, get_all, get_changed, get_services):
+        get_all.return_value = self.compute_nodes
+        get_changed.return_value = changed_nodes
+        get_services.return_value = self.services
+        self.host_manager.get_all_host_states(self.context)
+        return (get_all, get_changed)
+
+    def test_first_refresh_reads_every_node(self):
+        (get_all, get_changed) = self._refresh([])
+        get_all.assert_called_once_with(self.context)
+        self.assertFalse(get_changed.called)
+        self.assertEqual(4, len(self.host_manager.host_state_map))
+        self.assertEqual(self.now - datetime.timedelta(minutes=1),
+                         self.host_manager.last_compute_node_change)
+
+    def test_incremental_refresh(self):
+        self._refresh([])
+        host_state = self.host_manager.host_state_map[('host2', 'node2')]
+        changed = self._compute_node(2, self.now, free_ram_mb=256)
+
+        with mock.patch.object(host_manager.HostState,
+                               'update_from_compute_node') as update:
+            (get_all, get_changed) = self._refresh([changed])
+
+        self.assertFalse(get_all.called)
+        get_changed.assert_called_once_with(
+            self.context, self.now - datetime.timedelta(minutes=1) -
+            host_manager.CHANGED_SINCE_MARGIN)
+        update.assert_called_once_with(changed)
+        self.assertIs(host_state,
+                      self.host_manager.host_state_map[('host2', 'node2')])
+        self.assertEqual(self.now, self.host_manager.last_compute_node_change)
+
+    def test_incremental_refresh_skips_known_nodes(self):
+        self._refresh([])
+        with mock.patch.object(host_manager.HostState,
+                               'update_from_compute_node') as update:
+            self._refresh([self.compute_nodes[0]])
+        self.assertFalse(update.called)
+
+    def test_incremental_refresh_new_node(self):
+        self._refresh([])
+        self.services.append(dict(id=6, host='host5', disabled=False,
+                                  binary='nova-compute'))
+        self._refresh([self._compute_node(5, self.now)])
+        self.assertEqual(5, len(self.host_manager.host_state_map))
+        self.assertEqual(512, self.host_manager.host_state_map[
+            ('host5', 'node5')].free_ram_mb)
+
+    def test_incremental_refresh_deleted_node(self):
+        self._refresh([])
+        deleted = self._compute_node(3, self.now, deleted=3,
+                                     deleted_at=self.now)
+        self._refresh([deleted])
+        self.assertEqual(3, len(self.host_manager.host_state_map))
+        self.assertNotIn(('host3', 'node3'), self.host_manager.host_state_map)
+
+    def test_incremental_refresh_node_created_again(self):
+        self._refresh([])
+        deleted = self._compute_node(3, self.now, deleted=3,
+                                     deleted_at=self.now)
+        created = self._compute_node(6, self.now, service=dict(
+            host='host3', disabled=False), hypervisor_hostname='node3')
+        self._refresh([created, deleted])
+        self.assertEqual(4, len(self.host_manager.host_state_map))
+        self.assertEqual(('host3', 'node3'),
+                         self.host_manager.compute_node_keys[6])
+
+    def test_incremental_refresh_updates_services(self):
+        self._refresh([])
+        self.services[0]['disabled'] = True
+        del self.services[3]
+        self._refresh([])
+        host_states_map = self.host_manager.host_state_map
+        self.assertEqual(3, len(host_states_map))
+        self.assertTrue(host_states_map[('host1', 'node1')].service[
+            'disabled'])
+        self.assertNotIn(('host4', 'node4'), host_states_map)
+
+    def test_full_refresh_interval(self):
+        self.flags(scheduler_host_state_full_refresh_interval=60)
+        self._refresh([])
+        timeutils.advance_time_seconds(61)
+        (get_all, get_changed) = self._refresh([])
+        get_all.assert_called_once_with(self.context)
+        self.assertFalse(get_changed.called)
+
+    def test_disabled(self):
+        self.flags(scheduler_incremental_host_state_refresh=False)
+        self._refresh([])
+        (get_all, get_changed) = self._refresh([])
+        get_all.assert_called_once_with(self.context)
+        self.assertFalse(get_changed.called)
+
+
 class HostStateTestCase(test.NoDBTestCase):
     """Test case for HostState class."""
 
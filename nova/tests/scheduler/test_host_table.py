@@ -0,0 +1,272 @@
+# Copyright (c) 2014 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Tests For the columnar host state table.
+"""
+
+import random
+
+import mock
+import testtools
+
+from nova import exception
+from nova.scheduler import filters
+from nova.scheduler import host_manager
+from nova.scheduler import host_table
+from nova.scheduler import weights
+from nova import test
+from nova.tests.scheduler import fakes
+
+
+def _make_hosts(count, seed=42):
+    rand = random.Random(seed)
+    hosts = []
+    for i in range(count):
+        total_ram = rand.choice([2048, 4096, 8192])
+        total_disk = rand.choice([20, 40, 80])
+        metrics = {}
+        if rand.random() < 0.8:
+            metrics['foo'] = host_manager.MetricItem(
+                value=rand.randint(0, 100), timestamp=None, source='fake')
+        if rand.random() < 0.8:
+            metrics['bar'] = host_manager.MetricItem(
+                value=rand.random(), timestamp=None, source='fake')
+        hosts.append(fakes.FakeHostState('host%d' % i, 'node%d' % i, {
+            'total_usable_ram_mb': total_ram,
+            'free_ram_mb': rand.randint(-512, total_ram),
+            'total_usable_disk_gb': total_disk,
+            'free_disk_mb': rand.randint(0, total_disk * 1024),
+            'vcpus_total': rand.choice([0, 4, 8]),
+            'vcpus_used': rand.randint(0, 100),
+            'num_instances': rand.randint(0, 60),
+            'num_io_ops': rand.randint(0, 10),
+            'metrics': metrics}))
+    return hosts
+
+
+@testtools.skipIf(host_table.numpy is None, 'numpy is not installed')
+class HostTableFilterTestCase(test.NoDBTestCase):
+    """Vectorized filters must select the same hosts and set the same
+    limits as their host_passes().
+    """
+
+    def setUp(self):
+        super(HostTableFilterTestCase, self).setUp()
+        self.filter_handler = filters.HostFilterHandler()
+        self.filter_properties = {'instance_type': {
+            'memory_mb': 1024, 'vcpus': 2, 'root_gb': 10,
+            'ephemeral_gb': 5, 'swap': 512}}
+
+    def _get_filter_classes(self, names):
+        return self.filter_handler.get_matching_classes(
+            ['nova.scheduler.filters.%s' % name for name in names])
+
+    def _assert_same_hosts(self, names, filter_properties=None):
+        if filter_properties is None:
+            filter_properties = self.filter_properties
+        filter_classes = self._get_filter_classes(names)
+        expected_hosts = _make_hosts(200)
+        hosts = _make_hosts(200)
+
+        expected = self.filter_handler.get_filtered_objects(
+            filter_classes, expected_hosts, filter_properties)
+        result = host_table.filter_hosts(self.filter_handler, filter_classes,
+                                         hosts, filter_properties)
+
+        self.assertTrue(0 < len(result) < 200)
+        self.assertEqual([x.host for x in expected],
+                         [x.host for x in result])
+        for (expected_host, host) in zip(expected, result):
+            self.assertEqual(expected_host.limits, host.limits)
+
+    def test_ram_filter(self):
+        self._assert_same_hosts(['ram_filter.RamFilter'])
+
+    def test_core_filter(self):
+        self._assert_same_hosts(['core_filter.CoreFilter'])
+
+    def test_disk_filter(self):
+        self._assert_same_hosts(['disk_filter.DiskFilter'])
+
+    def test_num_instances_filter(self):
+        self._assert_same_hosts(['num_instances_filter.NumInstancesFilter'])
+
+    def test_io_ops_filter(self):
+        self._assert_same_hosts(['io_ops_filter.IoOpsFilter'])
+
+    def test_vectorized_and_per_host_filters(self):
+        self._assert_same_hosts(['ram_filter.RamFilter',
+                                 'retry_filter.RetryFilter',
+                                 'io_ops_filter.IoOpsFilter',
+                                 'all_hosts_filter.AllHostsFilter'])
+
+    def test_per_host_filters_run_on_remaining_hosts(self):
+        filter_classes = self._get_filter_classes(
+            ['ram_filter.RamFilter', 'all_hosts_filter.AllHostsFilter'])
+        hosts = _make_hosts(200)
+        with mock.patch.object(self.filter_handler,
+                               'get_filtered_objects') as get_filtered:
+            host_table.filter_hosts(self.filter_handler, filter_classes,
+                                    hosts, self.filter_properties)
+        (remaining_classes, remaining_hosts, _, _) = get_filtered.call_args[0]
+        self.assertEqual(['AllHostsFilter'],
+                         [x.__name__ for x in remaining_classes])
+        self.assertTrue(len(remaining_hosts) < len(hosts))
+
+    def test_aggregate_filters_run_per_host(self):
+        table = host_table.HostTable(_make_hosts(3))
+        for name in ['disk_filter.AggregateDiskFilter',
+                     'num_instances_filter.AggregateNumInstancesFilter',
+                     'io_ops_filter.AggregateIoOpsFilter',
+                     'ram_filter.AggregateRamFilter',
+                     'core_filter.AggregateCoreFilter']:
+            filter_cls = self._get_filter_classes([name])[0]
+            self.assertIsNone(filter_cls().filter_columns(
+                table, self.filter_properties))
+
+    def test_no_host_passes(self):
+        filter_classes = self._get_filter_classes(['ram_filter.RamFilter'])
+        filter_properties = {'instance_type': {'memory_mb': 10 ** 6}}
+        result = host_table.filter_hosts(self.filter_handler, filter_classes,
+                                         _make_hosts(10), filter_properties)
+        self.assertEqual([], result)
+
+    def test_no_hosts(self):
+        filter_classes = self._get_filter_classes(['ram_filter.RamFilter'])
+        result = host_table.filter_hosts(self.filter_handler, filter_classes,
+                                         [], self.filter_properties)
+        self.assertEqual([], result)
+
+    def test_unset_column_filters_per_host(self):
+        filter_classes = self._get_filter_classes(['ram_filter.RamFilter'])
+        hosts = _make_hosts(10)
+        hosts[3].free_ram_mb = None
+        with mock.patch.object(self.filter_handler,
+                               'get_filtered_objects') as get_filtered:
+            host_table.filter_hosts(self.filter_handler, filter_classes,
+                                    hosts, self.filter_properties)
+        get_filtered.assert_called_once_with(filter_classes, hosts,
+                                             self.filter_properties, 0)
+
+
+@testtools.skipIf(host_table.numpy is None, 'numpy is not installed')
+class HostTableWeigherTestCase(test.NoDBTestCase):
+    """Vectorized weighers must give the same weights and order as the
+    weight handler.
+    """
+
+    def setUp(self):
+        super(HostTableWeigherTestCase, self).setUp()
+        self.weight_handler = weights.HostWeightHandler()
+        self.flags(weight_setting=['foo=1', 'bar=-2.5'], group='metrics')
+        self.flags(required=False, group='metrics')
+
+    def _get_weigher_classes(self, names):
+        return self.weight_handler.get_matching_classes(
+            ['nova.scheduler.weights.%s' % name for name in names])
+
+    def _assert_same_order(self, names, limit=None):
+        weigher_classes = self._get_weigher_classes(names)
+        expected = self.weight_handler.get_weighed_objects(
+            weigher_classes, _make_hosts(200), {})
+        result = host_table.weigh_hosts(self.weight_handler, weigher_classes,
+                                        _make_hosts(200), {}, limit=limit)
+
+        expected = expected[:limit]
+        self.assertEqual([(x.obj.host, x.weight) for x in expected],
+                         [(x.obj.host, x.weight) for x in result])
+
+    def test_ram_weigher(self):
+        self._assert_same_order(['ram.RAMWeigher'])
+
+    def test_io_ops_weigher(self):
+        # Many hosts have the same number of I/O operations
+        self._assert_same_order(['io_ops.IoOpsWeigher'])
+
+    def test_metrics_weigher(self):
+        self._assert_same_order(['metrics.MetricsWeigher'])
+
+    def test_all_weighers(self):
+        self._assert_same_order(['ram.RAMWeigher', 'io_ops.IoOpsWeigher',
+                                 'metrics.MetricsWeigher'])
+
+    def test_limit(self):
+        for limit in (1, 5, 199, 200, 500):
+            self._assert_same_order(['io_ops.IoOpsWeigher'], limit=limit)
+
+    def test_per_host_weigher(self):
+        class FakeWeigher(weights.BaseHostWeigher):
+            def _weigh_object(self, host_state, weight_properties):
+                return len(host_state.host)
+
+        weigher_classes = [FakeWeigher] + self._get_weigher_classes(
+            ['ram.RAMWeigher'])
+        expected = self.weight_handler.get_weighed_objects(
+            weigher_classes, _make_hosts(200), {})
+        result = host_table.weigh_hosts(self.weight_handler, weigher_classes,
+                                        _make_hosts(200), {})
+        self.assertEqual([(x.obj.host, x.weight) for x in expected],
+                         [(x.obj.host, x.weight) for x in result])
+
+    def test_required_metric_not_found(self):
+        self.flags(required=True, group='metrics')
+        weigher_classes = self._get_weigher_classes(['metrics.MetricsWeigher'])
+        self.assertRaises(exception.ComputeHostMetricNotFound,
+                          host_table.weigh_hosts, self.weight_handler,
+                          weigher_classes, _make_hosts(200), {})
+
+
+class HostManagerHostTableTestCase(test.NoDBTestCase):
+    """The host manager filters and weighs over a host table only when it
+    is enabled and numpy is available.
+    """
+
+    def setUp(self):
+        super(HostManagerHostTableTestCase, self).setUp()
+        self.host_manager = host_manager.HostManager()
+        self.hosts = _make_hosts(10)
+        self.filter_properties = {'instance_type': {'memory_mb': 1024}}
+
+    @mock.patch.object(host_table, 'filter_hosts')
+    def test_disabled(self, filter_hosts):
+        self.flags(scheduler_use_host_table=False,
+                   scheduler_default_filters=['RamFilter'])
+        self.host_manager.get_filtered_hosts(self.hosts,
+                                             self.filter_properties)
+        self.assertFalse(filter_hosts.called)
+
+    @mock.patch.object(host_table, 'numpy', None)
+    @mock.patch.object(host_table, 'filter_hosts')
+    def test_numpy_not_installed(self, filter_hosts):
+        self.flags(scheduler_use_host_table=True,
+                   scheduler_default_filters=['RamFilter'])
+        result = self.host_manager.get_filtered_hosts(self.hosts,
+                                                      self.filter_properties)
+        self.assertFalse(filter_hosts.called)
+        self.assertTrue(len(result) > 0)
+
+    @testtools.skipIf(host_table.numpy is None, 'numpy is not installed')
+    def test_enabled(self):
+        self.flags(scheduler_use_host_table=True,
+                   scheduler_default_filters=['RamFilter'])
+        with mock.patch.object(host_table, 'filter_hosts',
+                               return_value=[]) as filter_hosts:
+            self.host_manager.get_filtered_hosts(self.hosts,
+                                                 self.filter_properties)
+        self.assertTrue(filter_hosts.called)
+
+        weighed_hosts = self.host_manager.get_weighed_hosts(self.hosts, {},
+                                                            limit=3)
+        self.assertEqual(3, len(weighed_hosts))
@@ -67,3 +67,7 @@ class SchedulerRpcAPITestCase(test.NoDBTestCase):
         self._test_scheduler_api('select_destinations', rpc_method='call',
                 request_spec='fake_request_spec',
                 filter_properties='fake_prop')
+
+    def test_select_destinations_batch(self):
+        self._test_scheduler_api('select_destinations_batch',
+                rpc_method='call', requests='fake_requests', version='3.1')
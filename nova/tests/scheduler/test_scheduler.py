@@ -269,6 +269,21 @@ class SchedulerManagerTestCase(test.NoDBTestCase):
         self.assertEqual([['host', 'node']],
                          filter_properties['retry']['hosts'])
 
+    def test_select_destinations_batch(self):
+        requests = [{'request_spec': 'fake_spec',
+                     'filter_properties': 'fake_props'}]
+        dests = [[dict(host='host', nodename='node', limits={})]]
+
+        self.mox.StubOutWithMock(self.manager.driver,
+                                 'select_destinations_batch')
+        self.manager.driver.select_destinations_batch(
+            self.context, requests).AndReturn(dests)
+
+        self.mox.ReplayAll()
+        result = self.manager.select_destinations_batch(self.context,
+                                                        requests)
+        self.assertEqual(dests, result)
+
 
 class SchedulerTestCase(test.NoDBTestCase):
     """Test case for base scheduler driver class."""
@@ -355,6 +370,24 @@ class SchedulerDriverBaseTestCase(SchedulerTestCase):
         self.assertRaises(NotImplementedError,
                 self.driver.select_destinations, self.context, {}, {})
 
+    def test_select_destinations_batch(self):
+        requests = [{'request_spec': 'fake_spec1',
+                     'filter_properties': 'fake_props1'},
+                    {'request_spec': 'fake_spec2',
+                     'filter_properties': 'fake_props2'}]
+        self.mox.StubOutWithMock(self.driver, 'select_destinations')
+        self.driver.select_destinations(
+            self.context, 'fake_spec1', 'fake_props1').AndReturn(
+                ['fake_dest'])
+        self.driver.select_destinations(
+            self.context, 'fake_spec2', 'fake_props2').AndRaise(
+                exception.NoValidHost(reason=''))
+        self.mox.ReplayAll()
+
+        results = self.driver.select_destinations_batch(self.context,
+                                                        requests)
+        self.assertEqual([['fake_dest'], None], results)
+
 
 class SchedulerInstanceGroupData(test.TestCase):
 
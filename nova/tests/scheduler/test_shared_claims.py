@@ -0,0 +1,215 @@
+# Copyright (c) 2014 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Tests For the resource claims shared by scheduler workers.
+"""
+
+import mock
+from oslo.utils import timeutils
+
+from nova.openstack.common import memorycache
+from nova.scheduler import caching_scheduler
+from nova.scheduler import host_manager
+from nova.scheduler import shared_claims
+from nova import test
+
+INSTANCE = dict(root_gb=1, ephemeral_gb=1, memory_mb=512, vcpus=1,
+                vm_state='building', task_state=None, project_id='fake',
+                pci_requests=None)
+
+
+class SharedClaimsTestCase(test.NoDBTestCase):
+    """Test case for SharedClaims class."""
+
+    def setUp(self):
+        super(SharedClaimsTestCase, self).setUp()
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        self.client = memorycache.Client()
+        # Two scheduler workers, with their own copy of the host states
+        self.claims1 = shared_claims.SharedClaims(self.client)
+        self.claims2 = shared_claims.SharedClaims(self.client)
+        self.report = timeutils.utcnow()
+        self.hosts1 = self._host_states()
+        self.hosts2 = self._host_states()
+        timeutils.advance_time_seconds(1)
+
+    def _host_states(self):
+        host_states = []
+        for i in xrange(2):
+            host_state = host_manager.HostState('host%d' % i, 'node%d' % i)
+            host_state.update_from_compute_node(dict(
+                memory_mb=4096, free_ram_mb=4096, local_gb=100,
+                free_disk_gb=100, local_gb_used=0, vcpus=4, vcpus_used=0,
+                updated_at=self.report, host_ip='127.0.0.1',
+                hypervisor_version=0, numa_topology=None))
+            host_states.append(host_state)
+        return host_states
+
+    def _consume(self, claims, host_state):
+        host_state.consume_from_instance(INSTANCE)
+        claims.publish(host_state, INSTANCE)
+        timeutils.advance_time_seconds(1)
+
+    def test_apply_claims_of_other_worker(self):
+        self.claims1.apply(self.hosts1)
+        self.claims2.apply(self.hosts2)
+        self._consume(self.claims1, self.hosts1[0])
+        self._consume(self.claims1, self.hosts1[0])
+
+        self.claims2.apply(self.hosts2)
+        self.assertEqual(3072, self.hosts2[0].free_ram_mb)
+        self.assertEqual(2, self.hosts2[0].vcpus_used)
+        self.assertEqual(2, self.hosts2[0].num_instances)
+        self.assertEqual(4096, self.hosts2[1].free_ram_mb)
+
+        # Claims are applied once, and not to the worker that made them
+        self.claims1.apply(self.hosts1)
+        self.claims2.apply(self.hosts2)
+        self.assertEqual(3072, self.hosts1[0].free_ram_mb)
+        self.assertEqual(3072, self.hosts2[0].free_ram_mb)
+
+    def test_concurrent_claims_are_numbered(self):
+        self.claims1.apply(self.hosts1)
+        self.claims2.apply(self.hosts2)
+        self._consume(self.claims1, self.hosts1[1])
+        self._consume(self.claims2, self.hosts2[1])
+
+        self.assertEqual([1], self.claims1.claims[('host1', 'node1')].keys())
+        self.assertEqual([2], self.claims2.claims[('host1', 'node1')].keys())
+        self.claims1.apply(self.hosts1)
+        self.claims2.apply(self.hosts2)
+        self.assertEqual(3072, self.hosts1[1].free_ram_mb)
+        self.assertEqual(3072, self.hosts2[1].free_ram_mb)
+
+    def test_apply_after_compute_node_report(self):
+        self.claims1.apply(self.hosts1)
+        self.claims2.apply(self.hosts2)
+        self._consume(self.claims1, self.hosts1[0])
+        # The report counts the first claim, not the second one
+        compute = dict(memory_mb=4096, free_ram_mb=3584, local_gb=100,
+                       free_disk_gb=98, local_gb_used=2, vcpus=4,
+                       vcpus_used=1, updated_at=timeutils.utcnow(),
+                       host_ip='127.0.0.1', hypervisor_version=0,
+                       numa_topology=None)
+        timeutils.advance_time_seconds(1)
+        self.claims2.apply(self.hosts2)
+        self._consume(self.claims2, self.hosts2[0])
+        self._consume(self.claims1, self.hosts1[1])
+        for host_state in (self.hosts1[0], self.hosts2[0]):
+            host_state.updated = None
+            host_state.update_from_compute_node(compute)
+
+        self.claims1.apply(self.hosts1)
+        self.claims2.apply(self.hosts2)
+        for host_states in (self.hosts1, self.hosts2):
+            self.assertEqual(3072, host_states[0].free_ram_mb)
+            self.assertEqual(2, host_states[0].vcpus_used)
+            self.assertEqual(3584, host_states[1].free_ram_mb)
+
+    def test_expired_claims_are_forgotten(self):
+        self.flags(scheduler_shared_claims_ttl=10)
+        self._consume(self.claims1, self.hosts1[0])
+        timeutils.advance_time_seconds(20)
+        self.claims1.apply(self.hosts1)
+        self.claims2.apply(self.hosts2)
+        self.assertEqual({}, self.claims1.claims[('host0', 'node0')])
+        self.assertEqual(4096, self.hosts2[0].free_ram_mb)
+
+    def _consume_not_stored(self, claims, host_state):
+        """Consume and number a claim, whose storage is delayed: returns the
+        arguments of the delayed set()."""
+        delayed = []
+        set_value = self.client.set
+
+        def delay_claims(key, *args, **kwargs):
+            if key.endswith('-count'):
+                return set_value(key, *args, **kwargs)
+            delayed.append((key,) + args)
+
+        with mock.patch.object(self.client, 'set', delay_claims):
+            self._consume(claims, host_state)
+        return delayed[0]
+
+    def test_claim_stored_after_read(self):
+        state_key = ('host0', 'node0')
+        self.claims2.apply(self.hosts2)
+        # The first claim is numbered, but not stored before the second one
+        delayed = self._consume_not_stored(self.claims1, self.hosts1[0])
+        self._consume(self.claims1, self.hosts1[0])
+
+        self.claims2.apply(self.hosts2)
+        self.assertEqual(3584, self.hosts2[0].free_ram_mb)
+        self.assertEqual(0, self.claims2.last_numbers[state_key])
+        self.assertEqual([1], self.claims2.gaps[state_key].keys())
+
+        self.client.set(*delayed)
+        self.claims2.apply(self.hosts2)
+        self.assertEqual(3072, self.hosts2[0].free_ram_mb)
+        self.assertEqual(2, self.claims2.last_numbers[state_key])
+        self.assertEqual({}, self.claims2.gaps[state_key])
+
+    def test_claim_never_stored(self):
+        self.flags(scheduler_shared_claims_ttl=10)
+        state_key = ('host0', 'node0')
+        self._consume_not_stored(self.claims1, self.hosts1[0])
+        self.claims2.apply(self.hosts2)
+        self.assertEqual(0, self.claims2.last_numbers[state_key])
+
+        timeutils.advance_time_seconds(20)
+        self.claims2.apply(self.hosts2)
+        self.assertEqual(1, self.claims2.last_numbers[state_key])
+        self.assertEqual({}, self.claims2.gaps[state_key])
+        self.assertEqual(4096, self.hosts2[0].free_ram_mb)
+
+    def test_publish_error(self):
+        with mock.patch.object(self.client, 'incr',
+                               side_effect=ValueError('fake')):
+            with mock.patch.object(shared_claims.LOG, 'warn') as warn:
+                self.claims1.publish(self.hosts1[0], INSTANCE)
+        self.assertTrue(warn.called)
+        self.assertEqual({}, self.claims1.claims)
+
+    def test_apply_error(self):
+        with mock.patch.object(self.client, 'get',
+                               side_effect=ValueError('fake')):
+            with mock.patch.object(shared_claims.LOG, 'warn') as warn:
+                result = self.claims1.apply(self.hosts1)
+        self.assertTrue(warn.called)
+        self.assertEqual(self.hosts1, result)
+
+
+class CachingSchedulerSharedClaimsTestCase(test.NoDBTestCase):
+    """Test case for the shared claims of the CachingScheduler."""
+
+    def test_disabled(self):
+        driver = caching_scheduler.CachingScheduler()
+        self.assertIsNone(driver.shared_claims)
+
+    @mock.patch.object(shared_claims.SharedClaims, 'publish')
+    @mock.patch.object(shared_claims.SharedClaims, 'apply')
+    def test_enabled(self, apply_claims, publish):
+        self.flags(scheduler_share_claims=True)
+        driver = caching_scheduler.CachingScheduler()
+        driver.all_host_states = ['fake_host_state']
+
+        result = driver._get_all_host_states('fake_context')
+        self.assertEqual(['fake_host_state'], result)
+        apply_claims.assert_called_once_with(['fake_host_state'])
+
+        host_state = mock.Mock()
+        driver._consume_from_instance(host_state, INSTANCE)
+        host_state.consume_from_instance.assert_called_once_with(INSTANCE)
+        publish.assert_called_once_with(host_state, INSTANCE)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Micro-benchmarks of the discovery database backend.
+
+The "predicates" benchmark measures the evaluation of the criterions built by
+instance_get_all_by_filters (deleted and soft deleted filters, exact filters
+on the project and on a list of hosts, regular expression on the name) on
+rows of instances that are built in memory: no database is required.
+
+The "api" benchmark populates a storage that stands in for Riak (in memory,
+or in a sqlite database) with services, compute nodes, instances and quotas,
+and measures the hot calls of the database API. For each call, it reports
+its latency, the number of Riak operations (round trips) it issued, and the
+number of objects it allocated (objects tracked by the garbage collector
+that are still alive when the call returns).
+
+    python tools/db/discovery_bench.py --rows 10000
+    python tools/db/discovery_bench.py --bench api --instances 1000
+"""
+
+from __future__ import print_function
+
+import contextlib
+import datetime
+import gc
+import optparse
+import os
+import random
+import sys
+import time
+
+from oslo.config import cfg
+from oslo.db import options as db_options
+from sqlalchemy.sql import null
+from sqlalchemy.util._collections import KeyedTuple
+
+from nova.compute import vm_states
+from nova import context as nova_context
+from nova.db.discovery import client
+from nova.db.discovery import models
+from nova.db.discovery.query import or_
+from nova.db.discovery.query import RiakModelQuery
+from nova import quota
+
+CONF = cfg.CONF
+
+
+def build_instance_rows(count):
+    """Returns rows of instances, labelled as the rows of RiakModelQuery."""
+
+    random.seed(0)
+    rows = []
+    for i in range(count):
+        instance = models.Instance()
+        instance.id = i + 1
+        instance.deleted = random.choice([0, 0, 0, i + 1])
+        instance.vm_state = random.choice([vm_states.ACTIVE,
+                                           vm_states.SOFT_DELETED, None])
+        instance.project_id = "project-%d" % (i % 10)
+        instance.host = "host-%d" % (i % 100)
+        instance.display_name = "server-%d" % (i)
+        rows += [KeyedTuple([instance], labels=["Instances"])]
+    return rows
+
+
+def build_instance_query():
+    """Returns a query with the criterions of instance_get_all_by_filters
+    for a non admin request that filters on hosts and on the name."""
+
+    query = RiakModelQuery(models.Instance).\
+        filter_by(deleted=0).\
+        filter(or_(models.Instance.vm_state != vm_states.SOFT_DELETED,
+                   models.Instance.vm_state == null())).\
+        filter(models.Instance.project_id == "project-3").\
+        filter(models.Instance.host.in_(["host-3", "host-13", "host-23"])).\
+        filter(models.Instance.display_name.op("REGEXP")("server-1"))
+    return query
+
+
+def bench_predicates(rows, repeat):
+    query = build_instance_query()
+
+    start = time.time()
+    for criterion in query._criterions:
+        criterion.compile()
+    compile_time = time.time() - start
+
+    timings = []
+    matches = 0
+    for _ in range(repeat):
+        start = time.time()
+        matches = 0
+        for row in rows:
+            if all(x.evaluate(row) for x in query._criterions):
+                matches += 1
+        timings += [time.time() - start]
+
+    best = min(timings)
+    print("predicates: %d rows, %d matches" % (len(rows), matches))
+    print("  compilation: %.3f ms" % (compile_time * 1000))
+    print("  evaluation: %.3f ms (best of %d), %.0f rows/s" %
+          (best * 1000, repeat, len(rows) / best))
+
+
+@contextlib.contextmanager
+def silenced():
+    """Hide the traces printed on the standard output by the backend."""
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def use_storage(storage, storage_path):
+    """Back the Riak client of the process by a storage that stands in for
+    Riak (the [database] options, read by the database API, are registered
+    with their defaults)."""
+
+    db_options.set_defaults(CONF, connection="sqlite://")
+    CONF.set_override("storage", storage, group="discovery")
+    CONF.set_override("storage_path", storage_path, group="discovery")
+    client.reset_client()
+
+
+def get_quota_resources():
+    return dict((name, quota.ReservableResource(name, "_sync_instances",
+                                                name))
+                for name in ["instances", "cores", "ram"])
+
+
+def populate(context, services, instances, projects):
+    """Create services (with their compute nodes), instances and quotas.
+    Returns the ids of the services and the uuids of the instances."""
+
+    from nova.db.discovery import api as db_api
+
+    random.seed(0)
+    service_ids = []
+    for i in range(services):
+        """Services are saved directly: service_create of the discovery
+        backend rejects every service (it compares a list of rows with
+        None)."""
+        service = models.Service()
+        service.update({"host": "host-%d" % (i), "binary": "nova-compute",
+                        "topic": "compute", "report_count": 0})
+        service_ids += [service.id]
+        db_api.compute_node_create(context, {
+            "service_id": service.id, "vcpus": 16, "memory_mb": 65536,
+            "local_gb": 1000, "vcpus_used": 0, "memory_mb_used": 0,
+            "local_gb_used": 0, "hypervisor_type": "fake",
+            "hypervisor_version": 1, "hypervisor_hostname": "node-%d" % (i),
+            "cpu_info": "{}", "free_ram_mb": 65536, "free_disk_gb": 1000,
+            "current_workload": 0, "running_vms": 0,
+            "disk_available_least": 1000})
+
+    instance_uuids = []
+    for i in range(instances):
+        instance = db_api.instance_create(context, {
+            "project_id": "project-%d" % (i % projects),
+            "user_id": "user-%d" % (i % projects),
+            "host": "host-%d" % (i % max(services, 1)),
+            "vcpus": random.choice([1, 2, 4]), "memory_mb": 2048,
+            "vm_state": vm_states.ACTIVE,
+            "display_name": "server-%d" % (i)})
+        instance_uuids += [instance.uuid]
+
+    for i in range(projects):
+        for (resource, limit) in [("instances", 100000), ("cores", 400000),
+                                  ("ram", 200000000)]:
+            db_api.quota_create(context, "project-%d" % (i), resource,
+                                limit)
+    return (service_ids, instance_uuids)
+
+
+def measure_call(function, *args):
+    """Call a function, and returns its latency, the number of Riak
+    operations it issued and the number of objects it allocated."""
+
+    gc.collect()
+    gc.disable()
+    try:
+        operations = client.get_operation_count()
+        objects = gc.get_count()[0]
+        start = time.time()
+        with silenced():
+            function(*args)
+        latency = time.time() - start
+        return (latency, client.get_operation_count() - operations,
+                gc.get_count()[0] - objects)
+    finally:
+        gc.enable()
+
+
+def get_api_calls(context, service_ids, instance_uuids):
+    """Returns the measured calls of the database API, as a list of tuples
+    (name, function, arguments of the n-th call)."""
+
+    from nova.db.discovery import api as db_api
+
+    resources = get_quota_resources()
+    quotas = {"instances": 100000, "cores": 400000, "ram": 200000000}
+    expire = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+
+    def quota_reserve(i):
+        project_context = nova_context.RequestContext(
+            "user-%d" % (i % 10), "project-%d" % (i % 10), is_admin=True)
+        db_api.quota_reserve(project_context, resources, quotas,
+                             dict(quotas), {"instances": 1, "cores": 1,
+                                            "ram": 512}, expire, 0, 0)
+
+    return [
+        ("instance_get_all_by_filters",
+         lambda i: db_api.instance_get_all_by_filters(
+             context, {"project_id": "project-%d" % (i % 10),
+                       "deleted": False}, "created_at", "desc")),
+        ("compute_node_get_all",
+         lambda i: db_api.compute_node_get_all(context, False)),
+        ("quota_reserve", quota_reserve),
+        ("service_update",
+         lambda i: db_api.service_update(
+             context, service_ids[i % len(service_ids)],
+             {"report_count": i})),
+        ("instance_update",
+         lambda i: db_api.instance_update(
+             context, instance_uuids[i % len(instance_uuids)],
+             {"task_state": None, "progress": i % 100})),
+    ]
+
+
+def bench_api(options):
+    """Populate a storage and measure the hot calls of the database API.
+    Returns the measures of each call, as a dict name -> (best latency,
+    round trips per call, allocated objects per call)."""
+
+    use_storage(options.storage, options.storage_path)
+    context = nova_context.RequestContext("bench-user", "bench-project",
+                                          is_admin=True)
+    start = time.time()
+    with silenced():
+        (service_ids, instance_uuids) = populate(
+            context, options.services, options.instances, options.projects)
+    print("api: %d services, %d instances, %d projects (%s storage, "
+          "populated in %.1f s)" % (options.services, options.instances,
+                                    options.projects, options.storage,
+                                    time.time() - start))
+
+    results = {}
+    for (name, function) in get_api_calls(context, service_ids,
+                                          instance_uuids):
+        measures = [measure_call(function, i) for i in range(options.repeat)]
+        best = min(x[0] for x in measures)
+        round_trips = float(sum(x[1] for x in measures)) / len(measures)
+        allocations = float(sum(x[2] for x in measures)) / len(measures)
+        results[name] = (best, round_trips, allocations)
+        print("  %s: %.3f ms (best of %d), %.1f round trips, "
+              "%.0f allocated objects" % (name, best * 1000, options.repeat,
+                                          round_trips, allocations))
+    return results
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-b", "--bench", default="predicates,api",
+                      help="comma separated list of benchmarks "
+                           "(default: %default)")
+    parser.add_option("-r", "--rows", type="int", default=10000,
+                      help="number of rows (default: %default)")
+    parser.add_option("-n", "--repeat", type="int", default=5,
+                      help="number of runs (default: %default)")
+    parser.add_option("--services", type="int", default=20,
+                      help="number of services and compute nodes "
+                           "(default: %default)")
+    parser.add_option("--instances", type="int", default=200,
+                      help="number of instances (default: %default)")
+    parser.add_option("--projects", type="int", default=10,
+                      help="number of projects (default: %default)")
+    parser.add_option("--storage", default="memory",
+                      help="storage of the api benchmark: memory or sqlite "
+                           "(default: %default)")
+    parser.add_option("--storage-path", default=None,
+                      help="path of the sqlite database")
+    (options, args) = parser.parse_args()
+
+    benchmarks = options.bench.split(",")
+    if "predicates" in benchmarks:
+        rows = build_instance_rows(options.rows)
+        bench_predicates(rows, options.repeat)
+    if "api" in benchmarks:
+        bench_api(options)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())